@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+Run the pipeline stages on synthetic datasets of increasing size, and compare the timings against a saved baseline.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import tomllib
+from dataclasses import asdict
+from datetime import datetime
+from typing import Dict, List
+
+from eflips.depot.api import SmartChargingStrategy, simulate_scenario
+from eflips.model import Trip, setup_database
+from sqlalchemy.orm import Session
+
+from scripts import database, instrumentation, util
+from scripts.pipeline import REPETITION_PERIOD, SMART_CHARGING_STRATEGY
+from scripts.feasibility import check_energy_feasibility
+from scripts.plot import plot_results
+from scripts.prepare import (
+    add_depot,
+    add_empty_trips,
+    delete_invalid_rotations_and_trips,
+    fix_driving_events,
+)
+from scripts.scheduling import do_scheduling
+from scripts.synthetic import generate_scenario
+from scripts.util import fixup_rotations
+
+if os.path.exists("config.toml"):
+    with open("config.toml", "rb") as fp:
+        config = tomllib.load(fp)
+else:
+    raise FileNotFoundError("config.toml not found.")
+
+# A separate database, as every benchmark run clears it
+BENCHMARK_DB_URL = util.construct_database_url(
+    config["benchmark"]["dbname"],
+    config["database"]["user"],
+    config["database"]["password"],
+    config["database"]["host"],
+    config["database"]["port"],
+)
+
+
+def run_benchmark(scale: float) -> Dict:
+    """
+    Generate a synthetic scenario of the given scale in an empty database and run all pipeline stages on it.
+
+    :param scale: The scale of the synthetic dataset, see :func:`scripts.synthetic.generate_scenario`.
+    :return: The number of trips and the :class:`instrumentation.StageMeasurement` of each stage, as a dictionary.
+    """
+    util.clear_database(BENCHMARK_DB_URL)
+    engine = database.get_engine(BENCHMARK_DB_URL)
+    setup_database(engine)
+
+    plot_config = copy.deepcopy(config)
+    plot_config["paths"]["output_dir"] = config["benchmark"]["output_dir"]
+
+    measurements: List[instrumentation.StageMeasurement] = []
+    try:
+        with Session(engine) as session:
+            scenario = generate_scenario(session, scale)
+            session.commit()
+            trip_count = session.query(Trip).filter(Trip.scenario == scenario).count()
+
+            stages = [
+                ("fixup", lambda: fixup_rotations(session)),
+                (
+                    "scheduling",
+                    lambda: do_scheduling(
+                        scenario,
+                        session,
+                        decompose=config["scheduling"]["decompose"],
+                        workers=config["scheduling"]["workers"],
+                    ),
+                ),
+                ("empty_trips", lambda: add_empty_trips(scenario, session)),
+                (
+                    "validation",
+                    lambda: delete_invalid_rotations_and_trips(scenario, session),
+                ),
+                ("driving_events", lambda: fix_driving_events(scenario, session)),
+                (
+                    "feasibility",
+                    lambda: check_energy_feasibility(
+                        scenario,
+                        session,
+                        min_soc=config["feasibility"]["min_soc"],
+                        split=config["feasibility"]["split"],
+                    ),
+                ),
+                (
+                    "depot",
+                    lambda: add_depot(
+                        scenario,
+                        session,
+                        electric_power=config["depot"]["electric_power"],
+                        capacity=config["depot"]["capacity"],
+                    ),
+                ),
+                (
+                    "simulation",
+                    lambda: simulate_scenario(
+                        scenario,
+                        repetition_period=REPETITION_PERIOD,
+                        smart_charging_strategy=SmartChargingStrategy[
+                            SMART_CHARGING_STRATEGY
+                        ],
+                    ),
+                ),
+                ("plotting", lambda: plot_results(scenario, session, plot_config)),
+            ]
+            for stage, run_stage in stages:
+                with instrumentation.measure_stage(stage, engine, measurements):
+                    run_stage()
+    finally:
+        database.dispose_engines()
+
+    return {
+        "trips": trip_count,
+        "stages": [asdict(measurement) for measurement in measurements],
+    }
+
+
+def find_regressions(results: Dict, baseline: Dict) -> List[str]:
+    """
+    Compare the wall times of a benchmark run against a baseline. A stage has regressed if it became slower by more
+    than both the relative `tolerance` and the absolute `min_regression_s` from the `[benchmark]` section.
+
+    :param results: The results of the current run, as written by this script.
+    :param baseline: The results of the baseline run.
+    :return: A description of each regression. Empty if there are none.
+    """
+    tolerance = config["benchmark"]["tolerance"]
+    min_regression = config["benchmark"]["min_regression_s"]
+    regressions = []
+    for scale, result in results["scales"].items():
+        if scale not in baseline["scales"]:
+            continue
+        baseline_times = {
+            stage["stage"]: stage["wall_time_s"]
+            for stage in baseline["scales"][scale]["stages"]
+        }
+        for stage in result["stages"]:
+            before = baseline_times.get(stage["stage"])
+            after = stage["wall_time_s"]
+            if before is None:
+                continue
+            if after > before * (1 + tolerance) and after - before > min_regression:
+                regressions.append(
+                    f"scale {scale}, stage {stage['stage']}: {before:.2f}s -> {after:.2f}s "
+                    f"(+{(after / before - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic datasets of increasing size."
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=float,
+        default=config["benchmark"]["scales"],
+        help="The dataset scales to run, relative to the base network.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the new baseline instead of comparing against it.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config["logging"]["level"])
+    logger = logging.getLogger(__name__)
+    database.configure_engines(config)
+
+    results = {
+        "written_at": datetime.now().astimezone().isoformat(),
+        "scales": {},
+    }
+    for scale in args.scales:
+        logger.info(f"Running benchmark at scale {scale:g}")
+        results["scales"][f"{scale:g}"] = run_benchmark(scale)
+
+    results_path = config["benchmark"]["results"]
+    baseline_path = config["benchmark"]["baseline"]
+    for path in [results_path] + ([baseline_path] if args.save_baseline else []):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            json.dump(results, fp, indent=2)
+    logger.info(f"Benchmark results written to {results_path}")
+
+    if not args.save_baseline:
+        if not os.path.exists(baseline_path):
+            logger.warning(
+                f"No baseline at {baseline_path}, run with --save-baseline to create one."
+            )
+            sys.exit(0)
+        with open(baseline_path) as fp:
+            baseline = json.load(fp)
+        regressions = find_regressions(results, baseline)
+        for regression in regressions:
+            logger.error(f"Regression at {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        logger.info("No regressions against the baseline.")
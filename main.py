@@ -3,27 +3,30 @@
 """
 This is the main file of the project. Run it to start the program.
 """
+import argparse
 import logging
 import os
+import sys
 import tomllib
-from datetime import timedelta
+from datetime import datetime
+from typing import List
 
-from eflips.depot.api import simulate_scenario, SmartChargingStrategy
 from eflips.model import (
+    Rotation,
     Scenario,
 )
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
-from scripts import util
-from scripts.plot import plot_results
-from scripts.prepare import (
-    add_empty_trips,
-    delete_invalid_rotations_and_trips,
-    add_depot,
-    fix_driving_events,
+from scripts import checkpoint, database, incremental, instrumentation, snapshot, util
+from scripts.pipeline import (
+    OutputExecutor,
+    global_stage_fingerprints,
+    process_scenario,
+    process_scenarios_parallel,
+    release_loaded_objects,
+    resume_point,
+    streaming_chunk_size,
 )
-from scripts.scheduling import do_scheduling
 from scripts.util import create_three_scenarios, fixup_rotations
 
 if os.path.exists("config.toml"):
@@ -32,6 +35,9 @@ if os.path.exists("config.toml"):
 else:
     raise FileNotFoundError("config.toml not found.")
 
+if config["export"]["run_id"] == "":
+    config["export"]["run_id"] = datetime.now().strftime("%Y%m%dT%H%M%S")
+
 DB_URL = util.construct_database_url(
     config["database"]["dbname"],
     config["database"]["user"],
@@ -41,37 +47,285 @@ DB_URL = util.construct_database_url(
 )
 
 
-def setup_database():
+def setup_database() -> bool:
+    """
+    Bring the database into its freshly imported state, using the fastest way available:
+
+    1. Restore the snapshot taken after `create_three_scenarios`, if enabled and valid
+    2. Keep the database as is, if it still holds an unmodified import of the dump
+    3. Restore the snapshot taken after the import, if valid
+    4. Clear the database and import the dump (and save a snapshot of the result)
+
+    :return: True if the scenarios were restored from a snapshot, so `fixup_rotations` and
+        `create_three_scenarios` must be skipped.
+    """
     logger = logging.getLogger(__name__)
 
+    dump_path = config["paths"]["input_sql"]
+    use_snapshots = config["snapshots"]["enabled"]
+    if use_snapshots:
+        fingerprint = snapshot.snapshot_fingerprint(dump_path)
+        if config["snapshots"]["after_scenarios"] and snapshot.restore_snapshot(
+            DB_URL, "scenarios", fingerprint
+        ):
+            logger.info("Database setup complete (scenarios restored from snapshot).")
+            return True
+
+    if util.imported_dump_hash(DB_URL) == util.dump_hash(dump_path):
+        logger.info(f"Database already contains an unmodified import of {dump_path}.")
+        return False
+
+    if use_snapshots and snapshot.restore_snapshot(DB_URL, "import", fingerprint):
+        logger.info("Database setup complete (restored from snapshot).")
+        return False
+
     util.clear_database(DB_URL)
-    util.import_database_dump(DB_URL, config["paths"]["input_sql"])
+    util.import_database_dump(DB_URL, dump_path, jobs=config["import"]["jobs"])
+    if use_snapshots:
+        # Creating a template requires that there are no open connections to the database
+        database.dispose_engines()
+        snapshot.save_snapshot(DB_URL, "import", fingerprint)
 
     logger.info("Database setup complete.")
+    return False
+
+
+def stage_list(value: str) -> List[str]:
+    """
+    Parse the comma-separated list of per-scenario stages given to `--stages`.
+
+    :param value: The argument, e.g. "simulation,plotting".
+    :return: The stages.
+    """
+    stages = [stage.strip() for stage in value.split(",") if stage.strip() != ""]
+    unknown = [stage for stage in stages if stage not in checkpoint.SCENARIO_STAGES]
+    if len(stages) == 0 or len(unknown) > 0:
+        raise argparse.ArgumentTypeError(
+            f"unknown stages {unknown}, choose from {checkpoint.SCENARIO_STAGES}"
+        )
+    return stages
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the eFLIPS simulation for the Kyoto dataset."
+    )
+    parser.add_argument(
+        "--force",
+        action="append",
+        default=[],
+        choices=checkpoint.GLOBAL_STAGES + checkpoint.SCENARIO_STAGES,
+        metavar="STAGE",
+        help="Rerun a stage even if it has a valid checkpoint. Can be given multiple times.",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Run the parameter sweep from the [sweep] section of config.toml instead of the regular scenarios.",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Only process the scenario with this short name, e.g. MIX. Can be given multiple times.",
+    )
+    parser.add_argument(
+        "--stages",
+        type=stage_list,
+        metavar="STAGE,...",
+        help="Only run these per-scenario stages, regardless of their checkpoints, e.g. --stages simulation,plotting. "
+        f"Available stages: {', '.join(checkpoint.SCENARIO_STAGES)}.",
+    )
+    parser.add_argument(
+        "--no-reset",
+        action="store_true",
+        help="Keep the database as it is and skip the import, fixup_rotations and create_three_scenarios. "
+        "The scenarios must have been created and committed by an earlier run.",
+    )
+    args = parser.parse_args()
+    if args.sweep and (len(args.scenario) > 0 or args.stages is not None):
+        parser.error("--sweep cannot be combined with --scenario or --stages")
+
     logging.basicConfig(level=config["logging"]["level"])
-    setup_database()
-    engine = create_engine(DB_URL)
+    logger = logging.getLogger(__name__)
+    parallel = config["pipeline"]["parallel"]
+    snapshot_scenarios = (
+        config["snapshots"]["enabled"] and config["snapshots"]["after_scenarios"]
+    )
+    use_checkpoints = config["checkpoints"]["enabled"]
+    # Partial runs commit their results, so later partial runs can continue from them
+    partial = args.no_reset or len(args.scenario) > 0 or args.stages is not None
+    overlap = config["pipeline"]["overlap_output"] and not parallel and not args.sweep
+    output_errors = {}
+
+    database.configure_engines(config)
+    engine = database.get_engine(DB_URL)
+    measurements = []
+    global_fingerprints = None
+    checkpoint_base = None
+    start = 0
+    if use_checkpoints:
+        global_fingerprints = global_stage_fingerprints(
+            snapshot.snapshot_fingerprint(config["paths"]["input_sql"])
+        )
+        checkpoint_base = global_fingerprints[-1][1]
+    if args.no_reset:
+        start = len(checkpoint.GLOBAL_STAGES)
+    elif use_checkpoints:
+        with Session(engine) as session:
+            start = resume_point(session, global_fingerprints, config, args.force)
+        if start > 0:
+            logger.info(
+                f"Resuming after checkpoint {global_fingerprints[start - 1][0]}."
+            )
+
+    if start == 0:
+        database.dispose_engines()
+        # The dump is loaded by psql or pg_restore, not through the engine
+        with instrumentation.configured_measurement(
+            "import",
+            engine,
+            measurements,
+            config,
+            config["paths"]["output_dir"],
+            count_queries=False,
+        ):
+            scenarios_restored = setup_database()
+        start = len(checkpoint.GLOBAL_STAGES) if scenarios_restored else 1
+        # Checkpoints and saved states of the old data must not survive a reset, even if checkpoints are disabled
+        with Session(engine) as session:
+            checkpoint.clear_checkpoints(session)
+            incremental.clear_prepared_states(session)
+            if use_checkpoints:
+                for stage, fingerprint in global_fingerprints[:start]:
+                    checkpoint.record_checkpoint(
+                        session, checkpoint.GLOBAL_KEY, stage, fingerprint
+                    )
+            session.commit()
+
     with Session(engine) as session:
-        fixup_rotations(session)
-        create_three_scenarios(session)
-        for scenario in session.query(Scenario):
-            if scenario.name_short == "MIX":
-                max_duration = timedelta(hours=5)
-            else:
-                max_duration = None
-            do_scheduling(scenario, session, max_duration)
-            add_empty_trips(scenario, session)
-            delete_invalid_rotations_and_trips(scenario, session)
-            fix_driving_events(scenario, session)
-            add_depot(scenario, session)
-
-            simulate_scenario(
-                scenario,
-                repetition_period=timedelta(days=1),
-                smart_charging_strategy=SmartChargingStrategy.NONE,
+        if start < len(checkpoint.GLOBAL_STAGES):
+            if start <= 1:
+                with instrumentation.configured_measurement(
+                    "fixup", engine, measurements, config, config["paths"]["output_dir"]
+                ):
+                    fixup_rotations(session, chunk_size=streaming_chunk_size(config))
+            with instrumentation.configured_measurement(
+                "clone", engine, measurements, config, config["paths"]["output_dir"]
+            ):
+                create_three_scenarios(session)
+            if streaming_chunk_size(config) is not None:
+                # The cloned objects are not needed anymore, the scenarios are processed one by one
+                release_loaded_objects(session)
+            if (
+                parallel
+                or args.sweep
+                or snapshot_scenarios
+                or use_checkpoints
+                or partial
+                or overlap
+            ):
+                # Worker processes, template databases and reruns only see committed data
+                if use_checkpoints:
+                    for stage, fingerprint in global_fingerprints[start:]:
+                        checkpoint.record_checkpoint(
+                            session, checkpoint.GLOBAL_KEY, stage, fingerprint
+                        )
+                util.invalidate_imported_dump_hash(session)
+                session.commit()
+            if snapshot_scenarios:
+                # Creating a template requires that there are no open connections to the database
+                session.close()
+                database.dispose_engines()
+                snapshot.save_snapshot(
+                    DB_URL,
+                    "scenarios",
+                    snapshot.snapshot_fingerprint(config["paths"]["input_sql"]),
+                )
+
+        if config["instrumentation"]["enabled"]:
+            instrumentation.write_run_report(
+                config["paths"]["output_dir"], checkpoint.GLOBAL_KEY, measurements
+            )
+
+        if args.sweep:
+            base_name = config["sweep"]["base_scenario"]
+            base_scenario_id = (
+                session.query(Scenario.id)
+                .filter(Scenario.name_short == base_name)
+                .one()[0]
             )
+            # Without checkpoints, the data shows whether the scenario has been simulated, as the simulation
+            # assigns a vehicle to every rotation
+            simulated = (
+                session.query(Rotation.id)
+                .filter(Rotation.scenario_id == base_scenario_id)
+                .filter(Rotation.vehicle_id.is_not(None))
+                .first()
+                is not None
+            )
+            if simulated or (base_name, "scheduling") in checkpoint.load_checkpoints(
+                session
+            ):
+                raise ValueError(
+                    f"Scenario {base_name} has already been processed. The sweep needs an unprocessed scenario, "
+                    "run it without --no-reset and with checkpoints disabled to reset the database."
+                )
+        else:
+            scenarios = session.query(Scenario).order_by(Scenario.id).all()
+            if len(args.scenario) > 0:
+                missing = set(args.scenario) - {s.name_short for s in scenarios}
+                if len(missing) > 0:
+                    raise ValueError(f"Unknown scenarios: {sorted(missing)}")
+                scenarios = [s for s in scenarios if s.name_short in args.scenario]
+            if len(scenarios) == 0:
+                raise ValueError(
+                    "The database contains no scenarios, run without --no-reset first."
+                )
+            scenario_ids = [s.id for s in scenarios]
+            if not parallel:
+                output = OutputExecutor(DB_URL, config) if overlap else None
+                try:
+                    for scenario in scenarios:
+                        process_scenario(
+                            scenario,
+                            session,
+                            config,
+                            checkpoint_base,
+                            args.force,
+                            args.stages,
+                            output,
+                        )
+                        if partial:
+                            util.invalidate_imported_dump_hash(session)
+                            session.commit()
+                finally:
+                    if output is not None:
+                        output_errors = output.wait()
+
+    if args.sweep:
+        # Imported here, as it pulls in eflips-depot and eflips-eval
+        from scripts.sweep import run_sweep
 
-            plot_results(scenario, session, config)
+        database.dispose_engines()
+        summary = run_sweep(base_scenario_id, DB_URL, config)
+        logger.info(f"Sweep results:\n{summary.to_string(index=False)}")
+        if summary["error"].notna().any():
+            sys.exit(1)
+    elif parallel:
+        database.dispose_engines()
+        results = process_scenarios_parallel(
+            scenario_ids, DB_URL, config, checkpoint_base, args.force, args.stages
+        )
+        failed = [
+            scenario_id for scenario_id, error in results.items() if error is not None
+        ]
+        if len(failed) > 0:
+            logger.error(f"{len(failed)} of {len(results)} scenarios failed: {failed}")
+            sys.exit(1)
+    elif len(output_errors) > 0:
+        logger.error(
+            f"The plotting or export of {len(output_errors)} scenarios failed: {sorted(output_errors)}"
+        )
+        sys.exit(1)
@@ -0,0 +1,200 @@
+import hashlib
+import json
+from typing import Collection, Dict, List, Tuple
+
+import sqlalchemy.orm
+from sqlalchemy import text
+
+CHECKPOINT_TABLE = "kyoto_checkpoint"
+"""A bookkeeping table holding one row per completed stage and scenario."""
+
+GLOBAL_STAGES = ["import", "fixup", "clone"]
+"""The stages that run once for the whole database."""
+
+SCENARIO_STAGES = [
+    "scheduling",
+    "empty_trips",
+    "validation",
+    "driving_events",
+    "feasibility",
+    "depot",
+    "simulation",
+    "plotting",
+    "export",
+]
+"""The stages that run once per scenario, in order."""
+
+READ_ONLY_STAGES = {"plotting", "export"}
+"""Stages that do not change the scenario, so an earlier stage can be rerun even if they are completed."""
+
+RESTORABLE_STAGES = {"depot", "simulation"}
+"""Stages whose changes are undone by restoring the state saved before them, see :mod:`scripts.incremental`."""
+
+GLOBAL_KEY = "*"
+"""The scenario key under which the global stages are recorded."""
+
+Checkpoints = Dict[Tuple[str, str], str]
+"""Maps (scenario key, stage) to the fingerprint the stage was completed with."""
+
+
+def stage_fingerprint(previous: str, stage: str, params: dict) -> str:
+    """
+    Compute the fingerprint of a stage. It includes the fingerprint of the previous stage, so changing the inputs or
+    parameters of a stage invalidates all stages after it.
+
+    :param previous: The fingerprint of the previous stage, or the input hash for the first stage.
+    :param stage: The name of the stage.
+    :param params: The parameters of the stage. Must be JSON-serializable using `str` as fallback.
+    :return: A hex digest.
+    """
+    payload = json.dumps(
+        {"previous": previous, "stage": stage, "params": params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def ensure_checkpoint_table(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Create the checkpoint table if it does not exist.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} ("
+            "scenario_key TEXT NOT NULL, "
+            "stage TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL, "
+            "completed_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+            "PRIMARY KEY (scenario_key, stage))"
+        )
+    )
+
+
+def load_checkpoints(session: sqlalchemy.orm.session.Session) -> Checkpoints:
+    """
+    Load all recorded checkpoints.
+
+    :param session: An SQLAlchemy session.
+    :return: The recorded checkpoints. Empty if the checkpoint table does not exist.
+    """
+    if (
+        session.execute(
+            text("SELECT to_regclass(:name)"), {"name": CHECKPOINT_TABLE}
+        ).scalar()
+        is None
+    ):
+        return {}
+    rows = session.execute(
+        text(f"SELECT scenario_key, stage, fingerprint FROM {CHECKPOINT_TABLE}")
+    )
+    return {(scenario_key, stage): fp for scenario_key, stage, fp in rows}
+
+
+def record_checkpoint(
+    session: sqlalchemy.orm.session.Session,
+    scenario_key: str,
+    stage: str,
+    fingerprint: str,
+) -> None:
+    """
+    Record a completed stage. This is done inside the session's transaction, so the checkpoint is only stored if the
+    stage's changes are committed along with it.
+
+    :param session: An SQLAlchemy session.
+    :param scenario_key: The short name of the scenario, or :data:`GLOBAL_KEY`.
+    :param stage: The name of the stage.
+    :param fingerprint: The fingerprint of the stage, see :func:`stage_fingerprint`.
+    :return: None
+    """
+    ensure_checkpoint_table(session)
+    session.execute(
+        text(
+            f"INSERT INTO {CHECKPOINT_TABLE} (scenario_key, stage, fingerprint) "
+            "VALUES (:scenario_key, :stage, :fingerprint) "
+            "ON CONFLICT (scenario_key, stage) "
+            "DO UPDATE SET fingerprint = EXCLUDED.fingerprint, completed_at = now()"
+        ),
+        {"scenario_key": scenario_key, "stage": stage, "fingerprint": fingerprint},
+    )
+
+
+def clear_checkpoints(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Remove all checkpoints, e.g. after the database has been reset.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.execute(text(f"DROP TABLE IF EXISTS {CHECKPOINT_TABLE}"))
+
+
+def first_stage_to_run(
+    checkpoints: Checkpoints,
+    scenario_key: str,
+    stage_fingerprints: List[Tuple[str, str]],
+    force: Collection[str] = (),
+) -> int:
+    """
+    Find the first stage of a chain that has no valid checkpoint.
+
+    :param checkpoints: The recorded checkpoints.
+    :param scenario_key: The short name of the scenario, or :data:`GLOBAL_KEY`.
+    :param stage_fingerprints: The (stage, fingerprint) pairs of the chain, in order.
+    :param force: Stages to rerun even if their checkpoint is valid.
+    :return: The index of the first stage to run, or the length of the chain if all stages are valid.
+    """
+    for i, (stage, fingerprint) in enumerate(stage_fingerprints):
+        if stage in force or checkpoints.get((scenario_key, stage)) != fingerprint:
+            return i
+    return len(stage_fingerprints)
+
+
+def needs_restore(
+    checkpoints: Checkpoints,
+    scenario_key: str,
+    stage_fingerprints: List[Tuple[str, str]],
+    start: int,
+) -> bool:
+    """
+    Check whether a stage at or after the first stage to run has already changed the data, so the chain cannot
+    simply be continued from there.
+
+    :param checkpoints: The recorded checkpoints.
+    :param scenario_key: The short name of the scenario, or :data:`GLOBAL_KEY`.
+    :param stage_fingerprints: The (stage, fingerprint) pairs of the chain, in order.
+    :param start: The index of the first stage to run, see :func:`first_stage_to_run`.
+    :return: True if a stage that changes the data has a checkpoint, valid or not, at or after `start`.
+    """
+    return any(
+        (scenario_key, stage) in checkpoints and stage not in READ_ONLY_STAGES
+        for stage, _ in stage_fingerprints[start:]
+    )
+
+
+def can_resume(
+    checkpoints: Checkpoints,
+    scenario_key: str,
+    stage_fingerprints: List[Tuple[str, str]],
+    force: Collection[str] = (),
+    restorable: bool = False,
+) -> bool:
+    """
+    Check whether a chain can be resumed in place. This is only possible if the database is still in the state
+    right before the first stage to run, i.e. no later stage that changes the data has been completed since, or if
+    that state can be restored.
+
+    :param checkpoints: The recorded checkpoints.
+    :param scenario_key: The short name of the scenario, or :data:`GLOBAL_KEY`.
+    :param stage_fingerprints: The (stage, fingerprint) pairs of the chain, in order.
+    :param force: Stages to rerun even if their checkpoint is valid.
+    :param restorable: Whether the state before the :data:`RESTORABLE_STAGES` has been saved and is still valid.
+    :return: True if the chain can be resumed at :func:`first_stage_to_run`.
+    """
+    start = first_stage_to_run(checkpoints, scenario_key, stage_fingerprints, force)
+    if not needs_restore(checkpoints, scenario_key, stage_fingerprints, start):
+        return True
+    return restorable and stage_fingerprints[start][0] in RESTORABLE_STAGES
@@ -0,0 +1,256 @@
+import logging
+import time
+from typing import Dict, List
+
+import sqlalchemy.orm
+from eflips.model import Base, Scenario
+from sqlalchemy import Table, text
+
+MAP_TABLE_PREFIX = "kyoto_clone_map_"
+"""Prefix of the temporary tables mapping the ids of the original rows to the ids of their copies, one per table."""
+
+
+def _map_table(table: Table) -> str:
+    """
+    The name of the temporary table holding the id mapping of a table.
+
+    :param table: An eflips-model table.
+    :return: The name of its mapping table.
+    """
+    return f"{MAP_TABLE_PREFIX}{table.name.lower()}"
+
+
+def _scenario_tables() -> List[Table]:
+    """
+    The tables whose rows belong to a scenario, in an order in which they can be inserted.
+
+    :return: The tables with a `scenario_id` column, except the scenario table itself.
+    """
+    return [
+        table
+        for table in Base.metadata.sorted_tables
+        if "scenario_id" in table.columns and table.name != Scenario.__tablename__
+    ]
+
+
+def _association_tables(mapped: Dict[str, str]) -> List[Table]:
+    """
+    The many-to-many association tables between scenario tables. They have no `scenario_id` column of their own, a
+    row belongs to a scenario if the rows it links do.
+
+    :param mapped: The names of the tables with an id mapping, mapped to the names of their mapping tables.
+    :return: The association tables.
+    """
+    return [
+        table
+        for table in Base.metadata.sorted_tables
+        if "scenario_id" not in table.columns
+        and len(table.foreign_keys) > 0
+        and all(
+            fk.column.table.name in mapped
+            and fk.column.table.name != Scenario.__tablename__
+            for fk in table.foreign_keys
+        )
+    ]
+
+
+def _copy_statement(table: Table, mapped: Dict[str, str]) -> str:
+    """
+    Build the INSERT ... SELECT statement copying the rows of a table for every clone. The copies take their ids from
+    the table's mapping table (or, for association tables, from the id sequence) and every foreign key is replaced by
+    the id of the copy it references, joining the mapping table of the referenced table. Nullable foreign keys stay
+    NULL.
+
+    :param table: The table to copy.
+    :param mapped: The names of the tables with an id mapping, mapped to the names of their mapping tables.
+    :return: The SQL statement.
+    """
+    has_map = table.name in mapped
+    columns, values, joins = [], [], []
+    copy_source = "own_map.copy" if has_map else None
+    if has_map:
+        joins.append(
+            f"JOIN {mapped[table.name]} AS own_map ON own_map.old_id = source.id"
+        )
+
+    for column in table.columns:
+        if column.primary_key:
+            if has_map:
+                columns.append(f'"{column.name}"')
+                values.append("own_map.new_id")
+            # Association rows get a fresh id from the column default
+            continue
+
+        columns.append(f'"{column.name}"')
+        references = [
+            fk for fk in column.foreign_keys if fk.column.table.name in mapped
+        ]
+        if len(references) == 0:
+            values.append(f'source."{column.name}"')
+            continue
+
+        alias = f"fk_{column.name}"
+        referenced = mapped[references[0].column.table.name]
+        if copy_source is None:
+            # The first foreign key of an association row decides which clone the copy belongs to
+            joins.append(
+                f'JOIN {referenced} AS {alias} ON {alias}.old_id = source."{column.name}"'
+            )
+            copy_source = f"{alias}.copy"
+        else:
+            join = "LEFT JOIN" if has_map else "JOIN"
+            joins.append(
+                f"{join} {referenced} AS {alias} "
+                f'ON {alias}.old_id = source."{column.name}" AND {alias}.copy = {copy_source}'
+            )
+        values.append(f"{alias}.new_id")
+
+    return (
+        f'INSERT INTO "{table.name}" ({", ".join(columns)}) '
+        f'SELECT {", ".join(values)} FROM "{table.name}" AS source ' + " ".join(joins)
+    )
+
+
+def clone_scenario(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session, count: int = 1
+) -> List[Scenario]:
+    """
+    Create copies of a scenario inside the database. This is equivalent to calling :meth:`Scenario.clone` `count`
+    times, but instead of loading and re-adding every object through the ORM, each table is copied with one
+    INSERT ... SELECT for all copies together, so the time grows with the number of rows and not with the number of
+    round trips, and no rows are loaded into Python.
+
+    First, every row of the scenario gets one new id per copy from its table's sequence, stored in a temporary
+    mapping table per table. Then the rows are copied table by table, replacing every foreign key by the new id
+    looked up in the mapping table of the referenced table. Association tables without a scenario column are copied
+    if all rows they link belong to the scenario.
+
+    The copies have the name, options and parent of a regular clone, and are flushed but not committed.
+
+    :param scenario: The scenario to copy. Pending changes in the session are flushed before copying.
+    :param session: An SQLAlchemy session.
+    :param count: The number of copies to create.
+    :return: The copies, in the order they were created.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+
+    clones = [
+        Scenario(
+            name=scenario.name,
+            name_short=scenario.name_short,
+            simba_options=scenario.simba_options,
+            eflips_depot_options=scenario.eflips_depot_options,
+            parent=scenario,
+        )
+        for _ in range(count)
+    ]
+    session.add_all(clones)
+    session.flush()
+
+    tables = _scenario_tables()
+    mapped = {Scenario.__tablename__: _map_table(Scenario.__table__)}
+    mapped.update({table.name: _map_table(table) for table in tables})
+    for map_table in mapped.values():
+        session.execute(
+            text(
+                f"CREATE TEMPORARY TABLE {map_table} ("
+                "copy INTEGER NOT NULL, "
+                "old_id BIGINT NOT NULL, "
+                "new_id BIGINT NOT NULL, "
+                "PRIMARY KEY (old_id, copy))"
+            )
+        )
+
+    session.execute(
+        text(
+            f"INSERT INTO {mapped[Scenario.__tablename__]} (copy, old_id, new_id) "
+            "VALUES (:copy, :old_id, :new_id)"
+        ),
+        [
+            {"copy": copy, "old_id": scenario.id, "new_id": clone.id}
+            for copy, clone in enumerate(clones)
+        ],
+    )
+    for table in tables:
+        session.execute(
+            text(
+                f"INSERT INTO {mapped[table.name]} (copy, old_id, new_id) "
+                f"SELECT copies.copy, source.id, nextval(pg_get_serial_sequence(:table, 'id')) "
+                f'FROM "{table.name}" AS source '
+                f"CROSS JOIN {mapped[Scenario.__tablename__]} AS copies "
+                "WHERE source.scenario_id = :scenario_id"
+            ),
+            {"table": f'"{table.name}"', "scenario_id": scenario.id},
+        )
+    for map_table in mapped.values():
+        session.execute(text(f"ANALYZE {map_table}"))
+
+    rows = 0
+    for table in tables + _association_tables(mapped):
+        rows += session.execute(text(_copy_statement(table, mapped))).rowcount
+
+    # After an error, the temporary tables are dropped with the rolled back transaction
+    for map_table in mapped.values():
+        session.execute(text(f"DROP TABLE {map_table}"))
+
+    logger.info(
+        f"Cloned scenario {scenario.name_short} {count} time(s) ({rows} rows) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return clones
+
+
+def delete_scenario(
+    scenario_id: int,
+    session: sqlalchemy.orm.session.Session,
+    reparent_to: int | None = None,
+) -> None:
+    """
+    Delete a scenario and all its rows inside the database, e.g. a temporary copy created by :func:`clone_scenario`.
+    Each table is emptied with one DELETE, from the association tables to the tables the others depend on.
+
+    :param scenario_id: The id of the scenario to delete.
+    :param session: An SQLAlchemy session. Pending changes are flushed first, and loaded objects of the scenario are
+        expired.
+    :param reparent_to: The new parent of the scenarios cloned from the deleted one. None leaves them without a
+        parent.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    session.flush()
+    params = {"scenario_id": scenario_id}
+
+    session.execute(
+        text(
+            f'UPDATE "{Scenario.__tablename__}" SET parent_id = :parent_id '
+            "WHERE parent_id = :scenario_id"
+        ),
+        {"parent_id": reparent_to, **params},
+    )
+    tables = _scenario_tables()
+    for table in _association_tables(
+        {table.name: _map_table(table) for table in tables}
+    ):
+        # A row belongs to the scenario if the first row it links does
+        fk = next(iter(table.foreign_keys))
+        session.execute(
+            text(
+                f'DELETE FROM "{table.name}" WHERE "{fk.parent.name}" IN '
+                f'(SELECT id FROM "{fk.column.table.name}" WHERE scenario_id = :scenario_id)'
+            ),
+            params,
+        )
+    for table in reversed(tables):
+        session.execute(
+            text(f'DELETE FROM "{table.name}" WHERE scenario_id = :scenario_id'),
+            params,
+        )
+    session.execute(
+        text(f'DELETE FROM "{Scenario.__tablename__}" WHERE id = :scenario_id'),
+        params,
+    )
+
+    # The statements above bypassed the ORM
+    session.expire_all()
+    logger.info(f"Deleted scenario {scenario_id}")
@@ -0,0 +1,117 @@
+import logging
+import os
+import time
+from typing import Dict, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+
+from scripts.instrumentation import statement_shape
+
+DEFAULT_SETTINGS = {
+    "pool_size": 5,
+    "max_overflow": 5,
+    "pool_pre_ping": True,
+    "insertmanyvalues_page_size": 1000,
+    "executemany_mode": "values_plus_batch",
+    "executemany_batch_page_size": 500,
+    "server_side_cursors": False,
+    "slow_statement_ms": 0,
+}
+"""The settings used for keys missing from the `[engine]` section of config.toml."""
+
+_settings: Dict = dict(DEFAULT_SETTINGS)
+_engines: Dict[Tuple[str, int], Engine] = {}
+
+
+def configure_engines(config: dict) -> None:
+    """
+    Set up the engine settings from the `[engine]` section of config.toml. Must be called in every process before
+    its first call to :func:`get_engine`, as engines are not shared between processes. Engines created before are
+    disposed of and replaced on their next use.
+
+    :param config: The parsed contents of config.toml.
+    :return: None
+    """
+    dispose_engines()
+    _engines.clear()
+    _settings.clear()
+    _settings.update(DEFAULT_SETTINGS)
+    _settings.update(config.get("engine", {}))
+
+
+def _log_slow_statements(engine: Engine, threshold_ms: float) -> None:
+    """
+    Log every statement executed through an engine that takes longer than a threshold, together with its duration.
+
+    :param engine: The engine to watch.
+    :param threshold_ms: The threshold in milliseconds.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, so a failing statement leaves nothing behind
+        if context is not None:
+            context._kyoto_statement_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_kyoto_statement_start", None)
+        if start is None:
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms > threshold_ms:
+            logger.warning(
+                f"Statement took {duration_ms:.0f} ms: {statement_shape(statement)[:300]}"
+            )
+
+
+def get_engine(database_url: str) -> Engine:
+    """
+    Get the engine for a database, creating it on first use with the settings from :func:`configure_engines`. All
+    stages of a process share this engine and its connection pool.
+
+    The engine batches the rows of bulk INSERTs into multi-row statements of `insertmanyvalues_page_size` rows and,
+    with psycopg2 and `executemany_mode = "values_plus_batch"`, sends bulk UPDATEs in pages of
+    `executemany_batch_page_size` statements instead of one round trip per row. With `server_side_cursors`, all
+    SELECTs stream their rows from a server-side cursor. With a positive `slow_statement_ms`, slower statements are
+    logged.
+
+    :param database_url: The database URL to connect to.
+    :return: The engine. Do not dispose of it directly, use :func:`dispose_engines`.
+    """
+    key = (database_url, os.getpid())
+    if key not in _engines:
+        arguments = dict(
+            pool_size=_settings["pool_size"],
+            max_overflow=_settings["max_overflow"],
+            pool_pre_ping=_settings["pool_pre_ping"],
+            insertmanyvalues_page_size=_settings["insertmanyvalues_page_size"],
+        )
+        if make_url(database_url).get_dialect().driver == "psycopg2":
+            # Only psycopg2 needs to be told to batch executemany(), psycopg 3 pipelines it by itself
+            arguments.update(
+                executemany_mode=_settings["executemany_mode"],
+                executemany_batch_page_size=_settings["executemany_batch_page_size"],
+            )
+        engine = create_engine(database_url, **arguments)
+        if _settings["server_side_cursors"]:
+            engine = engine.execution_options(stream_results=True)
+        if _settings["slow_statement_ms"] > 0:
+            _log_slow_statements(engine, _settings["slow_statement_ms"])
+        _engines[key] = engine
+    return _engines[key]
+
+
+def dispose_engines() -> None:
+    """
+    Close all pooled connections of this process's engines, e.g. before a database is dropped or used as a template.
+    The engines stay usable and open new connections when needed.
+
+    :return: None
+    """
+    for (_, pid), engine in _engines.items():
+        if pid == os.getpid():
+            engine.dispose()
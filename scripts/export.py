@@ -0,0 +1,247 @@
+import logging
+import os
+import time
+from typing import Dict
+from zoneinfo import ZoneInfo
+
+import eflips.eval.output.prepare
+import pandas as pd
+import sqlalchemy.orm
+from eflips.model import (
+    Area,
+    Depot,
+    Event,
+    EventType,
+    Rotation,
+    Route,
+    Scenario,
+    Trip,
+    TripType,
+)
+from sqlalchemy import case, func, select
+
+from scripts.plot import load_vehicle_socs
+
+SCHEMAS: Dict[str, Dict[str, str]] = {
+    "events": {
+        "event_id": "int64",
+        "vehicle_id": "Int64",
+        "vehicle_type_id": "int64",
+        "trip_id": "Int64",
+        "station_id": "Int64",
+        "area_id": "Int64",
+        "subloc_no": "Int64",
+        "event_type": "string",
+        "time_start": "datetime64[us, UTC]",
+        "time_end": "datetime64[us, UTC]",
+        "soc_start": "float64",
+        "soc_end": "float64",
+    },
+    "vehicle_soc": {
+        "vehicle_id": "int64",
+        "time": "datetime64[us, UTC]",
+        "soc": "float64",
+    },
+    "depot_power": {
+        "depot_id": "int64",
+        "time": "datetime64[us, UTC]",
+        "power": "float64",
+        "occupancy": "float64",
+    },
+    "rotations": {
+        "rotation_id": "int64",
+        "rotation_name": "string",
+        "vehicle_id": "Int64",
+        "vehicle_type_id": "int64",
+        "trip_count": "int64",
+        "passenger_trip_count": "int64",
+        "distance": "float64",
+        "time_start": "datetime64[us, UTC]",
+        "time_end": "datetime64[us, UTC]",
+        "soc_min": "float64",
+    },
+}
+"""The columns of each exported table and their pandas dtypes. Every table additionally starts with the columns
+"run_id", "scenario_id" and "scenario"."""
+
+
+def _events(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> pd.DataFrame:
+    """
+    :param scenario: The scenario to export.
+    :param session: An SQLAlchemy session.
+    :return: All events of the scenario, one row per event.
+    """
+    rows = session.execute(
+        select(
+            Event.id,
+            Event.vehicle_id,
+            Event.vehicle_type_id,
+            Event.trip_id,
+            Event.station_id,
+            Event.area_id,
+            Event.subloc_no,
+            Event.event_type,
+            Event.time_start,
+            Event.time_end,
+            Event.soc_start,
+            Event.soc_end,
+        )
+        .filter(Event.scenario_id == scenario.id)
+        .order_by(Event.id)
+    ).all()
+    df = pd.DataFrame(rows, columns=list(SCHEMAS["events"]))
+    df["event_type"] = df["event_type"].map(lambda event_type: event_type.name)
+    return df
+
+
+def _vehicle_soc(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> pd.DataFrame:
+    """
+    :param scenario: The scenario to export.
+    :param session: An SQLAlchemy session.
+    :return: The SoC time series of all vehicles, one row per point in time and vehicle.
+    """
+    frames = [
+        df.assign(vehicle_id=vehicle_id)
+        for vehicle_id, (df, _) in load_vehicle_socs(
+            scenario, session, timezone=ZoneInfo("UTC")
+        ).items()
+    ]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=list(SCHEMAS["vehicle_soc"]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _depot_power(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> pd.DataFrame:
+    """
+    :param scenario: The scenario to export.
+    :param session: An SQLAlchemy session.
+    :return: The power and occupancy time series of each depot, summed over its areas.
+    """
+    area_ids_by_depot: Dict[int, list] = {}
+    for depot_id, area_id in session.execute(
+        select(Depot.id, Area.id)
+        .join(Area, Area.depot_id == Depot.id)
+        .filter(Depot.scenario_id == scenario.id)
+        .filter(
+            Area.id.in_(select(Event.area_id).filter(Event.scenario_id == scenario.id))
+        )
+    ):
+        area_ids_by_depot.setdefault(depot_id, []).append(area_id)
+
+    frames = [
+        eflips.eval.output.prepare.power_and_occupancy(area_ids, session).assign(
+            depot_id=depot_id
+        )
+        for depot_id, area_ids in area_ids_by_depot.items()
+    ]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=list(SCHEMAS["depot_power"]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _rotations(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> pd.DataFrame:
+    """
+    :param scenario: The scenario to export.
+    :param session: An SQLAlchemy session.
+    :return: One row per rotation, with its trips, distance, time span and lowest SoC aggregated in the database.
+    """
+    lowest_soc = (
+        select(Trip.rotation_id, func.min(Event.soc_end).label("soc_min"))
+        .join(Event, Event.trip_id == Trip.id)
+        .filter(Trip.scenario_id == scenario.id)
+        .filter(Event.event_type == EventType.DRIVING)
+        .group_by(Trip.rotation_id)
+        .subquery()
+    )
+    rows = session.execute(
+        select(
+            Rotation.id,
+            Rotation.name,
+            Rotation.vehicle_id,
+            Rotation.vehicle_type_id,
+            func.count(Trip.id),
+            func.count(case((Trip.trip_type == TripType.PASSENGER, Trip.id))),
+            func.sum(Route.distance),
+            func.min(Trip.departure_time),
+            func.max(Trip.arrival_time),
+            func.min(lowest_soc.c.soc_min),
+        )
+        .join(Trip, Trip.rotation_id == Rotation.id)
+        .join(Route, Trip.route_id == Route.id)
+        .outerjoin(lowest_soc, lowest_soc.c.rotation_id == Rotation.id)
+        .filter(Rotation.scenario_id == scenario.id)
+        .group_by(Rotation.id)
+        .order_by(Rotation.id)
+    ).all()
+    return pd.DataFrame(rows, columns=list(SCHEMAS["rotations"]))
+
+
+def _conform(df: pd.DataFrame, schema: Dict[str, str]) -> pd.DataFrame:
+    """
+    Bring a dataframe into the column order and types of an export schema.
+
+    :param df: The dataframe to convert. It may have additional columns, which are dropped.
+    :param schema: The column names and pandas dtypes, see :data:`SCHEMAS`.
+    :return: The converted dataframe. Time columns are converted to UTC, naive times are assumed to be in UTC.
+    """
+    df = df[list(schema)].copy()
+    for column, dtype in schema.items():
+        if dtype.startswith("datetime64"):
+            df[column] = pd.to_datetime(df[column], utc=True)
+    return df.astype(schema)
+
+
+def export_results(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session, config: dict
+) -> None:
+    """
+    Export the simulation results of a scenario to Parquet files, for analysis across scenarios and runs with e.g.
+    pandas or DuckDB (`SELECT * FROM 'export/events/*/*.parquet'`).
+
+    Each table in :data:`SCHEMAS` is written to `<export_dir>/<table>/<scenario>/<run_id>.parquet`. The data is read
+    with a few column-wise queries, not through ORM objects. Requires pyarrow.
+
+    :param scenario: The simulated scenario.
+    :param session: An SQLAlchemy session.
+    :param config: The parsed contents of config.toml. `export.run_id` identifies the run.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    run_id = config["export"]["run_id"]
+    loaders = {
+        "events": _events,
+        "vehicle_soc": _vehicle_soc,
+        "depot_power": _depot_power,
+        "rotations": _rotations,
+    }
+    for table, load in loaders.items():
+        start = time.perf_counter()
+        df = _conform(load(scenario, session), SCHEMAS[table])
+        df.insert(0, "scenario", scenario.name_short)
+        df.insert(0, "scenario_id", scenario.id)
+        df.insert(0, "run_id", run_id)
+        df = df.astype(
+            {"run_id": "string", "scenario_id": "int64", "scenario": "string"}
+        )
+
+        directory = os.path.join(
+            config["export"]["export_dir"], table, scenario.name_short
+        )
+        os.makedirs(directory, exist_ok=True)
+        df.to_parquet(
+            os.path.join(directory, f"{run_id}.parquet"),
+            index=False,
+            engine="pyarrow",
+        )
+        logger.info(
+            f"Exported {len(df)} rows of {table} for scenario {scenario.name_short} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
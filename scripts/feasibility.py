@@ -0,0 +1,461 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+import numpy as np
+import sqlalchemy.orm
+from eflips.model import (
+    Event,
+    EventType,
+    Rotation,
+    Route,
+    Scenario,
+    Trip,
+    TripType,
+    Vehicle,
+)
+from sqlalchemy import insert, select, update
+
+EPSILON = 1e-9
+"""Tolerance when comparing SoC values, so a rotation ending exactly at the minimum SoC counts as feasible."""
+
+
+@dataclass
+class FeasibilityReport:
+    """
+    What :func:`check_energy_feasibility` found in a scenario, and which rotations it split.
+    """
+
+    rotations: int = 0
+    trips: int = 0
+
+    lowest_soc: Dict[int, float] = field(default_factory=dict)
+    """The lowest SoC reached by each infeasible rotation, starting with a full battery."""
+
+    split_rotation_ids: List[int] = field(default_factory=list)
+    """Infeasible rotations that were split into several rotations."""
+
+    new_rotation_ids: List[int] = field(default_factory=list)
+    """The rotations created by splitting."""
+
+    unsplittable_rotation_ids: List[int] = field(default_factory=list)
+    """Split rotations with a part that is still infeasible, as it has no stop at the terminal in between."""
+
+
+@dataclass
+class _Trips:
+    """
+    The trips of a scenario with their driving events, as one NumPy array per column. The trips of each rotation are
+    consecutive and ordered by departure time.
+    """
+
+    rotation_id: np.ndarray
+    trip_id: np.ndarray
+    route_id: np.ndarray
+    departure_station_id: np.ndarray
+    arrival_station_id: np.ndarray
+    distance: np.ndarray
+    departure_time: np.ndarray
+    arrival_time: np.ndarray
+    event_id: np.ndarray
+    soc_delta: np.ndarray
+
+
+def _load_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session) -> _Trips:
+    """
+    Load the trips of a scenario with a single query.
+
+    :param scenario: The scenario to load the trips of. Every trip needs a driving event.
+    :param session: An SQLAlchemy session.
+    :return: The trips as a :class:`_Trips`.
+    """
+    rows = session.execute(
+        select(
+            Trip.rotation_id,
+            Trip.id,
+            Trip.route_id,
+            Route.departure_station_id,
+            Route.arrival_station_id,
+            Route.distance,
+            Trip.departure_time,
+            Trip.arrival_time,
+            Event.id,
+            Event.soc_start - Event.soc_end,
+        )
+        .join(Route, Trip.route_id == Route.id)
+        .join(
+            Event,
+            (Event.trip_id == Trip.id) & (Event.event_type == EventType.DRIVING),
+        )
+        .filter(Trip.scenario_id == scenario.id)
+        .order_by(Trip.rotation_id, Trip.departure_time)
+    ).all()
+    columns = list(zip(*rows)) if len(rows) > 0 else [()] * 10
+    return _Trips(
+        rotation_id=np.array(columns[0], dtype=np.int64),
+        trip_id=np.array(columns[1], dtype=np.int64),
+        route_id=np.array(columns[2], dtype=np.int64),
+        departure_station_id=np.array(columns[3], dtype=np.int64),
+        arrival_station_id=np.array(columns[4], dtype=np.int64),
+        distance=np.array(columns[5], dtype=np.float64),
+        departure_time=np.array(columns[6], dtype=object),
+        arrival_time=np.array(columns[7], dtype=object),
+        event_id=np.array(columns[8], dtype=np.int64),
+        soc_delta=np.array(columns[9], dtype=np.float64),
+    )
+
+
+def chain_socs(
+    rotation_ids: np.ndarray, soc_deltas: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Chain the SoC over the trips of all rotations at once, with each rotation starting with a full battery. This is
+    the same chaining :func:`scripts.prepare.fix_driving_events` does trip by trip, as a segmented cumulative sum.
+
+    :param rotation_ids: The rotation of each trip. The trips of a rotation must be consecutive and in order.
+    :param soc_deltas: The SoC used by each trip.
+    :return: The index of the first trip of each rotation, and the SoC at the end of each trip.
+    """
+    if len(rotation_ids) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, rotation_ids[1:] != rotation_ids[:-1]])
+    used = np.cumsum(soc_deltas)
+    used_before_rotation = np.repeat(
+        used[starts] - soc_deltas[starts], np.diff(np.r_[starts, len(soc_deltas)])
+    )
+    return starts, 1 - (used - used_before_rotation)
+
+
+def _plan_split(
+    soc_deltas: np.ndarray,
+    splittable: np.ndarray,
+    empty_trip_deltas: float,
+    budget: float,
+) -> Tuple[List[int], bool]:
+    """
+    Greedily split the passenger trips of a rotation into as few parts as possible, each of which can be driven on
+    one charge together with an empty trip from and to the depot.
+
+    :param soc_deltas: The SoC used by each passenger trip.
+    :param splittable: For each passenger trip, whether the rotation may be split after it.
+    :param empty_trip_deltas: The SoC used by the empty trips from and to the depot together.
+    :param budget: The usable SoC range.
+    :return: The indices of the trips starting a new part, and whether all parts are feasible.
+    """
+    used = np.r_[
+        0, np.cumsum(soc_deltas)
+    ]  # used[i] is the SoC used by the trips before trip i
+    candidates = np.flatnonzero(splittable[:-1]) + 1
+    part_starts = []
+    feasible = True
+    start = 0
+    while used[-1] - used[start] + empty_trip_deltas > budget + EPSILON:
+        later = candidates[candidates > start]
+        if len(later) == 0:
+            feasible = False
+            break
+        fitting = later[
+            used[later] - used[start] + empty_trip_deltas <= budget + EPSILON
+        ]
+        if len(fitting) == 0:
+            # Even the first part ending at the terminal is infeasible, keep it as short as possible
+            feasible = False
+            start = int(later[0])
+        else:
+            start = int(fitting[-1])
+        part_starts.append(start)
+    return part_starts, feasible
+
+
+def _split_rotations(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    trips: _Trips,
+    starts: np.ndarray,
+    infeasible: np.ndarray,
+    budget: float,
+    report: FeasibilityReport,
+) -> None:
+    """
+    Split infeasible rotations at the terminal into rotations that each start and end at the depot, with a vehicle
+    of their own. The empty trips of the new rotations take the routes, durations, breaks and energy use of the
+    original rotation's empty trips. The SoC of all trips of the split rotations is chained again. All rows are
+    written with bulk statements.
+
+    :param scenario: The scenario containing the rotations.
+    :param session: An SQLAlchemy session.
+    :param trips: The trips of the scenario, as loaded by :func:`_load_trips`.
+    :param starts: The index of the first trip of each rotation, see :func:`chain_socs`.
+    :param infeasible: The positions of the infeasible rotations in `starts`.
+    :param budget: The usable SoC range.
+    :param report: The report to add the split and new rotations to.
+    :return: None
+    """
+    ends = np.r_[starts[1:], len(trips.trip_id)]
+    rotation_ids = [int(trips.rotation_id[starts[i]]) for i in infeasible]
+    originals = {
+        rotation_id: (vehicle_type_id, allow_opportunity_charging)
+        for rotation_id, vehicle_type_id, allow_opportunity_charging in session.execute(
+            select(
+                Rotation.id,
+                Rotation.vehicle_type_id,
+                Rotation.allow_opportunity_charging,
+            ).filter(Rotation.id.in_(rotation_ids))
+        )
+    }
+
+    # Plan the parts of each rotation as lists of trip indices, with None marking a new empty trip
+    plans = []
+    for i, rotation_id in zip(infeasible, rotation_ids):
+        first, last = int(starts[i]), int(ends[i]) - 1
+        if last - first < 3:
+            # A single passenger trip cannot be split
+            report.unsplittable_rotation_ids.append(rotation_id)
+            continue
+        passenger = np.arange(first + 1, last)
+        part_starts, feasible = _plan_split(
+            trips.soc_delta[passenger],
+            trips.arrival_station_id[passenger] == trips.departure_station_id[last],
+            trips.soc_delta[first] + trips.soc_delta[last],
+            budget,
+        )
+        if not feasible:
+            report.unsplittable_rotation_ids.append(rotation_id)
+        if len(part_starts) == 0:
+            continue
+        bounds = [0] + part_starts + [len(passenger)]
+        parts = [
+            [first if j == 0 else None]
+            + list(passenger[bounds[j] : bounds[j + 1]])
+            + [last if j == len(bounds) - 2 else None]
+            for j in range(len(bounds) - 1)
+        ]
+        plans.append((rotation_id, first, last, parts))
+        report.split_rotation_ids.append(rotation_id)
+    if len(plans) == 0:
+        return
+
+    new_rotation_rows = [
+        dict(
+            scenario_id=scenario.id,
+            vehicle_type_id=originals[rotation_id][0],
+            allow_opportunity_charging=originals[rotation_id][1],
+            name=f"Part {j + 1} of rotation {rotation_id}",
+        )
+        for rotation_id, _, _, parts in plans
+        for j in range(1, len(parts))
+    ]
+    new_rotation_ids = iter(
+        session.scalars(
+            insert(Rotation).returning(Rotation.id, sort_by_parameter_order=True),
+            new_rotation_rows,
+        ).all()
+    )
+    part_rotation_ids = [
+        [rotation_id] + [next(new_rotation_ids) for _ in parts[1:]]
+        for rotation_id, _, _, parts in plans
+    ]
+    report.new_rotation_ids = [
+        rotation_id for ids in part_rotation_ids for rotation_id in ids[1:]
+    ]
+
+    # Like fix_driving_events, every rotation gets a vehicle of its own
+    vehicle_ids = session.scalars(
+        insert(Vehicle).returning(Vehicle.id, sort_by_parameter_order=True),
+        [
+            dict(
+                scenario_id=scenario.id,
+                name=f"Auto-Generated Vehicle for Rotation {rotation_id}",
+                name_short=f"V_{rotation_id}",
+                vehicle_type_id=row["vehicle_type_id"],
+            )
+            for rotation_id, row in zip(report.new_rotation_ids, new_rotation_rows)
+        ],
+    ).all()
+    vehicle_id_by_rotation = dict(zip(report.new_rotation_ids, vehicle_ids))
+    session.execute(
+        update(Rotation),
+        [
+            dict(id=rotation_id, vehicle_id=vehicle_id)
+            for rotation_id, vehicle_id in vehicle_id_by_rotation.items()
+        ],
+    )
+    vehicle_id_by_rotation.update(
+        session.execute(
+            select(Rotation.id, Rotation.vehicle_id).filter(
+                Rotation.id.in_(report.split_rotation_ids)
+            )
+        ).all()
+    )
+
+    vehicle_type_id_by_rotation = {
+        rotation_id: vehicle_type_id
+        for rotation_id, (vehicle_type_id, _) in originals.items()
+    }
+    moved_trips = []
+    updated_events = []
+    new_trips = []  # The rows of the new empty trips
+    new_events = []  # The rows of their driving events, without the trip id
+    for (rotation_id, first, last, parts), ids in zip(plans, part_rotation_ids):
+        break_before = trips.departure_time[first + 1] - trips.arrival_time[first]
+        break_after = trips.departure_time[last] - trips.arrival_time[last - 1]
+        for part, part_rotation_id in zip(parts, ids):
+            # The new empty trips are the negative entries -1, -2, ... of new_trips
+            if part[0] is None:
+                arrival = trips.departure_time[part[1]] - break_before
+                new_trips.append(
+                    dict(
+                        route_id=int(trips.route_id[first]),
+                        departure_time=arrival
+                        - (trips.arrival_time[first] - trips.departure_time[first]),
+                        arrival_time=arrival,
+                        soc_delta=float(trips.soc_delta[first]),
+                    )
+                )
+                part[0] = -len(new_trips)
+            if part[-1] is None:
+                departure = trips.arrival_time[part[-2]] + break_after
+                new_trips.append(
+                    dict(
+                        route_id=int(trips.route_id[last]),
+                        departure_time=departure,
+                        arrival_time=departure
+                        + (trips.arrival_time[last] - trips.departure_time[last]),
+                        soc_delta=float(trips.soc_delta[last]),
+                    )
+                )
+                part[-1] = -len(new_trips)
+
+            vehicle_id = vehicle_id_by_rotation[part_rotation_id]
+            deltas = np.array(
+                [
+                    new_trips[-t - 1]["soc_delta"] if t < 0 else trips.soc_delta[t]
+                    for t in part
+                ]
+            )
+            soc_end = 1 - np.cumsum(deltas)
+            soc_start = np.r_[1, soc_end[:-1]]
+            for t, start_soc, end_soc in zip(part, soc_start, soc_end):
+                if t < 0:
+                    new_trips[-t - 1].update(rotation_id=part_rotation_id)
+                    new_events.append(
+                        dict(
+                            scenario_id=scenario.id,
+                            event_type=EventType.DRIVING,
+                            vehicle_id=vehicle_id,
+                            vehicle_type_id=vehicle_type_id_by_rotation[rotation_id],
+                            time_start=new_trips[-t - 1]["departure_time"],
+                            time_end=new_trips[-t - 1]["arrival_time"],
+                            soc_start=float(start_soc),
+                            soc_end=float(end_soc),
+                        )
+                    )
+                    continue
+                if part_rotation_id != rotation_id:
+                    moved_trips.append(
+                        dict(id=int(trips.trip_id[t]), rotation_id=part_rotation_id)
+                    )
+                updated_events.append(
+                    dict(
+                        id=int(trips.event_id[t]),
+                        vehicle_id=vehicle_id,
+                        soc_start=float(start_soc),
+                        soc_end=float(end_soc),
+                    )
+                )
+
+    if len(moved_trips) > 0:
+        session.execute(update(Trip), moved_trips)
+    new_trip_ids = session.scalars(
+        insert(Trip).returning(Trip.id, sort_by_parameter_order=True),
+        [
+            dict(
+                scenario_id=scenario.id,
+                route_id=trip["route_id"],
+                rotation_id=trip["rotation_id"],
+                departure_time=trip["departure_time"],
+                arrival_time=trip["arrival_time"],
+                trip_type=TripType.EMPTY,
+                loaded_mass=0,
+            )
+            for trip in new_trips
+        ],
+    ).all()
+    session.execute(
+        insert(Event),
+        [
+            dict(event, trip_id=trip_id)
+            for event, trip_id in zip(new_events, new_trip_ids)
+        ],
+    )
+    session.execute(update(Event), updated_events)
+
+    # The statements above bypassed the ORM, so loaded rotations, trips and events are now stale
+    session.expire_all()
+
+
+def check_energy_feasibility(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    min_soc: float = 0.0,
+    split: bool = False,
+) -> FeasibilityReport:
+    """
+    Find the rotations that cannot be driven on one charge before running the (much slower) depot simulation.
+
+    The driving events of all trips are loaded with one query into NumPy arrays, and the SoC over each rotation is
+    chained with a segmented cumulative sum, starting with a full battery. A rotation is infeasible if its SoC drops
+    below `min_soc`. With `split`, infeasible rotations are split at the terminal into as few rotations as possible,
+    each with its own empty trips to and from the depot and its own vehicle. Must run after
+    :func:`scripts.prepare.fix_driving_events`.
+
+    :param scenario: The scenario to check.
+    :param session: An SQLAlchemy session.
+    :param min_soc: The lowest SoC a rotation may reach.
+    :param split: Whether to split the infeasible rotations.
+    :return: A :class:`FeasibilityReport`.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+    report = FeasibilityReport()
+
+    trips = _load_trips(scenario, session)
+    starts, soc_end = chain_socs(trips.rotation_id, trips.soc_delta)
+    report.rotations = len(starts)
+    report.trips = len(trips.trip_id)
+    if report.trips == 0:
+        return report
+
+    lowest_soc = np.minimum.reduceat(soc_end, starts)
+    infeasible = np.flatnonzero(lowest_soc < min_soc - EPSILON)
+    report.lowest_soc = {
+        int(trips.rotation_id[starts[i]]): float(lowest_soc[i]) for i in infeasible
+    }
+    logger.info(
+        f"Checked {report.rotations} rotations with {report.trips} trips in "
+        f"{time.perf_counter() - start:.3f}s, {len(infeasible)} drop below an SoC of {min_soc}"
+    )
+    if len(infeasible) == 0:
+        return report
+
+    distances = np.add.reduceat(trips.distance, starts) / 1000
+    for i in infeasible[np.argsort(lowest_soc[infeasible])][:10]:
+        logger.warning(
+            f"Rotation {trips.rotation_id[starts[i]]} ({distances[i]:.1f} km) reaches an SoC of "
+            f"{lowest_soc[i]:.2f}"
+        )
+
+    if split:
+        _split_rotations(
+            scenario, session, trips, starts, infeasible, 1 - min_soc, report
+        )
+        logger.info(
+            f"Split {len(report.split_rotation_ids)} rotations into "
+            f"{len(report.split_rotation_ids) + len(report.new_rotation_ids)}"
+        )
+        if len(report.unsplittable_rotation_ids) > 0:
+            logger.warning(
+                f"Rotations {report.unsplittable_rotation_ids} remain infeasible after splitting"
+            )
+    return report
@@ -0,0 +1,225 @@
+import logging
+from typing import Dict
+
+import sqlalchemy.orm
+from eflips.model import Event, Rotation, Scenario, Vehicle
+from sqlalchemy import delete, text, update
+
+from scripts.prepare import remove_depot
+
+PREPARED_STAGE = "feasibility"
+"""The stage after which the state of a scenario is saved. The stages after it can be rerun by restoring that state."""
+
+PREPARED_STATE_TABLE = "kyoto_prepared_state"
+"""A bookkeeping table holding one row per scenario with a saved state, with the fingerprint it was saved at."""
+
+PREPARED_EVENT_TABLE = "kyoto_prepared_event"
+PREPARED_VEHICLE_TABLE = "kyoto_prepared_vehicle"
+PREPARED_ROTATION_TABLE = "kyoto_prepared_rotation"
+
+
+def _ensure_prepared_tables(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Create the tables holding the saved states if they do not exist. The event and vehicle copies have the columns of
+    the eflips-model tables, so rows can be copied back and forth with `SELECT *`.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {PREPARED_STATE_TABLE} ("
+            "scenario_id BIGINT PRIMARY KEY, "
+            "fingerprint TEXT NOT NULL, "
+            "saved_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        )
+    )
+    for table, source in [
+        (PREPARED_EVENT_TABLE, Event.__tablename__),
+        (PREPARED_VEHICLE_TABLE, Vehicle.__tablename__),
+    ]:
+        session.execute(text(f'CREATE TABLE IF NOT EXISTS {table} (LIKE "{source}")'))
+        session.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {table}_scenario ON {table} (scenario_id)"
+            )
+        )
+    session.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {PREPARED_ROTATION_TABLE} ("
+            "id BIGINT PRIMARY KEY, "
+            "scenario_id BIGINT NOT NULL, "
+            "vehicle_id BIGINT)"
+        )
+    )
+
+
+def load_prepared_states(session: sqlalchemy.orm.session.Session) -> Dict[int, str]:
+    """
+    Load the fingerprints of all saved states.
+
+    :param session: An SQLAlchemy session.
+    :return: A dictionary mapping scenario ids to the fingerprint of :data:`PREPARED_STAGE` their state was saved
+        with. Empty if no state has been saved.
+    """
+    if (
+        session.execute(
+            text("SELECT to_regclass(:name)"), {"name": PREPARED_STATE_TABLE}
+        ).scalar()
+        is None
+    ):
+        return {}
+    rows = session.execute(
+        text(f"SELECT scenario_id, fingerprint FROM {PREPARED_STATE_TABLE}")
+    )
+    return {scenario_id: fp for scenario_id, fp in rows}
+
+
+def _delete_prepared_state(
+    session: sqlalchemy.orm.session.Session, scenario_id: int
+) -> None:
+    """
+    Delete the saved state of a scenario, if there is one.
+
+    :param session: An SQLAlchemy session.
+    :param scenario_id: The id of the scenario.
+    :return: None
+    """
+    for table in [
+        PREPARED_STATE_TABLE,
+        PREPARED_EVENT_TABLE,
+        PREPARED_VEHICLE_TABLE,
+        PREPARED_ROTATION_TABLE,
+    ]:
+        session.execute(
+            text(f"DELETE FROM {table} WHERE scenario_id = :scenario_id"),
+            {"scenario_id": scenario_id},
+        )
+
+
+def save_prepared_state(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session, fingerprint: str
+) -> None:
+    """
+    Save the events, vehicles and vehicle assignments of a scenario after :data:`PREPARED_STAGE`. These are the rows
+    that the depot and simulation stages change (besides the depot itself), so restoring them with
+    :func:`restore_prepared_state` allows rerunning those stages with different parameters without repeating the
+    scheduling and preparation.
+
+    Like a checkpoint, the state is saved inside the session's transaction, and replaces an earlier state of the
+    scenario.
+
+    :param scenario: The prepared scenario.
+    :param session: An SQLAlchemy session.
+    :param fingerprint: The fingerprint of :data:`PREPARED_STAGE`, see :func:`checkpoint.stage_fingerprint`.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    session.flush()
+    _ensure_prepared_tables(session)
+    _delete_prepared_state(session, scenario.id)
+
+    params = {"scenario_id": scenario.id}
+    events = session.execute(
+        text(
+            f'INSERT INTO {PREPARED_EVENT_TABLE} SELECT * FROM "{Event.__tablename__}" '
+            "WHERE scenario_id = :scenario_id"
+        ),
+        params,
+    ).rowcount
+    session.execute(
+        text(
+            f'INSERT INTO {PREPARED_VEHICLE_TABLE} SELECT * FROM "{Vehicle.__tablename__}" '
+            "WHERE scenario_id = :scenario_id"
+        ),
+        params,
+    )
+    session.execute(
+        text(
+            f"INSERT INTO {PREPARED_ROTATION_TABLE} (id, scenario_id, vehicle_id) "
+            f'SELECT id, scenario_id, vehicle_id FROM "{Rotation.__tablename__}" '
+            "WHERE scenario_id = :scenario_id"
+        ),
+        params,
+    )
+    session.execute(
+        text(
+            f"INSERT INTO {PREPARED_STATE_TABLE} (scenario_id, fingerprint) "
+            "VALUES (:scenario_id, :fingerprint)"
+        ),
+        {"scenario_id": scenario.id, "fingerprint": fingerprint},
+    )
+    logger.info(
+        f"Saved the prepared state of scenario {scenario.name_short} ({events} events)"
+    )
+
+
+def restore_prepared_state(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> None:
+    """
+    Bring a scenario back to the state saved by :func:`save_prepared_state`: remove the depot and all events, and
+    replace the vehicles, the vehicle assignments of the rotations and the events with their saved copies. Each table
+    is changed with a single statement, so this takes seconds even for large scenarios.
+
+    :param scenario: The scenario to restore. Its state must have been saved.
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    session.flush()
+    params = {"scenario_id": scenario.id}
+
+    session.execute(
+        update(Rotation)
+        .where(Rotation.scenario_id == scenario.id)
+        .values(vehicle_id=None)
+    )
+    session.execute(delete(Event).where(Event.scenario_id == scenario.id))
+    remove_depot(scenario, session)
+    session.execute(delete(Vehicle).where(Vehicle.scenario_id == scenario.id))
+
+    session.execute(
+        text(
+            f'INSERT INTO "{Vehicle.__tablename__}" SELECT * FROM {PREPARED_VEHICLE_TABLE} '
+            "WHERE scenario_id = :scenario_id"
+        ),
+        params,
+    )
+    session.execute(
+        text(
+            f'UPDATE "{Rotation.__tablename__}" AS rotation SET vehicle_id = saved.vehicle_id '
+            f"FROM {PREPARED_ROTATION_TABLE} AS saved "
+            "WHERE rotation.id = saved.id AND saved.scenario_id = :scenario_id"
+        ),
+        params,
+    )
+    events = session.execute(
+        text(
+            f'INSERT INTO "{Event.__tablename__}" SELECT * FROM {PREPARED_EVENT_TABLE} '
+            "WHERE scenario_id = :scenario_id"
+        ),
+        params,
+    ).rowcount
+
+    # The statements above bypassed the ORM
+    session.expire_all()
+    logger.info(
+        f"Restored the prepared state of scenario {scenario.name_short} ({events} events)"
+    )
+
+
+def clear_prepared_states(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Remove all saved states, e.g. after the database has been reset.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    for table in [
+        PREPARED_STATE_TABLE,
+        PREPARED_EVENT_TABLE,
+        PREPARED_VEHICLE_TABLE,
+        PREPARED_ROTATION_TABLE,
+    ]:
+        session.execute(text(f"DROP TABLE IF EXISTS {table}"))
@@ -0,0 +1,367 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import resource
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.interfaces import ExecuteStyle
+
+RUN_REPORT_NAME = "run_report.json"
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+"""The repository root. Call sites in files below it are reported as the origin of a query."""
+
+
+@dataclass
+class StageMeasurement:
+    """
+    The resources used by one run of a pipeline stage.
+    """
+
+    stage: str
+    wall_time_s: float
+    cpu_time_s: float
+    """User and system time of this process and of all worker processes that finished during the stage."""
+    peak_memory_mb: float
+    """The tracemalloc peak of the stage if memory tracing is enabled, otherwise the peak RSS of the process so far."""
+    sql_statements: int | None
+    """None if the statements of the stage were not counted, e.g. because they run in a subprocess."""
+    sql_time_s: float | None
+
+
+class _QueryCounter:
+    """
+    Counts the SQL statements executed through an engine and the time spent on them, using the engine's cursor
+    events. The start time is kept on the execution context, so a failing statement leaves nothing behind.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.statements = 0
+        self.time = 0.0
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        # Statements without a context (e.g. during the dialect's initialization) are counted, but not timed
+        if context is not None:
+            context._kyoto_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_kyoto_start", None)
+        if start is not None:
+            self.time += time.perf_counter() - start
+        self.statements += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        event.listen(self.engine, "after_cursor_execute", self._after)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before)
+        event.remove(self.engine, "after_cursor_execute", self._after)
+
+
+def _cpu_time() -> float:
+    """
+    :return: The user and system time of this process and its terminated children, in seconds.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+@contextmanager
+def measure_stage(
+    stage: str,
+    engine: Engine,
+    measurements: List[StageMeasurement],
+    trace_memory: bool = False,
+    profile_dir: str | None = None,
+    count_queries: bool = True,
+) -> Iterator[None]:
+    """
+    Measure the resources used by the code inside the `with` block and append them to `measurements`. Nothing is
+    recorded if the block raises.
+
+    :param stage: The name of the stage.
+    :param engine: The engine whose SQL statements are counted.
+    :param measurements: The list to append the :class:`StageMeasurement` to.
+    :param trace_memory: If True, the peak memory is measured with tracemalloc. This is exact for the stage, but
+        slows down allocation-heavy code considerably.
+    :param profile_dir: If given, the stage is run under cProfile and the statistics are saved to
+        `<profile_dir>/<stage>.prof`, for use with e.g. `python -m pstats` or snakeviz.
+    :param count_queries: If False, the SQL statements are not counted and recorded as None. For stages whose
+        statements do not go through `engine`, where a count would be misleading.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    profiler = cProfile.Profile() if profile_dir is not None else None
+    if trace_memory:
+        tracemalloc.start()
+
+    wall_start = time.perf_counter()
+    cpu_start = _cpu_time()
+    try:
+        with _QueryCounter(engine) as counter:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = _cpu_time() - cpu_start
+    finally:
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] / 1024**2
+            tracemalloc.stop()
+
+    if not trace_memory:
+        # ru_maxrss is in kilobytes on Linux
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{stage}.prof"))
+
+    measurement = StageMeasurement(
+        stage=stage,
+        wall_time_s=wall_time,
+        cpu_time_s=cpu_time,
+        peak_memory_mb=peak_memory,
+        sql_statements=counter.statements if count_queries else None,
+        sql_time_s=counter.time if count_queries else None,
+    )
+    measurements.append(measurement)
+    sql = (
+        f"{counter.statements} SQL statements in {counter.time:.2f}s"
+        if count_queries
+        else "SQL statements not counted"
+    )
+    logger.info(
+        f"Stage {stage}: {wall_time:.2f}s wall, {cpu_time:.2f}s CPU, {peak_memory:.0f} MB peak, {sql}"
+    )
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """
+    Raised if a stage executes more SQL statements than its budget allows. Contains the most repeated statements.
+    """
+
+    def __init__(self, stage: str, budget: int, report: str):
+        self.stage = stage
+        self.budget = budget
+        self.report = report
+        super().__init__(
+            f"Stage {stage} exceeded its budget of {budget} SQL statements.\n{report}"
+        )
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Reduce an SQL statement to its shape, so statements differing only in their parameters or in the number of rows
+    of a multi-row INSERT compare equal.
+
+    :param statement: The SQL statement, with parameter placeholders.
+    :return: The normalized statement.
+    """
+    shape = re.sub(r"\s+", " ", statement).strip()
+    # Numbered parameters, e.g. %(id_1)s or the "__[POSTCOMPILE_id_1]" of expanding IN lists
+    shape = re.sub(r"_\d+\b", "", shape)
+    shape = re.sub(r"\(__\[POSTCOMPILE_\w+\]\)", "(...)", shape)
+    # Repeated VALUES tuples of multi-row INSERTs
+    return re.sub(r"(\((?:[^()]|\([^()]*\))*\))(?:, \1)+", r"\1, ...", shape)
+
+
+def _call_site() -> str:
+    """
+    Find where the statement currently being executed was issued: the innermost frame outside SQLAlchemy and this
+    module. If that is in a library, the innermost frame of this repository is appended.
+
+    :return: A "file:line" description.
+    """
+    origin = None
+    for frame, line in traceback.walk_stack(None):
+        filename = frame.f_code.co_filename
+        if filename == __file__ or f"{os.sep}sqlalchemy{os.sep}" in filename:
+            continue
+        in_project = filename.startswith(PROJECT_DIR)
+        site = f"{os.path.relpath(filename, PROJECT_DIR) if in_project else filename}:{line}"
+        if in_project:
+            return site if origin is None else f"{origin} (via {site})"
+        if origin is None:
+            origin = site
+    return origin or "unknown"
+
+
+class QueryGuard:
+    """
+    Records the shape and call site of every SQL statement executed through an engine, to find N+1 query patterns
+    such as lazy loads inside loops. Optionally enforces a maximum number of statements.
+
+    A bulk INSERT that SQLAlchemy splits into batches of `insertmanyvalues_page_size` rows counts as one statement,
+    as does an executemany, so the count does not grow with the number of rows written at once.
+
+    Usable as a context manager, e.g. in a test::
+
+        with QueryGuard(engine, "validation", budget=20) as guard:
+            delete_invalid_rotations_and_trips(scenario, session)
+        assert guard.repeated() == []
+    """
+
+    def __init__(self, engine: Engine, stage: str, budget: int | None = None):
+        """
+        :param engine: The engine to watch.
+        :param stage: The name of the stage, used in reports and errors.
+        :param budget: The maximum number of statements. If exceeded, the statement is not executed and
+            :class:`QueryBudgetExceeded` is raised. None for no limit.
+        """
+        self.engine = engine
+        self.stage = stage
+        self.budget = budget
+        self.statements = 0
+        self.call_sites: Dict[str, Counter] = {}
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if (
+            context is not None
+            and context.execute_style is ExecuteStyle.INSERTMANYVALUES
+        ):
+            # All batches of a bulk INSERT share its execution context
+            if getattr(context, "_kyoto_guard_counted", False):
+                return
+            context._kyoto_guard_counted = True
+        self.statements += 1
+        shape = statement_shape(statement)
+        self.call_sites.setdefault(shape, Counter())[_call_site()] += 1
+        if self.budget is not None and self.statements > self.budget:
+            raise QueryBudgetExceeded(self.stage, self.budget, self.report())
+
+    def repeated(self, threshold: int = 2) -> List[Tuple[str, int, Counter]]:
+        """
+        The statement shapes executed at least `threshold` times, most frequent first.
+
+        :param threshold: The minimum number of executions.
+        :return: A list of (shape, count, call sites) tuples. The call sites count the executions per "file:line".
+        """
+        repeated = [
+            (shape, sum(sites.values()), sites)
+            for shape, sites in self.call_sites.items()
+            if sum(sites.values()) >= threshold
+        ]
+        return sorted(repeated, key=lambda entry: entry[1], reverse=True)
+
+    def report(self, threshold: int = 2, limit: int = 5) -> str:
+        """
+        Describe the most repeated statements and where they were issued.
+
+        :param threshold: The minimum number of executions of a statement to be included.
+        :param limit: The maximum number of statements to include.
+        :return: A human-readable multi-line report.
+        """
+        lines = [
+            f"{self.statements} statements in {len(self.call_sites)} distinct shapes."
+        ]
+        for shape, count, sites in self.repeated(threshold)[:limit]:
+            lines.append(f"{count}x {shape[:200]}")
+            for site, site_count in sites.most_common(3):
+                lines.append(f"    {site_count}x at {site}")
+        return "\n".join(lines)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._before)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._before)
+
+
+@contextmanager
+def configured_measurement(
+    stage: str,
+    engine: Engine,
+    measurements: List[StageMeasurement],
+    config: dict,
+    report_dir: str,
+    count_queries: bool = True,
+) -> Iterator[None]:
+    """
+    Set up :func:`measure_stage` and :class:`QueryGuard` according to the `[instrumentation]` and `[query_guard]`
+    sections of config.toml. Does nothing if both are disabled.
+
+    :param stage: The name of the stage.
+    :param engine: The engine whose SQL statements are counted.
+    :param measurements: The list to append the :class:`StageMeasurement` to.
+    :param config: The parsed contents of config.toml.
+    :param report_dir: The directory the run report is written to. Profiles are saved in its "profiles" subdirectory.
+    :param count_queries: See :func:`measure_stage`.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    with ExitStack() as stack:
+        if config["instrumentation"]["enabled"]:
+            stack.enter_context(
+                measure_stage(
+                    stage,
+                    engine,
+                    measurements,
+                    trace_memory=config["instrumentation"]["trace_memory"],
+                    profile_dir=(
+                        os.path.join(report_dir, "profiles")
+                        if config["instrumentation"]["profile"]
+                        else None
+                    ),
+                    count_queries=count_queries,
+                )
+            )
+        guard = None
+        if config["query_guard"]["enabled"]:
+            guard = stack.enter_context(
+                QueryGuard(engine, stage, config["query_guard"]["budgets"].get(stage))
+            )
+        yield
+        if guard is not None:
+            threshold = config["query_guard"]["repeat_threshold"]
+            if len(guard.repeated(threshold)) > 0:
+                logger.warning(
+                    f"Stage {stage} repeated SQL statements at least {threshold} times, "
+                    f"possibly N+1 queries:\n{guard.report(threshold)}"
+                )
+
+
+def write_run_report(
+    directory: str, scenario_key: str, measurements: List[StageMeasurement]
+) -> None:
+    """
+    Write the measurements of a run to `<directory>/run_report.json`.
+
+    :param directory: The directory to write the report to.
+    :param scenario_key: The short name of the scenario, or "*" for the global stages.
+    :param measurements: The measurements of the stages that were run, in order.
+    :return: None
+    """
+    os.makedirs(directory, exist_ok=True)
+    report = {
+        "scenario": scenario_key,
+        "written_at": datetime.now().astimezone().isoformat(),
+        "stages": [asdict(measurement) for measurement in measurements],
+        "total": {
+            "wall_time_s": sum(m.wall_time_s for m in measurements),
+            "cpu_time_s": sum(m.cpu_time_s for m in measurements),
+            # Over the stages whose statements were counted
+            "sql_statements": sum(m.sql_statements or 0 for m in measurements),
+            "sql_time_s": sum(m.sql_time_s or 0.0 for m in measurements),
+        },
+    }
+    with open(os.path.join(directory, RUN_REPORT_NAME), "w") as fp:
+        json.dump(report, fp, indent=2)
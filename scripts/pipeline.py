@@ -0,0 +1,670 @@
+import importlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from datetime import timedelta
+from typing import Any, Callable, Collection, Dict, List, Tuple
+
+import sqlalchemy.orm
+from eflips.model import Scenario
+from sqlalchemy.orm import Session
+
+from scripts import checkpoint, database, incremental, instrumentation
+from scripts.prepare import (
+    BREAK_DURATION,
+    DEPOT_TRIP_DISTANCE,
+    DEPOT_TRIP_DURATION,
+    add_empty_trips,
+    delete_invalid_rotations_and_trips,
+    add_depot,
+    fix_driving_events,
+)
+
+REPETITION_PERIOD = timedelta(days=1)
+SMART_CHARGING_STRATEGY = "NONE"
+"""The name of the :class:`eflips.depot.api.SmartChargingStrategy` used for the simulation."""
+
+
+def lazy_import(module: str, name: str) -> Any:
+    """
+    Import an attribute of a module when it is needed. The modules of the scheduling, simulation, plotting and export
+    stages import eflips-opt, eflips-depot, eflips-eval, plotly and pandas, which takes seconds, so they are only
+    imported once one of these stages actually runs.
+
+    :param module: The name of the module, e.g. "scripts.plot".
+    :param name: The name of the attribute, e.g. "plot_results".
+    :return: The attribute.
+    """
+    return getattr(importlib.import_module(module), name)
+
+
+def scheduling_max_duration(name_short: str) -> timedelta | None:
+    """
+    The maximum duration of a rotation for the scheduling of a given scenario.
+
+    :param name_short: The short name of the scenario to be scheduled.
+    :return: A timedelta for the "MIX" scenario, None (unlimited) otherwise.
+    """
+    if name_short == "MIX":
+        return timedelta(hours=5)
+    return None
+
+
+def global_stage_fingerprints(input_fingerprint: str) -> List[Tuple[str, str]]:
+    """
+    The checkpoint fingerprints of the stages that run once for the whole database.
+
+    :param input_fingerprint: Identifies the dump and schema version, see :func:`snapshot.snapshot_fingerprint`.
+    :return: A list of (stage, fingerprint) pairs, in the order of :data:`checkpoint.GLOBAL_STAGES`.
+    """
+    params = {
+        "import": {},
+        "fixup": {},
+        "clone": {},
+    }
+    fingerprints = []
+    previous = input_fingerprint
+    for stage in checkpoint.GLOBAL_STAGES:
+        previous = checkpoint.stage_fingerprint(previous, stage, params[stage])
+        fingerprints.append((stage, previous))
+    return fingerprints
+
+
+def scenario_stage_fingerprints(
+    name_short: str, checkpoint_base: str, config: dict
+) -> List[Tuple[str, str]]:
+    """
+    The checkpoint fingerprints of the per-scenario stages.
+
+    :param name_short: The short name of the scenario.
+    :param checkpoint_base: The fingerprint of the last global stage.
+    :param config: The parsed contents of config.toml.
+    :return: A list of (stage, fingerprint) pairs, in the order of :data:`checkpoint.SCENARIO_STAGES`.
+    """
+    params = {
+        "scheduling": {"max_duration": scheduling_max_duration(name_short)},
+        "empty_trips": {
+            "break_duration": BREAK_DURATION,
+            "depot_trip_duration": DEPOT_TRIP_DURATION,
+            "depot_trip_distance": DEPOT_TRIP_DISTANCE,
+        },
+        "validation": {},
+        "driving_events": {},
+        "feasibility": {
+            "min_soc": config["feasibility"]["min_soc"],
+            "split": config["feasibility"]["split"],
+        },
+        "depot": {
+            "electric_power": config["depot"]["electric_power"],
+            "capacity": config["depot"]["capacity"],
+        },
+        "simulation": {
+            "repetition_period": REPETITION_PERIOD,
+            "smart_charging_strategy": SMART_CHARGING_STRATEGY,
+        },
+        "plotting": {
+            "output_dir": config["paths"]["output_dir"],
+            # All options except the number of workers change the plots
+            **{
+                option: value
+                for option, value in config["plotting"].items()
+                if option != "workers"
+            },
+        },
+        "export": {
+            "enabled": config["export"]["enabled"],
+            "export_dir": config["export"]["export_dir"],
+        },
+    }
+    fingerprints = []
+    previous = checkpoint_base
+    for stage in checkpoint.SCENARIO_STAGES:
+        previous = checkpoint.stage_fingerprint(previous, stage, params[stage])
+        fingerprints.append((stage, previous))
+    return fingerprints
+
+
+def resume_point(
+    session: sqlalchemy.orm.session.Session,
+    global_fingerprints: List[Tuple[str, str]],
+    config: dict,
+    force: Collection[str] = (),
+) -> int:
+    """
+    Find the global stage the pipeline can be resumed at, based on the recorded checkpoints.
+
+    :param session: An SQLAlchemy session.
+    :param global_fingerprints: The result of :func:`global_stage_fingerprints`.
+    :param config: The parsed contents of config.toml.
+    :param force: Stages to rerun even if their checkpoint is valid.
+    :return: The index of the first global stage to run. 0 means the database needs to be reset, the length of
+        `global_fingerprints` means only the per-scenario stages need to run.
+    """
+    checkpoints = checkpoint.load_checkpoints(session)
+    if not checkpoint.can_resume(
+        checkpoints, checkpoint.GLOBAL_KEY, global_fingerprints, force
+    ):
+        return 0
+    start = checkpoint.first_stage_to_run(
+        checkpoints, checkpoint.GLOBAL_KEY, global_fingerprints, force
+    )
+    if start < len(global_fingerprints):
+        return start
+
+    # A scenario stage can only be rerun in place if no later stage has changed the scenario in the meantime, or if
+    # the scenario can be restored to the state before the depot was added
+    prepared_states = incremental.load_prepared_states(session)
+    for scenario_id, name_short in session.query(Scenario.id, Scenario.name_short):
+        fingerprints = scenario_stage_fingerprints(
+            name_short, global_fingerprints[-1][1], config
+        )
+        if not checkpoint.can_resume(
+            checkpoints,
+            name_short,
+            fingerprints,
+            force,
+            restorable=is_restorable(
+                scenario_id, fingerprints, prepared_states, config
+            ),
+        ):
+            return 0
+    return start
+
+
+def is_restorable(
+    scenario_id: int,
+    stage_fingerprints: List[Tuple[str, str]],
+    prepared_states: Dict[int, str],
+    config: dict,
+) -> bool:
+    """
+    Check whether a scenario can be restored to the state before its depot was added, see
+    :func:`incremental.restore_prepared_state`.
+
+    :param scenario_id: The id of the scenario.
+    :param stage_fingerprints: The result of :func:`scenario_stage_fingerprints` for the scenario.
+    :param prepared_states: The result of :func:`incremental.load_prepared_states`.
+    :param config: The parsed contents of config.toml.
+    :return: True if incremental reruns are enabled and the saved state matches the current preparation stages.
+    """
+    if not config["checkpoints"]["incremental"]:
+        return False
+    fingerprint = dict(stage_fingerprints)[incremental.PREPARED_STAGE]
+    return prepared_states.get(scenario_id) == fingerprint
+
+
+def streaming_chunk_size(config: dict) -> int | None:
+    """
+    The chunk size for the stages that can stream their data, according to the `[streaming]` section of config.toml.
+
+    :param config: The parsed contents of config.toml.
+    :return: The chunk size, or None if streaming is disabled.
+    """
+    if config["streaming"]["enabled"]:
+        return config["streaming"]["chunk_size"]
+    return None
+
+
+def release_loaded_objects(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Flush pending changes and remove all objects except the scenarios from the session's identity map, so the memory
+    they take up can be freed. They are loaded again from the database when needed.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.flush()
+    for obj in list(session.identity_map.values()):
+        if not isinstance(obj, Scenario):
+            session.expunge(obj)
+
+
+def _stage_runners(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    config: dict,
+    restored: bool = False,
+) -> List[Callable[[], object]]:
+    """
+    The functions running the per-scenario stages.
+
+    :param scenario: The scenario to process.
+    :param session: An SQLAlchemy session the scenario is attached to.
+    :param config: The parsed contents of config.toml.
+    :param restored: Whether the scenario has been restored by :func:`incremental.restore_prepared_state`, so the
+        plots not depending on the simulation can be kept.
+    :return: One function per stage, in the order of :data:`checkpoint.SCENARIO_STAGES`.
+    """
+    max_duration = scheduling_max_duration(scenario.name_short)
+    chunk_size = streaming_chunk_size(config)
+    return [
+        lambda: lazy_import("scripts.scheduling", "do_scheduling")(
+            scenario,
+            session,
+            max_duration,
+            cache_dir=(
+                config["scheduling"]["cache_dir"]
+                if config["scheduling"]["cache"]
+                else None
+            ),
+            cache_max_size_mb=config["scheduling"]["cache_max_size_mb"],
+            decompose=config["scheduling"]["decompose"],
+            workers=config["scheduling"]["workers"],
+            chunk_size=chunk_size,
+        ),
+        lambda: add_empty_trips(scenario, session, chunk_size=chunk_size),
+        lambda: delete_invalid_rotations_and_trips(scenario, session),
+        lambda: fix_driving_events(scenario, session, chunk_size=chunk_size),
+        lambda: lazy_import("scripts.feasibility", "check_energy_feasibility")(
+            scenario,
+            session,
+            min_soc=config["feasibility"]["min_soc"],
+            split=config["feasibility"]["split"],
+        ),
+        lambda: add_depot(
+            scenario,
+            session,
+            electric_power=config["depot"]["electric_power"],
+            capacity=config["depot"]["capacity"],
+        ),
+        lambda: lazy_import("eflips.depot.api", "simulate_scenario")(
+            scenario,
+            repetition_period=REPETITION_PERIOD,
+            smart_charging_strategy=lazy_import(
+                "eflips.depot.api", "SmartChargingStrategy"
+            )[SMART_CHARGING_STRATEGY],
+        ),
+        lambda: lazy_import("scripts.plot", "plot_results")(
+            scenario, session, config, simulation_only=restored
+        ),
+        lambda: (
+            lazy_import("scripts.export", "export_results")(scenario, session, config)
+            if config["export"]["enabled"]
+            else None
+        ),
+    ]
+
+
+def process_scenario(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    config: dict,
+    checkpoint_base: str | None = None,
+    force: Collection[str] = (),
+    only: Collection[str] | None = None,
+    output: "OutputExecutor | None" = None,
+) -> None:
+    """
+    Run all per-scenario stages of the pipeline: scheduling, preparation, feasibility check, simulation, plotting and
+    export.
+
+    :param scenario: The scenario to process.
+    :param session: An SQLAlchemy session the scenario is attached to.
+    :param config: The parsed contents of config.toml.
+    :param checkpoint_base: The fingerprint of the last global stage. If given, stages with a valid checkpoint are
+        skipped, and each completed stage is committed together with its checkpoint. If None, all stages run and
+        nothing is committed.
+    :param force: Stages to rerun even if their checkpoint is valid.
+    :param only: If given, only these stages run, in pipeline order and regardless of their checkpoints. The scenario
+        must already be in the state they expect, e.g. simulated for "plotting".
+    :param output: If given, the session is committed after the simulation, and the plotting and export are handed
+        to this executor instead of running them here. The executor also writes the run report.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    report_dir = os.path.join(
+        config["paths"]["output_dir"], f"scenario {scenario.name_short}"
+    )
+    measurements: List[instrumentation.StageMeasurement] = []
+    chunk_size = streaming_chunk_size(config)
+    name_short = scenario.name_short
+    # The output stages handed to the executor, with their checkpoint fingerprints
+    deferred: List[Tuple[str, str | None]] = []
+    submitted = False
+    restored = False
+
+    try:
+        if checkpoint_base is None:
+            stages = [
+                (stage, None, run_stage)
+                for stage, run_stage in zip(
+                    checkpoint.SCENARIO_STAGES,
+                    _stage_runners(scenario, session, config),
+                )
+            ]
+        else:
+            fingerprints = scenario_stage_fingerprints(
+                name_short, checkpoint_base, config
+            )
+            checkpoints = checkpoint.load_checkpoints(session)
+            if only is not None:
+                start = 0
+            else:
+                start = checkpoint.first_stage_to_run(
+                    checkpoints, name_short, fingerprints, force
+                )
+            if start > 0:
+                logger.info(
+                    f"Scenario {name_short}: skipping stages with valid checkpoints: "
+                    f"{[stage for stage, _ in fingerprints[:start]]}"
+                )
+            if only is None and checkpoint.needs_restore(
+                checkpoints, name_short, fingerprints, start
+            ):
+                # resume_point only lets this happen if the depot or a later stage has changed
+                logger.info(
+                    f"Scenario {name_short}: stage {fingerprints[start][0]} changed, "
+                    "restoring the prepared scenario"
+                )
+                incremental.restore_prepared_state(scenario, session)
+                restored = True
+                # Restoring also removes the depot, so all restorable stages need to run again
+                start = min(
+                    i
+                    for i, (stage, _) in enumerate(fingerprints)
+                    if stage in checkpoint.RESTORABLE_STAGES
+                )
+            runners = _stage_runners(scenario, session, config, restored)
+            stages = [
+                (stage, fingerprint, run_stage)
+                for (stage, fingerprint), run_stage in zip(fingerprints, runners)
+            ][start:]
+
+        for stage, fingerprint, run_stage in stages:
+            if only is not None and stage not in only:
+                continue
+            if output is not None and stage in checkpoint.READ_ONLY_STAGES:
+                deferred.append((stage, fingerprint))
+                continue
+            logger.info(f"Scenario {name_short}: running stage {stage}")
+            with instrumentation.configured_measurement(
+                stage, session.get_bind(), measurements, config, report_dir
+            ):
+                run_stage()
+                if fingerprint is not None:
+                    if (
+                        stage == incremental.PREPARED_STAGE
+                        and config["checkpoints"]["incremental"]
+                    ):
+                        incremental.save_prepared_state(scenario, session, fingerprint)
+                    checkpoint.record_checkpoint(
+                        session, name_short, stage, fingerprint
+                    )
+                    session.commit()
+            if chunk_size is not None:
+                release_loaded_objects(session)
+
+        if len(deferred) > 0:
+            # The background process only sees committed data
+            session.commit()
+            output.submit(scenario, deferred, restored, measurements)
+            submitted = True
+    finally:
+        if config["instrumentation"]["enabled"] and not submitted:
+            instrumentation.write_run_report(
+                report_dir, scenario.name_short, measurements
+            )
+
+
+def _output_stages_worker(
+    scenario_id: int,
+    database_url: str,
+    config: dict,
+    stages: List[Tuple[str, str | None]],
+    restored: bool,
+    measurements: List[instrumentation.StageMeasurement],
+) -> str:
+    """
+    Entry point of the background process of an :class:`OutputExecutor`. Runs the output stages of a simulated
+    scenario in its own session, records their checkpoints and commits.
+
+    :param scenario_id: The id of the scenario.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml.
+    :param stages: The stages to run, with their checkpoint fingerprints (None without checkpoints).
+    :param restored: See :func:`_stage_runners`.
+    :param measurements: The measurements of the stages the main process has run, completed with the output stages
+        for the run report.
+    :return: The short name of the scenario.
+    """
+    logging.basicConfig(level=config["logging"]["level"])
+    logger = logging.getLogger(__name__)
+
+    database.configure_engines(config)
+    engine = database.get_engine(database_url)
+    try:
+        with Session(engine) as session:
+            scenario = session.query(Scenario).filter(Scenario.id == scenario_id).one()
+            name_short = scenario.name_short
+            report_dir = os.path.join(
+                config["paths"]["output_dir"], f"scenario {name_short}"
+            )
+            runners = dict(
+                zip(
+                    checkpoint.SCENARIO_STAGES,
+                    _stage_runners(scenario, session, config, restored),
+                )
+            )
+            try:
+                for stage, fingerprint in stages:
+                    logger.info(f"Scenario {name_short}: running stage {stage}")
+                    with instrumentation.configured_measurement(
+                        stage, engine, measurements, config, report_dir
+                    ):
+                        runners[stage]()
+                        if fingerprint is not None:
+                            checkpoint.record_checkpoint(
+                                session, name_short, stage, fingerprint
+                            )
+                        session.commit()
+            finally:
+                if config["instrumentation"]["enabled"]:
+                    instrumentation.write_run_report(
+                        report_dir, name_short, measurements
+                    )
+            return name_short
+    finally:
+        database.dispose_engines()
+
+
+class OutputExecutor:
+    """
+    Runs the plotting and export of simulated scenarios in a background process, so the main process can continue
+    with the next scenario. Plotting is mostly serialization and disk I/O, and overlaps well with the scheduling and
+    simulation.
+
+    At most `pipeline.output_queue` scenarios are queued or running at a time. Submitting another one waits until the
+    oldest has finished, which bounds the memory held by pending jobs. Failed jobs are logged when they finish, and
+    collected in :attr:`errors`. Use as a context manager, leaving it waits for all outstanding jobs.
+    """
+
+    def __init__(self, database_url: str, config: dict):
+        """
+        :param database_url: The database URL the background process connects to.
+        :param config: The parsed contents of config.toml.
+        """
+        self.database_url = database_url
+        self.config = config
+        self.max_pending = max(config["pipeline"]["output_queue"], 1)
+        self.errors: Dict[str, Exception] = {}
+        self._pending: Dict[Future, str] = {}
+        # "spawn" makes sure no database connections from the parent are inherited by the worker
+        self._executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def __enter__(self) -> "OutputExecutor":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.wait()
+
+    def submit(
+        self,
+        scenario: Scenario,
+        stages: List[Tuple[str, str | None]],
+        restored: bool,
+        measurements: List[instrumentation.StageMeasurement],
+    ) -> None:
+        """
+        Queue the output stages of a scenario. The scenario must have been committed after its simulation.
+
+        :param scenario: The simulated scenario.
+        :param stages: The stages to run, with their checkpoint fingerprints (None without checkpoints).
+        :param restored: See :func:`_stage_runners`.
+        :param measurements: The measurements of the stages run so far, for the run report.
+        :return: None
+        """
+        logger = logging.getLogger(__name__)
+        while len(self._pending) >= self.max_pending:
+            logger.info("Waiting for the output of an earlier scenario")
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        future = self._executor.submit(
+            _output_stages_worker,
+            scenario.id,
+            self.database_url,
+            self.config,
+            stages,
+            restored,
+            measurements,
+        )
+        self._pending[future] = scenario.name_short
+        logger.info(
+            f"Scenario {scenario.name_short}: {[stage for stage, _ in stages]} queued in the background"
+        )
+
+    def _collect(self, futures: Collection[Future]) -> None:
+        """
+        Remove finished jobs from the pending ones, and log and record their errors.
+
+        :param futures: The finished jobs.
+        :return: None
+        """
+        logger = logging.getLogger(__name__)
+        for future in futures:
+            name_short = self._pending.pop(future)
+            try:
+                future.result()
+                logger.info(f"Scenario {name_short}: output finished")
+            except Exception as e:
+                logger.error(f"Scenario {name_short}: output failed: {e!r}")
+                self.errors[name_short] = e
+
+    def wait(self) -> Dict[str, Exception]:
+        """
+        Wait for all outstanding jobs and shut down the background process.
+
+        :return: The errors of all failed jobs, by scenario short name. Empty if all succeeded.
+        """
+        self._collect(list(wait(self._pending).done))
+        self._executor.shutdown()
+        return self.errors
+
+
+def _process_scenario_worker(
+    scenario_id: int,
+    database_url: str,
+    config: dict,
+    checkpoint_base: str | None,
+    force: Collection[str],
+    only: Collection[str] | None,
+) -> str:
+    """
+    Entry point of a worker process. Each worker uses its own engine (see :mod:`scripts.database`) and session and commits its scenario on success.
+
+    :param scenario_id: The id of the scenario to process.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml.
+    :param checkpoint_base: See :func:`process_scenario`.
+    :param force: See :func:`process_scenario`.
+    :param only: See :func:`process_scenario`.
+    :return: The short name of the processed scenario.
+    """
+    logging.basicConfig(level=config["logging"]["level"])
+    logger = logging.getLogger(__name__)
+
+    database.configure_engines(config)
+    engine = database.get_engine(database_url)
+    try:
+        with Session(engine) as session:
+            scenario = session.query(Scenario).filter(Scenario.id == scenario_id).one()
+            name_short = scenario.name_short
+            logger.info(f"Worker started for scenario {name_short}")
+            process_scenario(scenario, session, config, checkpoint_base, force, only)
+            session.commit()
+            logger.info(f"Worker finished and committed scenario {name_short}")
+            return name_short
+    finally:
+        database.dispose_engines()
+
+
+def process_scenarios_parallel(
+    scenario_ids: List[int],
+    database_url: str,
+    config: dict,
+    checkpoint_base: str | None = None,
+    force: Collection[str] = (),
+    only: Collection[str] | None = None,
+) -> Dict[int, Exception | None]:
+    """
+    Process several scenarios in parallel, one worker process per scenario. The scenarios need to be committed to the
+    database before calling this, as the workers open their own connections.
+
+    A failing scenario does not stop the others. Its exception is logged and returned.
+
+    :param scenario_ids: The ids of the scenarios to process.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml. The worker count is taken from `pipeline.workers`. The
+        plotting pool of each worker (`plotting.workers`) is capped, so that all workers together use at most one
+        process per CPU.
+    :param checkpoint_base: See :func:`process_scenario`.
+    :param force: See :func:`process_scenario`.
+    :param only: See :func:`process_scenario`.
+    :return: A dictionary mapping each scenario id to None on success or the exception raised on failure.
+    """
+    logger = logging.getLogger(__name__)
+    workers = min(config["pipeline"]["workers"], len(scenario_ids))
+    plot_workers = max(
+        1, min(config["plotting"]["workers"], (os.cpu_count() or 1) // max(workers, 1))
+    )
+    if plot_workers < config["plotting"]["workers"]:
+        logger.info(
+            f"Using {plot_workers} plotting worker(s) per scenario with {workers} scenario workers."
+        )
+        config = {**config, "plotting": {**config["plotting"], "workers": plot_workers}}
+
+    results: Dict[int, Exception | None] = {}
+    # "spawn" makes sure no database connections from the parent are inherited by the workers
+    with ProcessPoolExecutor(
+        max_workers=max(workers, 1), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = {
+            executor.submit(
+                _process_scenario_worker,
+                scenario_id,
+                database_url,
+                config,
+                checkpoint_base,
+                force,
+                only,
+            ): scenario_id
+            for scenario_id in scenario_ids
+        }
+        for future in as_completed(futures):
+            scenario_id = futures[future]
+            try:
+                name_short = future.result()
+                logger.info(f"Scenario {name_short} (id {scenario_id}) succeeded.")
+                results[scenario_id] = None
+            except Exception as e:
+                logger.error(f"Scenario with id {scenario_id} failed: {e!r}")
+                results[scenario_id] = e
+    return results
@@ -1,12 +1,42 @@
+import logging
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from itertools import groupby
+from zoneinfo import ZoneInfo
 
 import eflips
 import eflips.eval.input.prepare
 import eflips.eval.input.visualize
 import eflips.eval.output.prepare
 import eflips.eval.output.visualize
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io.json
+import plotly.offline
+import plotly.subplots
 import sqlalchemy
-from eflips.model import Rotation, Event, Vehicle
+from eflips.model import (
+    Rotation,
+    Event,
+    Vehicle,
+    EventType,
+    Area,
+    Depot,
+    Station,
+    Route,
+    Trip,
+)
+from sqlalchemy import select
+
+from scripts.timeseries import (
+    PERCENTILES,
+    downsample_soc,
+    fleet_soc_bands,
+    fleet_soc_grid,
+)
 
 
 def _rename_rotations(scenario, session):
@@ -20,35 +50,66 @@ def _rename_rotations(scenario, session):
         rotation.name = f"Rotation {rotation.id}"
 
 
-def _plot_rotation_plan(scenario, session, scenario_dir):
+PLOTLY_JS = "plotly.min.js"
+"""The file name of the plotly.js bundle shared by all figures of a scenario."""
+
+
+def _write_shared_plotly_js(scenario_dir):
     """
-    Create and save an HTML plot displaying the rotation information
-    for the given scenario.
+    Write the plotly.js bundle into the scenario directory, so the HTML files only need to reference it instead of
+    embedding several MB of JavaScript each. An existing bundle is only rewritten if it differs from the one of the
+    installed plotly version.
+
+    :param scenario_dir: The directory path where the plots will be saved.
+    """
+    path = os.path.join(scenario_dir, PLOTLY_JS)
+    bundle = plotly.offline.get_plotlyjs()
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as fp:
+            if fp.read() == bundle:
+                return
+    with open(path, "w", encoding="utf-8") as fp:
+        fp.write(bundle)
+
+
+def _prepare_rotation_plan(scenario, session):
+    """
+    Load the rotation information for the given scenario.
 
     :param scenario: The Scenario object for which to create the plot.
     :param session: A SQLAlchemy session for querying the required data.
-    :param scenario_dir: The directory path where the plot will be saved.
+    :return: The dataframe returned by :func:`eflips.eval.input.prepare.rotation_info`.
     """
     rotation_ids = [
         r[0]
         for r in session.query(Rotation.id).filter(Rotation.scenario == scenario).all()
     ]
-    rotation_info = eflips.eval.input.prepare.rotation_info(
+    return eflips.eval.input.prepare.rotation_info(
         scenario_id=scenario.id, session=session, rotation_ids=rotation_ids
     )
+
+
+def _render_rotation_plan(rotation_info, name_short, path):
+    """
+    Create and save an HTML plot displaying the rotation information
+    for the given scenario.
+
+    :param rotation_info: The data returned by :func:`_prepare_rotation_plan`.
+    :param name_short: The short name of the scenario, used in the title.
+    :param path: The path where the plot will be saved.
+    """
     fig = eflips.eval.input.visualize.rotation_info(rotation_info)
-    fig.update_layout(title=f"Rotation information for scenario {scenario.name_short}")
-    fig.write_html(os.path.join(scenario_dir, "rotation_info.html"))
+    fig.update_layout(title=f"Rotation information for scenario {name_short}")
+    fig.write_html(path, include_plotlyjs=PLOTLY_JS)
 
 
-def _plot_depot_load(scenario, session, scenario_dir):
+def _prepare_depot_load(scenario, session):
     """
-    Create and save an HTML plot displaying power and occupancy (load)
-    for the depots in the given scenario.
+    Load the power and occupancy (load) for the depots in the given scenario.
 
     :param scenario: The Scenario object for which to create the plot.
     :param session: A SQLAlchemy session for querying the required data.
-    :param scenario_dir: The directory path where the plot will be saved.
+    :return: The dataframe returned by :func:`eflips.eval.output.prepare.power_and_occupancy`.
     """
     area_ids = [
         a[0]
@@ -57,62 +118,431 @@ def _plot_depot_load(scenario, session, scenario_dir):
         .distinct()
         .all()
     ]
-    df = eflips.eval.output.prepare.power_and_occupancy(area_ids, session)
+    return eflips.eval.output.prepare.power_and_occupancy(area_ids, session)
+
+
+def _render_depot_load(df, name_short, path):
+    """
+    Create and save an HTML plot displaying power and occupancy (load)
+    for the depots in the given scenario.
+
+    :param df: The data returned by :func:`_prepare_depot_load`.
+    :param name_short: The short name of the scenario, used in the title.
+    :param path: The path where the plot will be saved.
+    """
     fig = eflips.eval.output.visualize.power_and_occupancy(df)
-    fig.update_layout(title=f"Power and occupancy for scenario {scenario.name_short}")
-    fig.write_html(os.path.join(scenario_dir, "power_and_occupancy.html"))
+    fig.update_layout(title=f"Power and occupancy for scenario {name_short}")
+    fig.write_html(path, include_plotlyjs=PLOTLY_JS)
 
 
-def _plot_depot_event_timeline(scenario, session, scenario_dir):
+def _prepare_depot_event_timeline(scenario, session):
     """
-    Create and save an HTML plot visualizing all events happening
-    in the depot (e.g., arrivals, departures, charging, etc.).
+    Load all events happening in the depot (e.g., arrivals, departures, charging, etc.).
 
     :param scenario: The Scenario object for which to create the plot.
     :param session: A SQLAlchemy session for querying the required data.
-    :param scenario_dir: The directory path where the plot will be saved.
+    :return: The dataframe returned by :func:`eflips.eval.output.prepare.depot_event`.
     """
     vehicle_ids = [
         v[0]
         for v in session.query(Vehicle.id).filter(Vehicle.scenario == scenario).all()
     ]
-    df = eflips.eval.output.prepare.depot_event(scenario.id, session, vehicle_ids)
-    color_scheme = "event_type"
+    return eflips.eval.output.prepare.depot_event(scenario.id, session, vehicle_ids)
+
+
+def _render_depot_event_timeline(df, color_scheme, name_short, path):
+    """
+    Create and save an HTML plot visualizing all events happening
+    in the depot (e.g., arrivals, departures, charging, etc.).
+
+    :param df: The data returned by :func:`_prepare_depot_event_timeline`.
+    :param color_scheme: The color scheme passed to :func:`eflips.eval.output.visualize.depot_event`.
+    :param name_short: The short name of the scenario, used in the title.
+    :param path: The path where the plot will be saved.
+    """
     fig = eflips.eval.output.visualize.depot_event(df, color_scheme=color_scheme)
-    fig.update_layout(title=f"Depot events for scenario {scenario.name_short}")
-    fig.write_html(os.path.join(scenario_dir, f"depot_event_{color_scheme}.html"))
+    fig.update_layout(title=f"Depot events for scenario {name_short}")
+    fig.write_html(path, include_plotlyjs=PLOTLY_JS)
 
 
-def _plot_vehicle_socs(scenario, session, scenario_dir):
+def load_vehicle_socs(
+    scenario, session, timezone=ZoneInfo("Europe/Berlin"), include_trips=False
+):
     """
-    Create and save an HTML plot (one per vehicle) showing the state of
-    charge (SoC) over time for each vehicle in the scenario.
+    Load the SoC time series and event descriptions of all vehicles in the scenario, in the same form as
+    :func:`eflips.eval.output.prepare.vehicle_soc` returns them for a single vehicle.
+
+    Instead of several queries per vehicle, all events are loaded in one query and all rotations with their trips in
+    another, and then split by vehicle in memory.
 
-    :param scenario: The Scenario object for which to create the SoC plots.
+    :param scenario: The Scenario object for which to load the SoC data.
     :param session: A SQLAlchemy session for querying the required data.
-    :param scenario_dir: The directory path where the plots will be saved.
+    :param timezone: The timezone to convert the times to.
+    :param include_trips: Also add a "trip" entry to the descriptions, with the route name, departure and arrival of
+        every trip. This is not part of the descriptions from eflips-eval, and adds one shaded area per trip to the
+        SoC plots.
+    :return: A dictionary mapping each vehicle id to a (dataframe, descriptions) tuple.
+    """
+    vehicle_ids = [
+        v[0]
+        for v in session.query(Vehicle.id)
+        .filter(Vehicle.scenario == scenario)
+        .order_by(Vehicle.id)
+    ]
+    times = {vehicle_id: [] for vehicle_id in vehicle_ids}
+    socs = {vehicle_id: [] for vehicle_id in vehicle_ids}
+    descriptions = {
+        vehicle_id: {"rotation": [], "charging": []} for vehicle_id in vehicle_ids
+    }
+    if include_trips:
+        for vehicle_id in vehicle_ids:
+            descriptions[vehicle_id]["trip"] = []
+
+    events = session.execute(
+        select(
+            Event.vehicle_id,
+            Event.time_start,
+            Event.time_end,
+            Event.soc_start,
+            Event.soc_end,
+            Event.timeseries,
+            Event.event_type,
+            Area.name,
+            Depot.name,
+            Station.name,
+        )
+        .outerjoin(Area, Event.area_id == Area.id)
+        .outerjoin(Depot, Area.depot_id == Depot.id)
+        .outerjoin(Station, Event.station_id == Station.id)
+        .filter(Event.scenario_id == scenario.id)
+        .filter(Event.vehicle_id.is_not(None))
+        .order_by(Event.vehicle_id, Event.time_start)
+    )
+    for (
+        vehicle_id,
+        time_start,
+        time_end,
+        soc_start,
+        soc_end,
+        timeseries,
+        event_type,
+        area_name,
+        depot_name,
+        station_name,
+    ) in events:
+        times[vehicle_id].append(time_start.astimezone(timezone))
+        socs[vehicle_id].append(soc_start)
+        if timeseries is not None:
+            times[vehicle_id].extend(
+                datetime.fromisoformat(t).astimezone(timezone)
+                for t in timeseries["time"]
+            )
+            socs[vehicle_id].extend(timeseries["soc"])
+        times[vehicle_id].append(time_end.astimezone(timezone))
+        socs[vehicle_id].append(soc_end)
+
+        if event_type in (EventType.CHARGING_DEPOT, EventType.CHARGING_OPPORTUNITY):
+            if area_name is not None:
+                name = area_name + " in " + depot_name
+            else:
+                name = station_name
+            descriptions[vehicle_id]["charging"].append(
+                (name, time_start.astimezone(timezone), time_end.astimezone(timezone))
+            )
+
+    trips = session.execute(
+        select(
+            Rotation.vehicle_id,
+            Rotation.id,
+            Rotation.name,
+            Route.name,
+            Trip.departure_time,
+            Trip.arrival_time,
+        )
+        .join(Trip, Trip.rotation_id == Rotation.id)
+        .join(Route, Trip.route_id == Route.id)
+        .filter(Rotation.scenario_id == scenario.id)
+        .filter(Rotation.vehicle_id.is_not(None))
+        .order_by(Rotation.vehicle_id, Rotation.id, Trip.departure_time)
+    )
+    for (vehicle_id, _, rotation_name), rotation_trips in groupby(
+        trips, key=lambda row: row[:3]
+    ):
+        rotation_trips = list(rotation_trips)
+        descriptions[vehicle_id]["rotation"].append(
+            (
+                rotation_name,
+                rotation_trips[0][4].astimezone(timezone),
+                rotation_trips[-1][5].astimezone(timezone),
+            )
+        )
+        if include_trips:
+            descriptions[vehicle_id]["trip"].extend(
+                (
+                    route_name,
+                    departure_time.astimezone(timezone),
+                    arrival_time.astimezone(timezone),
+                )
+                for _, _, _, route_name, departure_time, arrival_time in rotation_trips
+            )
+
+    return {
+        vehicle_id: (
+            pd.DataFrame({"time": times[vehicle_id], "soc": socs[vehicle_id]}),
+            descriptions[vehicle_id],
+        )
+        for vehicle_id in vehicle_ids
+    }
+
+
+def _render_vehicle_soc(vehicle_id, df, descriptions, path):
+    """
+    Create and save an HTML plot showing the state of charge (SoC) over time of a single vehicle.
+
+    :param vehicle_id: The id of the vehicle, used in the title.
+    :param df: The SoC time series of the vehicle, see :func:`load_vehicle_socs`.
+    :param descriptions: The event descriptions of the vehicle, see :func:`load_vehicle_socs`.
+    :param path: The path where the plot will be saved.
+    """
+    fig = eflips.eval.output.visualize.vehicle_soc(df, descriptions)
+    fig.update_layout(title=f"Vehicle {vehicle_id} SoC over time")
+    fig.write_html(path, include_plotlyjs=f"../{PLOTLY_JS}")
+
+
+FLEET_SOC_SCRIPT = """
+var gd = document.getElementById("{plot_id}");
+var views = VIEWS;
+var shown = 0;
+gd.on("plotly_buttonclicked", function (event) {
+    var trace = event.active - 1;
+    if (trace < 0) {
+        Plotly.restyle(gd, {visible: true});
+    } else {
+        Plotly.restyle(gd, {visible: false}, shown < 0 ? undefined : [shown]);
+        Plotly.restyle(gd, {visible: true}, [trace]);
+    }
+    shown = trace;
+    Plotly.relayout(gd, views[event.active]);
+});
+"""
+"""Switches the vehicle shown on the fleet SoC page. `VIEWS` is replaced by the shapes and title of each button."""
+
+
+def _render_fleet_soc(vehicle_socs, name_short, path):
     """
-    # For each vehicle, create a SoC over time plot
-    for vehicle in session.query(Vehicle).filter(Vehicle.scenario == scenario):
-        df, descriptions = eflips.eval.output.prepare.vehicle_soc(vehicle.id, session)
-        fig = eflips.eval.output.visualize.vehicle_soc(df, descriptions)
-        fig.update_layout(title=f"Vehicle {vehicle.id} SoC over time")
-        fig.write_html(
-            os.path.join(scenario_dir, "vehicle_socs", f"vehicle_{vehicle.id}_soc.html")
+    Create and save a single HTML page showing the SoC over time of all vehicles in the scenario, with a
+    dropdown to select the vehicle to display.
+
+    Each vehicle is one trace. Instead of storing the visibility of every trace for every dropdown entry, which grows
+    quadratically with the fleet, the dropdown only hides the previously shown trace and shows the selected one, see
+    :data:`FLEET_SOC_SCRIPT`.
+
+    :param vehicle_socs: The SoC data of all vehicles, as returned by :func:`load_vehicle_socs`.
+    :param name_short: The short name of the scenario, used in the title.
+    :param path: The path where the plot will be saved.
+    """
+    colors = {"rotation": "red", "charging": "green", "trip": "blue"}
+    fig = go.Figure()
+    buttons = [dict(label="All vehicles", method="skip")]
+    views = [{"shapes": [], "title": f"SoC over time for scenario {name_short}"}]
+    for i, (vehicle_id, (df, descriptions)) in enumerate(vehicle_socs.items()):
+        fig.add_trace(
+            go.Scatter(
+                x=df["time"],
+                y=df["soc"],
+                mode="lines",
+                name=f"Vehicle {vehicle_id}",
+                visible=i == 0,
+            )
         )
+        shapes = [
+            dict(
+                type="rect",
+                xref="x",
+                yref="paper",
+                x0=start,
+                x1=end,
+                y0=0,
+                y1=1,
+                # Passed to plotly.js as is, so without the magic underscores of plotly.py
+                line=dict(width=0),
+                fillcolor=colors[kind],
+                opacity=0.25,
+            )
+            for kind, events in descriptions.items()
+            for _, start, end in events
+        ]
+        buttons.append(dict(label=f"Vehicle {vehicle_id}", method="skip"))
+        views.append({"shapes": shapes, "title": f"Vehicle {vehicle_id} SoC over time"})
+    if len(views) > 1:
+        fig.update_layout(**views[1])
+    fig.update_layout(
+        updatemenus=[
+            dict(
+                buttons=buttons,
+                active=1 if len(views) > 1 else 0,
+                direction="down",
+                x=0,
+                y=1.15,
+            )
+        ],
+        xaxis_title="Time",
+        yaxis_title="Net State of Charge",
+    )
+    fig.write_html(
+        path,
+        include_plotlyjs=PLOTLY_JS,
+        post_script=FLEET_SOC_SCRIPT.replace(
+            "VIEWS", plotly.io.json.to_json_plotly(views)
+        ),
+    )
+
+
+def _render_fleet_soc_overview(grid_times, vehicle_ids, socs, bands, name_short, path):
+    """
+    Create and save a single HTML page summarizing the SoC of the whole fleet: a heatmap of the SoC of every vehicle
+    over time, and below it the minimum and percentile bands of the fleet SoC, both in percent. Its size depends on
+    the number of vehicles and grid times, not on the number of SoC samples.
+
+    :param grid_times: The grid times, see :func:`scripts.timeseries.fleet_soc_grid`.
+    :param vehicle_ids: The vehicle of each row of `socs`.
+    :param socs: The SoC of each vehicle at each grid time, see :func:`scripts.timeseries.fleet_soc_grid`.
+    :param bands: The minimum and percentiles, see :func:`scripts.timeseries.fleet_soc_bands`.
+    :param name_short: The short name of the scenario, used in the title.
+    :param path: The path where the plot will be saved.
+    """
+    fig = plotly.subplots.make_subplots(
+        rows=2,
+        cols=1,
+        shared_xaxes=True,
+        row_heights=[0.65, 0.35],
+        vertical_spacing=0.05,
+    )
+    fig.add_trace(
+        go.Heatmap(
+            x=grid_times,
+            y=[f"Vehicle {vehicle_id}" for vehicle_id in vehicle_ids],
+            z=socs * 100,
+            zmin=0,
+            zmax=100,
+            colorscale="RdYlGn",
+            colorbar=dict(title="SoC (%)", len=0.65, y=1, yanchor="top"),
+        ),
+        row=1,
+        col=1,
+    )
+
+    # Each band is filled up to the previous trace, from the outermost percentiles inwards
+    outer, inner = PERCENTILES[: len(PERCENTILES) // 2], PERCENTILES[::-1]
+    for lower, upper in zip(outer, inner):
+        fig.add_trace(
+            go.Scatter(
+                x=grid_times,
+                y=bands[f"p{lower}"] * 100,
+                mode="lines",
+                line=dict(width=0),
+                showlegend=False,
+                hoverinfo="skip",
+            ),
+            row=2,
+            col=1,
+        )
+        fig.add_trace(
+            go.Scatter(
+                x=grid_times,
+                y=bands[f"p{upper}"] * 100,
+                mode="lines",
+                line=dict(width=0),
+                fill="tonexty",
+                fillcolor="rgba(31, 119, 180, 0.25)",
+                name=f"{lower}th to {upper}th percentile",
+            ),
+            row=2,
+            col=1,
+        )
+    for key, name, dash in [("p50", "Median", "solid"), ("min", "Minimum", "dot")]:
+        fig.add_trace(
+            go.Scatter(
+                x=grid_times,
+                y=bands[key] * 100,
+                mode="lines",
+                line=dict(dash=dash),
+                name=name,
+            ),
+            row=2,
+            col=1,
+        )
+    fig.update_yaxes(title_text="Net State of Charge (%)", row=2, col=1)
+    fig.update_xaxes(title_text="Time", row=2, col=1)
+    fig.update_layout(title=f"Fleet SoC for scenario {name_short}")
+    fig.write_html(path, include_plotlyjs=PLOTLY_JS)
+
+
+def _timed_render(render, *args):
+    """
+    Run a render function and measure how long it takes. Module-level so it can be sent to worker processes.
+
+    :param render: One of the `_render_*` functions.
+    :param args: The arguments to pass to it.
+    :return: The elapsed wall time in seconds.
+    """
+    start = time.perf_counter()
+    render(*args)
+    return time.perf_counter() - start
+
+
+def _run_render_jobs(jobs, workers):
+    """
+    Run the figure rendering jobs, either in the main process or in a process pool, and log the time each one took.
+
+    :param jobs: A list of (name, render function, arguments) tuples.
+    :param workers: The number of worker processes. 1 renders in the main process.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+    if workers <= 1:
+        for name, render, args in jobs:
+            logger.debug(f"Rendered {name} in {_timed_render(render, *args):.2f}s")
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(_timed_render, render, *args): name
+                for name, render, args in jobs
+            }
+            for future in as_completed(futures):
+                logger.debug(f"Rendered {futures[future]} in {future.result():.2f}s")
+    logger.info(
+        f"Rendered {len(jobs)} figures in {time.perf_counter() - start:.2f}s "
+        f"with {workers} worker(s)"
+    )
 
 
 def plot_results(
-    scenario: "Scenario", session: "sqlalchemy.orm.session.Session", config: dict
+    scenario: "Scenario",
+    session: "sqlalchemy.orm.session.Session",
+    config: dict,
+    simulation_only: bool = False,
 ):
     """
     Create and save multiple plots that visualize the results of a given scenario:
       - Rotation plan
       - Depot load (power and occupancy)
       - Depot event timeline
-      - Vehicle SoC over time
+      - Vehicle SoC over time (one file per vehicle and/or one page for the whole fleet)
+      - Fleet SoC overview (a vehicle x time heatmap and percentile bands)
+
+    All data is loaded from the database first. The figures are then built and written, optionally in a process
+    pool with `plotting.workers` processes. All plots reference a single shared copy of plotly.js. The plots are
+    saved in an output folder named after the scenario.
 
-    The plots are saved in an output folder named after the scenario.
+    If `simulation_only` is True, the rotation plan, which does not depend on the simulation, is only created if it
+    does not exist yet, and the SoC plots of vehicles from an earlier simulation are removed. This is used when only
+    the depot and the simulation have been rerun.
+
+    With a positive `plotting.max_soc_points`, the SoC series of each vehicle is downsampled to that many points
+    before plotting, keeping its peaks and dips (see :func:`scripts.timeseries.lttb_indices`).
     """
     # Create output directory for the scenario and subfolder for vehicle SoCs
     os.makedirs(
@@ -131,8 +561,108 @@ def plot_results(
     # Rename rotations for better readability
     _rename_rotations(scenario, session)
 
+    # Load all the data needed for the plots
+    name_short = scenario.name_short
+    color_scheme = "event_type"
+    jobs = []
+    rotation_plan_path = os.path.join(scenario_dir, "rotation_info.html")
+    if not (simulation_only and os.path.exists(rotation_plan_path)):
+        jobs.append(
+            (
+                "rotation plan",
+                _render_rotation_plan,
+                (
+                    _prepare_rotation_plan(scenario, session),
+                    name_short,
+                    rotation_plan_path,
+                ),
+            )
+        )
+    jobs += [
+        (
+            "depot load",
+            _render_depot_load,
+            (
+                _prepare_depot_load(scenario, session),
+                name_short,
+                os.path.join(scenario_dir, "power_and_occupancy.html"),
+            ),
+        ),
+        (
+            "depot event timeline",
+            _render_depot_event_timeline,
+            (
+                _prepare_depot_event_timeline(scenario, session),
+                color_scheme,
+                name_short,
+                os.path.join(scenario_dir, f"depot_event_{color_scheme}.html"),
+            ),
+        ),
+    ]
+
+    vehicle_socs = load_vehicle_socs(
+        scenario, session, include_trips=config["plotting"]["trip_descriptions"]
+    )
+    if config["plotting"]["fleet_overview"]:
+        # The overview interpolates the full series, so it is computed before downsampling
+        grid_times, vehicle_ids, socs = fleet_soc_grid(
+            vehicle_socs, timedelta(minutes=config["plotting"]["overview_step_minutes"])
+        )
+        jobs.append(
+            (
+                "fleet SoC overview",
+                _render_fleet_soc_overview,
+                (
+                    grid_times,
+                    vehicle_ids,
+                    socs,
+                    fleet_soc_bands(socs),
+                    name_short,
+                    os.path.join(scenario_dir, "fleet_soc_overview.html"),
+                ),
+            )
+        )
+    max_points = config["plotting"]["max_soc_points"]
+    if max_points > 0:
+        vehicle_socs = {
+            vehicle_id: (downsample_soc(df, max_points), descriptions)
+            for vehicle_id, (df, descriptions) in vehicle_socs.items()
+        }
+    if simulation_only:
+        # The vehicles are created by the simulation, so the files of the previous vehicles would be left over
+        vehicle_soc_dir = os.path.join(scenario_dir, "vehicle_socs")
+        for filename in os.listdir(vehicle_soc_dir):
+            if filename.endswith("_soc.html"):
+                os.remove(os.path.join(vehicle_soc_dir, filename))
+    if config["plotting"]["vehicle_soc_files"]:
+        jobs.extend(
+            (
+                f"vehicle {vehicle_id} SoC",
+                _render_vehicle_soc,
+                (
+                    vehicle_id,
+                    df,
+                    descriptions,
+                    os.path.join(
+                        scenario_dir, "vehicle_socs", f"vehicle_{vehicle_id}_soc.html"
+                    ),
+                ),
+            )
+            for vehicle_id, (df, descriptions) in vehicle_socs.items()
+        )
+    if config["plotting"]["fleet_soc_page"]:
+        jobs.append(
+            (
+                "fleet SoC",
+                _render_fleet_soc,
+                (
+                    vehicle_socs,
+                    name_short,
+                    os.path.join(scenario_dir, "fleet_soc.html"),
+                ),
+            )
+        )
+
     # Generate the various plots
-    _plot_rotation_plan(scenario, session, scenario_dir)
-    _plot_depot_load(scenario, session, scenario_dir)
-    _plot_depot_event_timeline(scenario, session, scenario_dir)
-    _plot_vehicle_socs(scenario, session, scenario_dir)
+    _write_shared_plotly_js(scenario_dir)
+    _run_render_jobs(jobs, config["plotting"]["workers"])
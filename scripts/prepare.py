@@ -1,5 +1,8 @@
 import logging
+from dataclasses import dataclass, field
 from datetime import timedelta
+from itertools import groupby
+from typing import List, Tuple
 
 import sqlalchemy.orm
 from eflips.model import (
@@ -20,24 +23,55 @@ from eflips.model import (
     Plan,
     Process,
     AssocPlanProcess,
+    AssocAreaProcess,
     Vehicle,
+    StopTime,
 )
+from sqlalchemy import Select, delete, func, insert, select, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
 from sqlalchemy.orm import Session
 
 
-def add_empty_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session):
+DEPOT_LATLON = (34.97900836429751, 135.75613027247684)
+DEPOT_TRIP_DURATION = timedelta(minutes=6)
+DEPOT_TRIP_DISTANCE = 3100  # meters
+DEPOT_NAME = "九条車庫前"
+TERMINAL_NAME = "北大路バスターミナル（地下鉄北大路駅）"
+BREAK_DURATION = timedelta(minutes=5)
+DEPOT_CHARGING_POWER = 50  # kW
+DEPOT_AREA_CAPACITY = 10
+
+
+def _expire_loaded(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    cls: type,
+    attributes: List[str] | None = None,
+) -> None:
     """
-    Add empty trips from the depot to the first stop and from the last stop to the depot.
-    :param scenario:
-    :param session:
-    :return:
+    Expire all objects of a class belonging to a scenario that are loaded in the session. This is needed after rows
+    have been inserted, updated or deleted with statements that bypass the ORM.
+
+    :param scenario: The scenario whose objects to expire.
+    :param session: An SQLAlchemy session.
+    :param cls: The mapped class of the objects to expire.
+    :param attributes: The attributes to expire. If None, all attributes are expired.
+    :return: None
     """
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, cls) and obj.scenario_id == scenario.id:
+            session.expire(obj, attributes)
 
-    DEPOT_LATLON = (34.97900836429751, 135.75613027247684)
-    DEPOT_TRIP_DURATION = timedelta(minutes=6)
-    DEPOT_TRIP_DISTANCE = 3100  # meters
-    DEPOT_NAME = "九条車庫前"
 
+def _add_depot_station_and_routes(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> Tuple[Route, Route]:
+    """
+    Add the depot station as well as the routes from the depot to the terminal and back.
+    :param scenario: The scenario to add the depot station to.
+    :param session: An SQLAlchemy session.
+    :return: The route from the depot to the terminal and the route from the terminal to the depot.
+    """
     # Check if the depot is already in the stops
     if (
         session.query(Station)
@@ -67,7 +101,7 @@ def add_empty_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session)
     terminal = (
         session.query(Station)
         .filter(Station.scenario == scenario)
-        .filter(Station.name == "北大路バスターミナル（地下鉄北大路駅）")
+        .filter(Station.name == TERMINAL_NAME)
         .one()
     )
 
@@ -92,12 +126,51 @@ def add_empty_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session)
     )
     session.add(first_stop_to_depot)
 
+    return depot_to_first_stop, first_stop_to_depot
+
+
+def add_empty_trips(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    bulk: bool = True,
+    chunk_size: int | None = None,
+    break_duration: timedelta = BREAK_DURATION,
+    depot_trip_duration: timedelta = DEPOT_TRIP_DURATION,
+):
+    """
+    Add empty trips from the depot to the first stop and from the last stop to the depot.
+    :param scenario:
+    :param session:
+    :param bulk: If True, the first and last trip times of all rotations are loaded in one aggregate query and the
+        empty trips are inserted with a single multi-row INSERT. If False, the trips are added through the ORM,
+        one rotation at a time. Both produce the same trips.
+    :param chunk_size: If given (and `bulk` is True), the rotations are streamed from the database and the trips are
+        inserted in chunks of this size.
+    :param break_duration: The time between an empty trip and the first or last passenger trip.
+    :param depot_trip_duration: The duration of an empty trip.
+    :return:
+    """
+    depot_to_first_stop, first_stop_to_depot = _add_depot_station_and_routes(
+        scenario, session
+    )
+
+    if bulk:
+        _add_empty_trips_bulk(
+            scenario,
+            session,
+            depot_to_first_stop,
+            first_stop_to_depot,
+            chunk_size,
+            break_duration,
+            depot_trip_duration,
+        )
+        return
+
     # Now, add trips to each rotation
-    BREAK_DURATION = timedelta(minutes=5)
     for rotation in session.query(Rotation).filter(Rotation.scenario == scenario):
         first_trip_start = rotation.trips[0].departure_time
-        depot_trip_end = first_trip_start - BREAK_DURATION
-        depot_trip_start = depot_trip_end - DEPOT_TRIP_DURATION
+        depot_trip_end = first_trip_start - break_duration
+        depot_trip_start = depot_trip_end - depot_trip_duration
         depot_trip = Trip(
             scenario=scenario,
             route=depot_to_first_stop,
@@ -111,8 +184,8 @@ def add_empty_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session)
         del depot_trip  # Because we don't want to accidentally use it again
 
         last_trip_end = rotation.trips[-1].arrival_time
-        depot_trip_start = last_trip_end + BREAK_DURATION
-        depot_trip_end = depot_trip_start + DEPOT_TRIP_DURATION
+        depot_trip_start = last_trip_end + break_duration
+        depot_trip_end = depot_trip_start + depot_trip_duration
         depot_trip = Trip(
             scenario=scenario,
             route=first_stop_to_depot,
@@ -126,59 +199,227 @@ def add_empty_trips(scenario: Scenario, session: sqlalchemy.orm.session.Session)
         del depot_trip
 
 
+def _add_empty_trips_bulk(
+    scenario: Scenario,
+    session: sqlalchemy.orm.session.Session,
+    depot_to_first_stop: Route,
+    first_stop_to_depot: Route,
+    chunk_size: int | None = None,
+    break_duration: timedelta = BREAK_DURATION,
+    depot_trip_duration: timedelta = DEPOT_TRIP_DURATION,
+) -> None:
+    """
+    Set-based implementation of :func:`add_empty_trips`.
+
+    :param scenario: The scenario to add the empty trips to.
+    :param session: An SQLAlchemy session.
+    :param depot_to_first_stop: The route from the depot to the terminal.
+    :param first_stop_to_depot: The route from the terminal to the depot.
+    :param chunk_size: If given, the rotations are read with a server-side cursor and the trips are inserted every
+        time this many have been collected. Otherwise, all trips are inserted at once.
+    :param break_duration: The time between an empty trip and the first or last passenger trip.
+    :param depot_trip_duration: The duration of an empty trip.
+    :return: None
+    """
+    # The routes need ids before we can reference them in the INSERT
+    session.flush()
+
+    # The first departure and the arrival of the trip departing last, as `rotation.trips` is ordered by departure time
+    rotation_times_query = (
+        select(
+            Trip.rotation_id,
+            func.min(Trip.departure_time),
+            array_agg(
+                aggregate_order_by(Trip.arrival_time, Trip.departure_time.desc())
+            )[1],
+        )
+        .filter(Trip.scenario_id == scenario.id)
+        .group_by(Trip.rotation_id)
+    )
+    if chunk_size is not None:
+        rotation_times = session.execute(
+            rotation_times_query.execution_options(yield_per=chunk_size)
+        )
+    else:
+        rotation_times = session.execute(rotation_times_query).all()
+
+    trip_rows = []
+    for rotation_id, first_trip_start, last_trip_end in rotation_times:
+        depot_trip_end = first_trip_start - break_duration
+        trip_rows.append(
+            dict(
+                scenario_id=scenario.id,
+                route_id=depot_to_first_stop.id,
+                rotation_id=rotation_id,
+                departure_time=depot_trip_end - depot_trip_duration,
+                arrival_time=depot_trip_end,
+                trip_type=TripType.EMPTY,
+                loaded_mass=0,
+            )
+        )
+
+        depot_trip_start = last_trip_end + break_duration
+        trip_rows.append(
+            dict(
+                scenario_id=scenario.id,
+                route_id=first_stop_to_depot.id,
+                rotation_id=rotation_id,
+                departure_time=depot_trip_start,
+                arrival_time=depot_trip_start + depot_trip_duration,
+                trip_type=TripType.EMPTY,
+                loaded_mass=0,
+            )
+        )
+        if chunk_size is not None and len(trip_rows) >= chunk_size:
+            session.execute(insert(Trip).values(trip_rows))
+            trip_rows = []
+
+    if len(trip_rows) > 0:
+        session.execute(insert(Trip).values(trip_rows))
+
+    # The INSERT bypassed the ORM, so already loaded trip collections are now stale
+    _expire_loaded(scenario, session, Rotation, ["trips"])
+    session.expire(depot_to_first_stop, ["trips"])
+    session.expire(first_stop_to_depot, ["trips"])
+
+
+@dataclass
+class DeletionReport:
+    """
+    What :func:`delete_invalid_rotations_and_trips` removed from a scenario, and why.
+    """
+
+    discontinuous_rotation_ids: List[int] = field(default_factory=list)
+    """Rotations where a trip does not start at the arrival station of the previous trip."""
+
+    negative_consumption_trip_ids: List[int] = field(default_factory=list)
+    """Trips whose driving event has a negative (or zero) energy consumption."""
+
+    deleted_rotations: int = 0
+    deleted_trips: int = 0
+    deleted_stop_times: int = 0
+    deleted_events: int = 0
+
+
+def _delete_trips(
+    session: sqlalchemy.orm.session.Session, trip_ids: Select, report: DeletionReport
+) -> None:
+    """
+    Delete the stop times, events and trips selected by a subquery using set-based DELETE statements.
+
+    :param session: An SQLAlchemy session.
+    :param trip_ids: A SELECT statement returning the ids of the trips to delete.
+    :param report: The report to add the number of deleted rows to.
+    :return: None
+    """
+    report.deleted_stop_times += session.execute(
+        delete(StopTime).where(StopTime.trip_id.in_(trip_ids))
+    ).rowcount
+    report.deleted_events += session.execute(
+        delete(Event).where(Event.trip_id.in_(trip_ids))
+    ).rowcount
+    report.deleted_trips += session.execute(
+        delete(Trip).where(Trip.id.in_(trip_ids))
+    ).rowcount
+
+
 def delete_invalid_rotations_and_trips(
     scenario: Scenario, session: sqlalchemy.orm.session.Session
-):
+) -> DeletionReport:
+    """
+    Delete all rotations that are not continuous in space, as well as all trips with a negative energy consumption.
+
+    Both checks are done in the database. A rotation is discontinuous if the departure station of any of its trips
+    differs from the arrival station of the previous trip, ordered by departure time.
+
+    :param scenario: The scenario to clean up.
+    :param session: An SQLAlchemy session.
+    :return: A :class:`DeletionReport` describing what was removed.
+    """
     logger = logging.getLogger(__name__)
-    rotations_to_delete = []
-    for rotation in session.query(Rotation).filter(Rotation.scenario == scenario):
-        for i, trip in enumerate(rotation.trips):
-            if trip != rotation.trips[-1]:
-                if (
-                    rotation.trips[i].route.arrival_station
-                    != rotation.trips[i + 1].route.departure_station
-                ):
-                    rotations_to_delete.append(rotation)
-
-    rotations_to_delete = list(set(rotations_to_delete))
-    if len(rotations_to_delete) > 0:
+    report = DeletionReport()
+
+    previous_arrival_station_id = (
+        func.lag(Route.arrival_station_id)
+        .over(partition_by=Trip.rotation_id, order_by=Trip.departure_time)
+        .label("previous_arrival_station_id")
+    )
+    trip_links = (
+        select(
+            Trip.rotation_id,
+            Route.departure_station_id,
+            previous_arrival_station_id,
+        )
+        .join(Route, Trip.route_id == Route.id)
+        .filter(Trip.scenario_id == scenario.id)
+        .subquery()
+    )
+    report.discontinuous_rotation_ids = list(
+        session.scalars(
+            select(trip_links.c.rotation_id)
+            .filter(
+                trip_links.c.previous_arrival_station_id
+                != trip_links.c.departure_station_id
+            )
+            .distinct()
+            .order_by(trip_links.c.rotation_id)
+        )
+    )
+
+    if len(report.discontinuous_rotation_ids) > 0:
         logger.warning(
-            f"Deleting {len(rotations_to_delete)} rotations with invalid trips."
+            f"Deleting {len(report.discontinuous_rotation_ids)} rotations with invalid trips."
+        )
+        _delete_trips(
+            session,
+            select(Trip.id).filter(
+                Trip.rotation_id.in_(report.discontinuous_rotation_ids)
+            ),
+            report,
         )
-    for rotation in rotations_to_delete:
-        for trip in rotation.trips:
-            for stop_time in trip.stop_times:
-                session.delete(stop_time)
-            for event in trip.events:
-                session.delete(event)
-            session.delete(trip)
-        session.delete(rotation)
+        report.deleted_rotations += session.execute(
+            delete(Rotation).where(Rotation.id.in_(report.discontinuous_rotation_ids))
+        ).rowcount
 
     # Also, delete all trips where their driving event has a negative energy consumption
-    for event in (
-        session.query(Event)
-        .filter(Event.scenario == scenario)
-        .filter(Event.event_type == EventType.DRIVING)
-        .filter(Event.soc_start <= Event.soc_end)
-    ):
+    report.negative_consumption_trip_ids = list(
+        session.scalars(
+            select(Event.trip_id)
+            .filter(Event.scenario_id == scenario.id)
+            .filter(Event.event_type == EventType.DRIVING)
+            .filter(Event.soc_start <= Event.soc_end)
+            .distinct()
+            .order_by(Event.trip_id)
+        )
+    )
+    if len(report.negative_consumption_trip_ids) > 0:
         logger.warning(
-            f"Deleting trip {event.trip.id} because it has a negative energy consumption."
+            f"Deleting trips {report.negative_consumption_trip_ids} because they have a negative energy consumption."
         )
-        for stop_time in event.trip.stop_times:
-            session.delete(stop_time)
-        trip = event.trip
-        for event in trip.events:
-            session.delete(event)
-        rotation = trip.rotation
-        rotation.trips.remove(trip)
-        session.delete(trip)
+        _delete_trips(
+            session,
+            select(Trip.id).filter(Trip.id.in_(report.negative_consumption_trip_ids)),
+            report,
+        )
+
+    # The DELETEs bypassed the ORM relationships, so already loaded trip collections may now be stale
+    _expire_loaded(scenario, session, Rotation, ["trips"])
+
+    return report
 
 
-def add_depot(scenario: Scenario, session: Session):
+def add_depot(
+    scenario: Scenario,
+    session: Session,
+    electric_power: float = DEPOT_CHARGING_POWER,
+    capacity: int = DEPOT_AREA_CAPACITY,
+):
     """
     Add ad depot at the station with the "DEP" name_short.
     :param scenario: The scenario to add the depot to.
     :param session: THe session to add the depot to.
+    :param electric_power: The charging power per vehicle in the charging area, in kW.
+    :param capacity: The number of vehicles each of the two areas can hold.
     :return: None
     """
     depot = Depot(
@@ -198,7 +439,7 @@ def add_depot(scenario: Scenario, session: Session):
         area_type=AreaType.DIRECT_ONESIDE,
         vehicle_type=None,
         name="Waiting area",
-        capacity=10,
+        capacity=capacity,
     )
     session.add(waiting_area)
 
@@ -213,7 +454,7 @@ def add_depot(scenario: Scenario, session: Session):
             .filter(VehicleType.name == "ElectricBus")
             .one(),
             name="Direct charging area",
-            capacity=10,
+            capacity=capacity,
         )
     session.add(charging_area)
 
@@ -227,7 +468,7 @@ def add_depot(scenario: Scenario, session: Session):
         scenario=scenario,
         name="Direct charging process",
         dispatchable=True,
-        electric_power=50,
+        electric_power=electric_power,
         areas=[charging_area],
     )
     session.add(charging_process)
@@ -259,75 +500,219 @@ def add_depot(scenario: Scenario, session: Session):
     session.add(plan)
 
 
-def fix_driving_events(scenario: Scenario, session: Session):
+def remove_depot(scenario: Scenario, session: Session) -> None:
+    """
+    Remove the depots of a scenario, e.g. the one added by :func:`add_depot`, together with their areas, processes,
+    plans and all events in the areas. Each table is cleared with a single DELETE.
+
+    :param scenario: The scenario to remove the depots from.
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.flush()
+    area_ids = select(Area.id).filter(Area.scenario_id == scenario.id)
+    session.execute(delete(Event).where(Event.area_id.in_(area_ids)))
+    session.execute(
+        delete(AssocPlanProcess).where(AssocPlanProcess.scenario_id == scenario.id)
+    )
+    session.execute(
+        delete(AssocAreaProcess).where(AssocAreaProcess.area_id.in_(area_ids))
+    )
+    session.execute(delete(Process).where(Process.scenario_id == scenario.id))
+    session.execute(delete(Area).where(Area.scenario_id == scenario.id))
+    session.execute(delete(Depot).where(Depot.scenario_id == scenario.id))
+    session.execute(delete(Plan).where(Plan.scenario_id == scenario.id))
+
+    # The statements above bypassed the ORM
+    for cls in [Event, AssocPlanProcess, Process, Area, Depot, Plan]:
+        _expire_loaded(scenario, session, cls)
+
+
+def _write_events(
+    session: Session, new_events: List[dict], updated_events: List[dict]
+) -> None:
+    """
+    Insert and update driving events in bulk, then empty the lists.
+
+    :param session: An SQLAlchemy session.
+    :param new_events: The rows of the events to insert.
+    :param updated_events: The ids and new values of the events to update.
+    :return: None
+    """
+    if len(new_events) > 0:
+        session.execute(insert(Event), new_events)
+    if len(updated_events) > 0:
+        session.execute(update(Event), updated_events)
+    new_events.clear()
+    updated_events.clear()
+
+
+def fix_driving_events(
+    scenario: Scenario, session: Session, chunk_size: int | None = None
+):
     """
     - add a driving event to the first trip of each rotation
     - assign all driving events to the same vehicle
     - add a driving event to the last trip of each rotation
 
+    All data is read with a few set-based queries. The vehicles and new events are inserted in bulk, and the SoC
+    chains of the existing events are written with a single bulk UPDATE.
+
     :param scenario:
     :param session:
+    :param chunk_size: If given, the trips are streamed from the database in chunks of this size, and the events are
+        written every time this many have been collected, so memory use does not grow with the number of trips.
     :return: Nothing
     """
 
     # In order to add the events to the trips, we calculate the average energy consumption of the vehicles
-    sum_of_energy = 0
-    sum_of_distance = 0
-    for event in (
-        session.query(Event)
-        .filter(Event.scenario == scenario)
+    sum_of_energy, sum_of_distance = session.execute(
+        select(
+            func.sum((Event.soc_start - Event.soc_end) * VehicleType.battery_capacity),
+            func.sum(Route.distance / 1000),  # convert to km
+        )
+        .join(VehicleType, Event.vehicle_type_id == VehicleType.id)
+        .join(Trip, Event.trip_id == Trip.id)
+        .join(Route, Trip.route_id == Route.id)
+        .filter(Event.scenario_id == scenario.id)
         .filter(Event.event_type == EventType.DRIVING)
-    ):
-        sum_of_energy += (
-            event.soc_start - event.soc_end
-        ) * event.vehicle_type.battery_capacity
-        sum_of_distance += event.trip.route.distance / 1000  # convert to km
-
+    ).one()
     average_energy_consumption = sum_of_energy / sum_of_distance
-    for rotation in session.query(Rotation).filter(Rotation.scenario == scenario):
-        # Create a new vehicle for each rotation
-        vehicle = Vehicle(
-            scenario=scenario,
-            name=f"Auto-Generated Vehicle for Rotation {rotation.id}",
-            name_short=f"V_{rotation.id}",
-            vehicle_type=session.query(VehicleType)
-            .filter(VehicleType.scenario == scenario)
-            .filter(VehicleType.name == "ElectricBus")
-            .one(),
+
+    vehicle_type = (
+        session.query(VehicleType)
+        .filter(VehicleType.scenario == scenario)
+        .filter(VehicleType.name == "ElectricBus")
+        .one()
+    )
+
+    rotations = session.execute(
+        select(Rotation.id, VehicleType.battery_capacity)
+        .join(VehicleType, Rotation.vehicle_type_id == VehicleType.id)
+        .filter(Rotation.scenario_id == scenario.id)
+        .order_by(Rotation.id)
+    ).all()
+    if len(rotations) == 0:
+        return
+
+    # Create a new vehicle for each rotation
+    vehicle_ids = session.scalars(
+        insert(Vehicle).returning(Vehicle.id, sort_by_parameter_order=True),
+        [
+            dict(
+                scenario_id=scenario.id,
+                name=f"Auto-Generated Vehicle for Rotation {rotation_id}",
+                name_short=f"V_{rotation_id}",
+                vehicle_type_id=vehicle_type.id,
+            )
+            for rotation_id, _ in rotations
+        ],
+    ).all()
+    vehicle_id_by_rotation = {
+        rotation_id: vehicle_id
+        for (rotation_id, _), vehicle_id in zip(rotations, vehicle_ids)
+    }
+    battery_capacity_by_rotation = dict(rotations)
+    session.execute(
+        update(Rotation),
+        [
+            dict(id=rotation_id, vehicle_id=vehicle_id)
+            for rotation_id, vehicle_id in vehicle_id_by_rotation.items()
+        ],
+    )
+
+    # All trips of the scenario with their (optional) driving event, in the order they are driven
+    trips_query = (
+        select(
+            Trip.id,
+            Trip.rotation_id,
+            Trip.departure_time,
+            Trip.arrival_time,
+            Route.distance,
+            Event.id,
+            Event.soc_start,
+            Event.soc_end,
         )
-        session.add(vehicle)
-        rotation.vehicle = vehicle
+        .join(Route, Trip.route_id == Route.id)
+        .outerjoin(
+            Event,
+            (Event.trip_id == Trip.id) & (Event.event_type == EventType.DRIVING),
+        )
+        .filter(Trip.scenario_id == scenario.id)
+        .order_by(Trip.rotation_id, Trip.departure_time)
+    )
+    if chunk_size is not None:
+        trips = session.execute(trips_query.execution_options(yield_per=chunk_size))
+    else:
+        trips = session.execute(trips_query).all()
 
-        soc_at_start_of_trip = 1
-        for i, trip in enumerate(rotation.trips):
+    new_events = []
+    updated_events = []
+    for rotation_id, rotation_trips in groupby(trips, key=lambda row: row[1]):
+        rotation_trips = list(rotation_trips)
+        if len(set(row[0] for row in rotation_trips)) != len(rotation_trips):
+            raise ValueError(f"A trip of rotation {rotation_id} has multiple events.")
+        vehicle_id = vehicle_id_by_rotation[rotation_id]
 
-            if i == 0 or i == len(rotation.trips) - 1:
-                assert len(trip.events) == 0
+        soc_at_start_of_trip = 1
+        for i, (
+            trip_id,
+            _,
+            departure_time,
+            arrival_time,
+            distance,
+            event_id,
+            soc_start,
+            soc_end,
+        ) in enumerate(rotation_trips):
+            if i == 0 or i == len(rotation_trips) - 1:
+                assert event_id is None
                 # The first or last trip of a rotation should not have a driving event, as it is an empty trip
                 # which we have just created
-                energy = (trip.route.distance / 1000) * average_energy_consumption
-                delta_soc = energy / rotation.vehicle_type.battery_capacity
+                energy = (distance / 1000) * average_energy_consumption
+                delta_soc = energy / battery_capacity_by_rotation[rotation_id]
                 soc_at_end_of_trip = soc_at_start_of_trip - delta_soc
-                event = Event(
-                    scenario=scenario,
-                    trip=trip,
-                    event_type=EventType.DRIVING,
-                    vehicle=vehicle,
-                    vehicle_type=vehicle.vehicle_type,
-                    time_start=trip.departure_time,
-                    time_end=trip.arrival_time,
-                    soc_start=soc_at_start_of_trip,
-                    soc_end=soc_at_end_of_trip,
+                new_events.append(
+                    dict(
+                        scenario_id=scenario.id,
+                        trip_id=trip_id,
+                        event_type=EventType.DRIVING,
+                        vehicle_id=vehicle_id,
+                        vehicle_type_id=vehicle_type.id,
+                        time_start=departure_time,
+                        time_end=arrival_time,
+                        soc_start=soc_at_start_of_trip,
+                        soc_end=soc_at_end_of_trip,
+                    )
                 )
-                session.add(event)
             else:
-                assert len(trip.events) == 1
-                event = trip.events[0]
-                event.vehicle = vehicle
-                delta_soc = event.soc_start - event.soc_end
+                assert event_id is not None
+                delta_soc = soc_start - soc_end
                 if delta_soc < 0:
-                    breakpoint()
-                event.soc_start = soc_at_start_of_trip
-                event.soc_end = soc_at_start_of_trip - delta_soc
-                session.merge(event)
-            soc_at_start_of_trip = event.soc_end
+                    raise ValueError(
+                        f"Trip {trip_id} has a negative energy consumption. "
+                        "It should have been removed by delete_invalid_rotations_and_trips()."
+                    )
+                soc_at_end_of_trip = soc_at_start_of_trip - delta_soc
+                updated_events.append(
+                    dict(
+                        id=event_id,
+                        vehicle_id=vehicle_id,
+                        soc_start=soc_at_start_of_trip,
+                        soc_end=soc_at_end_of_trip,
+                    )
+                )
+            soc_at_start_of_trip = soc_at_end_of_trip
+
+        if (
+            chunk_size is not None
+            and len(new_events) + len(updated_events) >= chunk_size
+        ):
+            _write_events(session, new_events, updated_events)
+
+    _write_events(session, new_events, updated_events)
+
+    # The statements above bypassed the ORM, so loaded rotations, events and event collections are now stale
+    _expire_loaded(scenario, session, Rotation)
+    _expire_loaded(scenario, session, Event)
+    _expire_loaded(scenario, session, Trip, ["events"])
@@ -1,26 +1,389 @@
+import hashlib
+import json
 import logging
-from datetime import timedelta
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
 
+import networkx as nx
 import sqlalchemy.orm
-from eflips.model import Scenario, Trip
+from eflips.model import Scenario, Trip, Route, Station, Rotation, VehicleType
 from eflips.opt.scheduling import create_graph, solve, write_back_rotation_plan
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+
+CACHE_FORMAT_VERSION = 1
+"""Increase this if the way rotation plans are stored in the cache changes."""
+
+
+def _canonical_trips(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session
+) -> Tuple[List[int], List[Tuple[str, str, str, str, str]]]:
+    """
+    Load the scheduling-relevant properties of all trips of a scenario in a scenario-independent, canonical order.
+
+    The trips are described by their times, their departure and arrival station names and the vehicle type name, as
+    these are all that :func:`create_graph` depends on. Trips that are equal in all of these are interchangeable.
+
+    :param scenario: The scenario to load the trips of.
+    :param session: An SQLAlchemy session.
+    :return: The trip ids and the trip descriptions, both in canonical order.
+    """
+    departure_station = aliased(Station)
+    arrival_station = aliased(Station)
+    rows = session.execute(
+        select(
+            Trip.id,
+            Trip.departure_time,
+            Trip.arrival_time,
+            departure_station.name,
+            arrival_station.name,
+            VehicleType.name,
+        )
+        .join(Route, Trip.route_id == Route.id)
+        .join(departure_station, Route.departure_station_id == departure_station.id)
+        .join(arrival_station, Route.arrival_station_id == arrival_station.id)
+        .join(Rotation, Trip.rotation_id == Rotation.id)
+        .join(VehicleType, Rotation.vehicle_type_id == VehicleType.id)
+        .filter(Trip.scenario_id == scenario.id)
+    ).all()
+
+    described = sorted(
+        (
+            (
+                departure_time.isoformat(),
+                arrival_time.isoformat(),
+                departure_name,
+                arrival_name,
+                vehicle_type_name,
+            ),
+            trip_id,
+        )
+        for (
+            trip_id,
+            departure_time,
+            arrival_time,
+            departure_name,
+            arrival_name,
+            vehicle_type_name,
+        ) in rows
+    )
+    return [trip_id for _, trip_id in described], [key for key, _ in described]
+
+
+@dataclass(frozen=True, slots=True)
+class _StationStub:
+    """The part of a :class:`Station` used by :func:`create_graph`. Stations are compared by id."""
+
+    id: int
+    name: str
+
+
+@dataclass(slots=True)
+class _RouteStub:
+    """The part of a :class:`Route` used by :func:`create_graph`."""
+
+    departure_station: _StationStub
+    arrival_station: _StationStub
+
+
+@dataclass(slots=True)
+class _TripStub:
+    """The part of a :class:`Trip` used by :func:`create_graph`."""
+
+    id: int
+    departure_time: datetime
+    arrival_time: datetime
+    route: _RouteStub
+
+
+def _stream_trips(
+    scenario: Scenario, session: sqlalchemy.orm.session.Session, chunk_size: int
+) -> List[_TripStub]:
+    """
+    Load the trips of a scenario as plain objects carrying only what :func:`create_graph` reads, instead of ORM
+    objects with their routes and stations in the session's identity map.
+
+    :param scenario: The scenario to load the trips of.
+    :param session: An SQLAlchemy session.
+    :param chunk_size: The number of rows fetched from the server-side cursor at a time.
+    :return: The trips.
+    """
+    departure_station = aliased(Station)
+    arrival_station = aliased(Station)
+    rows = session.execute(
+        select(
+            Trip.id,
+            Trip.departure_time,
+            Trip.arrival_time,
+            departure_station.id,
+            departure_station.name,
+            arrival_station.id,
+            arrival_station.name,
+        )
+        .join(Route, Trip.route_id == Route.id)
+        .join(departure_station, Route.departure_station_id == departure_station.id)
+        .join(arrival_station, Route.arrival_station_id == arrival_station.id)
+        .filter(Trip.scenario_id == scenario.id)
+        .execution_options(yield_per=chunk_size)
+    )
+
+    stations: Dict[int, _StationStub] = {}
+    routes: Dict[Tuple[int, int], _RouteStub] = {}
+    trips = []
+    for (
+        trip_id,
+        departure_time,
+        arrival_time,
+        departure_id,
+        departure_name,
+        arrival_id,
+        arrival_name,
+    ) in rows:
+        route = routes.get((departure_id, arrival_id))
+        if route is None:
+            route = _RouteStub(
+                stations.setdefault(
+                    departure_id, _StationStub(departure_id, departure_name)
+                ),
+                stations.setdefault(arrival_id, _StationStub(arrival_id, arrival_name)),
+            )
+            routes[(departure_id, arrival_id)] = route
+        trips.append(_TripStub(trip_id, departure_time, arrival_time, route))
+    return trips
+
+
+def scheduling_fingerprint(
+    trip_descriptions: List[Tuple[str, str, str, str, str]],
+    delta_socs: Dict[int, float] | None,
+    max_duration: timedelta | None,
+) -> str:
+    """
+    Identify a scheduling problem independently of the scenario it belongs to.
+
+    :param trip_descriptions: The canonical trip descriptions, see :func:`_canonical_trips`.
+    :param delta_socs: The energy consumption per trip passed to :func:`create_graph`, keyed by canonical position.
+    :param max_duration: The maximum schedule duration passed to :func:`create_graph`.
+    :return: A hex digest.
+    """
+    payload = json.dumps(
+        {
+            "version": CACHE_FORMAT_VERSION,
+            "trips": trip_descriptions,
+            "delta_socs": delta_socs,
+            "max_duration": (
+                max_duration.total_seconds() if max_duration is not None else None
+            ),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _load_cached_plan(cache_dir: str, fingerprint: str) -> List[List[int]] | None:
+    """
+    Load a rotation plan from the cache.
+
+    :param cache_dir: The cache directory.
+    :param fingerprint: The fingerprint of the scheduling problem.
+    :return: The rotations as lists of canonical trip positions, or None on a cache miss.
+    """
+    path = os.path.join(cache_dir, f"{fingerprint}.json")
+    try:
+        with open(path) as fp:
+            rotations = json.load(fp)["rotations"]
+        os.utime(path)  # Mark as recently used for the eviction
+    except FileNotFoundError:
+        # Not cached, or evicted by another process in the meantime
+        return None
+    return rotations
+
+
+def _store_plan(
+    cache_dir: str,
+    fingerprint: str,
+    rotations: List[List[int]],
+    max_size_bytes: int,
+) -> None:
+    """
+    Store a rotation plan in the cache, then evict the least recently used entries until the cache fits its size.
+    Several processes may store and evict entries at the same time: each writes to its own temporary file, which is
+    then renamed, and entries removed by another process are skipped.
+
+    :param cache_dir: The cache directory.
+    :param fingerprint: The fingerprint of the scheduling problem.
+    :param rotations: The rotations as lists of canonical trip positions.
+    :param max_size_bytes: The maximum total size of the cache.
+    :return: None
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{fingerprint}.json")
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_dir, suffix=".tmp", delete=False
+    ) as fp:
+        json.dump({"rotations": rotations}, fp)
+    try:
+        os.replace(fp.name, path)
+    except OSError:
+        os.remove(fp.name)
+        raise
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json"):
+            continue
+        entry = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(entry)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total_size <= max_size_bytes or entry == path:
+            break
+        total_size -= size
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+
+def _solve_decomposed(graph: nx.DiGraph, workers: int) -> nx.DiGraph:
+    """
+    Solve the scheduling problem by splitting it into the weakly connected components of the connection graph.
+
+    No rotation can contain trips from two different components, as there is no connection between them. The total
+    number of rotations and the total waiting time are therefore the sums over the components, and combining optimal
+    solutions of the components yields an optimal solution of the whole problem. The components are packed into
+    roughly equally sized batches, which are solved in a process pool.
+
+    :param graph: The connection graph, as created by :func:`create_graph`.
+    :param workers: The number of worker processes.
+    :return: The rotation plan, in the same form as returned by :func:`solve`.
+    """
+    logger = logging.getLogger(__name__)
+    components = sorted(nx.weakly_connected_components(graph), key=len, reverse=True)
+
+    # Trips without any connection form rotations of their own and need no solving
+    rotation_plan = nx.DiGraph()
+    rotation_plan.add_nodes_from(
+        (node, graph.nodes[node])
+        for component in components
+        if len(component) == 1
+        for node in component
+    )
+    components = [component for component in components if len(component) > 1]
+
+    # Greedily assign the largest remaining component to the smallest batch
+    batches: List[List[int]] = [[] for _ in range(min(workers * 4, len(components)))]
+    for component in components:
+        min(batches, key=len).extend(component)
+    subgraphs = [graph.subgraph(batch).copy() for batch in batches]
+    logger.info(
+        f"Solving {len(components)} independent subproblems in {len(subgraphs)} batches "
+        f"with {workers} workers"
+    )
+
+    if len(subgraphs) > 0:
+        with ProcessPoolExecutor(
+            max_workers=max(min(workers, len(subgraphs)), 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            for result in executor.map(solve, subgraphs):
+                rotation_plan = nx.compose(rotation_plan, result)
+    return rotation_plan
 
 
 def do_scheduling(
     scenario: Scenario,
     session: sqlalchemy.orm.session.Session,
     max_duration: timedelta | None = None,
+    cache_dir: str | None = None,
+    cache_max_size_mb: float = 100,
+    decompose: bool = False,
+    workers: int = 1,
+    chunk_size: int | None = None,
 ):
+    """
+    Create a new rotation plan for a scenario and write it back to the database.
+
+    :param scenario: The scenario to schedule.
+    :param session: An SQLAlchemy session.
+    :param max_duration: The maximum duration of a rotation. None for unlimited.
+    :param cache_dir: If given, rotation plans are cached in this directory, keyed by the trip set and the scheduling
+        parameters. On a cache hit, the stored plan is written back without building the graph or calling the
+        solver. This also lets scenarios with identical trips (e.g. clones) share a solution.
+    :param cache_max_size_mb: The size of the cache directory beyond which the least recently used plans are removed.
+    :param decompose: If True, the connection graph is split into its independent parts, which are solved in
+        parallel. See :func:`_solve_decomposed`.
+    :param workers: The number of worker processes used if `decompose` is True.
+    :param chunk_size: If given, the trips are streamed in chunks of this size into lightweight objects for building
+        the graph, instead of being loaded into the session as ORM objects. See :func:`_stream_trips`.
+    :return: None
+    """
     logger = logging.getLogger(__name__)
-    trips = session.query(Trip).filter(Trip.scenario == scenario).all()
+    delta_socs = None
+
+    if cache_dir is not None:
+        trip_ids, trip_descriptions = _canonical_trips(scenario, session)
+        fingerprint = scheduling_fingerprint(
+            trip_descriptions, delta_socs, max_duration
+        )
+        cached_rotations = _load_cached_plan(cache_dir, fingerprint)
+        if cached_rotations is not None:
+            logger.info(
+                f"Using cached rotation plan {fingerprint[:12]} for scenario {scenario.name}"
+            )
+            rotation_plan = nx.DiGraph()
+            rotation_plan.add_nodes_from(trip_ids)
+            for rotation in cached_rotations:
+                rotation_plan.add_edges_from(
+                    (trip_ids[a], trip_ids[b]) for a, b in zip(rotation, rotation[1:])
+                )
+            write_back_rotation_plan(rotation_plan, session)
+            logger.info(f"Rotation plan written back for scenario {scenario.name}")
+            return
+
+    if chunk_size is not None:
+        trips = _stream_trips(scenario, session, chunk_size)
+    else:
+        trips = session.query(Trip).filter(Trip.scenario == scenario).all()
     logger.info(f"Creating graph for scenario {scenario.name}")
     graph = create_graph(
         trips,
-        delta_socs=None,
+        delta_socs=delta_socs,
         maximum_schedule_duration=max_duration,
     )
     logger.info(f"Solving scenario {scenario.name}")
-    rotation_plan = solve(graph, write_to_file=True)
+    if decompose:
+        rotation_plan = _solve_decomposed(graph, workers)
+    else:
+        rotation_plan = solve(graph, write_to_file=True)
+
+    if cache_dir is not None:
+        departure_time_by_id = {trip.id: trip.departure_time for trip in trips}
+        position_by_id = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        rotations = [
+            [
+                position_by_id[trip_id]
+                for trip_id in sorted(component, key=departure_time_by_id.get)
+            ]
+            for component in nx.connected_components(rotation_plan.to_undirected())
+        ]
+        try:
+            _store_plan(
+                cache_dir, fingerprint, rotations, int(cache_max_size_mb * 1024 * 1024)
+            )
+        except OSError as e:
+            # The plan is written back regardless, only later runs miss the cache
+            logger.warning(f"Could not store rotation plan {fingerprint[:12]}: {e}")
+
     logger.info(f"Starting write back for scenario {scenario.name}")
     write_back_rotation_plan(rotation_plan, session)
     logger.info(f"Rotation plan written back for scenario {scenario.name}")
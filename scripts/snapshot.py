@@ -0,0 +1,183 @@
+import json
+import logging
+import time
+from importlib.metadata import version
+
+import psycopg2
+import psycopg2.errors
+from psycopg2 import sql
+from sqlalchemy.engine import make_url
+
+from scripts import database, util
+
+
+def snapshot_fingerprint(dump_path: str) -> str:
+    """
+    Describe the inputs a snapshot was created from. A snapshot is only valid as long as neither the dump nor the
+    eflips-model version (and thus the database schema) have changed.
+
+    :param dump_path: The path to the database dump.
+    :return: A JSON string identifying the dump and the schema version.
+    """
+    return json.dumps(
+        {
+            "dump_hash": util.dump_hash(dump_path),
+            "eflips_model": version("eflips-model"),
+        },
+        sort_keys=True,
+    )
+
+
+def snapshot_name(database_url: str, stage: str) -> str:
+    """
+    The name of the template database holding a snapshot.
+
+    :param database_url: The URL of the database the snapshot is taken of.
+    :param stage: The pipeline stage after which the snapshot was taken, e.g. "import".
+    :return: The name of the snapshot database.
+    """
+    return f"{make_url(database_url).database}_snapshot_{stage}"
+
+
+def _maintenance_connection(database_url: str):
+    """
+    Opens an autocommit connection to the "postgres" maintenance database, as databases cannot be created or dropped
+    from within a transaction or while connected to them.
+
+    :param database_url: The URL of the project database.
+    :return: A psycopg2 connection.
+    """
+    url = make_url(database_url).set(database="postgres")
+    conn = psycopg2.connect(url.render_as_string(hide_password=False))
+    conn.autocommit = True
+    return conn
+
+
+def _snapshot_comment(cur, name: str) -> str | None:
+    """
+    Read the fingerprint stored as the comment of a snapshot database.
+
+    :param cur: A cursor on the maintenance database.
+    :param name: The name of the snapshot database.
+    :return: The fingerprint, an empty string if there is no comment, or None if the database does not exist.
+    """
+    cur.execute(
+        "SELECT shobj_description(oid, 'pg_database') FROM pg_database WHERE datname = %s",
+        (name,),
+    )
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row[0] or ""
+
+
+def save_snapshot(database_url: str, stage: str, fingerprint: str) -> None:
+    """
+    Save the current state of the database as a template database. An existing snapshot of the same stage is
+    replaced. PostgreSQL only copies a database without other open sessions, so the pooled connections of this
+    process are closed first. If the database user lacks the `CREATEDB` privilege or another process is still
+    connected, a warning is logged and no snapshot is saved.
+
+    :param database_url: The URL of the database to snapshot.
+    :param stage: The pipeline stage after which the snapshot is taken.
+    :param fingerprint: The result of :func:`snapshot_fingerprint` for the current inputs.
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+    name = snapshot_name(database_url, stage)
+    database.dispose_engines()
+    conn = _maintenance_connection(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name))
+            )
+            try:
+                cur.execute(
+                    sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(
+                        sql.Identifier(name),
+                        sql.Identifier(make_url(database_url).database),
+                    )
+                )
+            except psycopg2.errors.InsufficientPrivilege as e:
+                logger.warning(
+                    f"Not saving snapshot {name}, the database user needs the CREATEDB privilege: {e}"
+                )
+                return
+            except psycopg2.errors.ObjectInUse as e:
+                logger.warning(
+                    f"Not saving snapshot {name}, other sessions are connected to the database: {e}"
+                )
+                return
+            cur.execute(
+                sql.SQL("COMMENT ON DATABASE {} IS {}").format(
+                    sql.Identifier(name), sql.Literal(fingerprint)
+                )
+            )
+    finally:
+        conn.close()
+    logger.info(f"Saved snapshot {name} in {time.perf_counter() - start:.1f}s")
+
+
+def restore_snapshot(database_url: str, stage: str, fingerprint: str) -> bool:
+    """
+    Replace the database with a clone of a snapshot, if a snapshot for the given stage exists and was created from
+    the same inputs. A snapshot created from different inputs is dropped.
+
+    The clone is created under a temporary name first, and only renamed after the database has been dropped, so the
+    database is kept if the clone cannot be created. If the database user lacks the privileges to create the clone or
+    to drop the database, a warning is logged and the database is left unchanged.
+
+    :param database_url: The URL of the database to reset.
+    :param stage: The pipeline stage of the snapshot to restore.
+    :param fingerprint: The result of :func:`snapshot_fingerprint` for the current inputs.
+    :return: True if the snapshot was restored, False if there is no valid snapshot.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+    name = snapshot_name(database_url, stage)
+    conn = _maintenance_connection(database_url)
+    try:
+        with conn.cursor() as cur:
+            comment = _snapshot_comment(cur, name)
+            if comment is None:
+                return False
+            if comment != fingerprint:
+                logger.info(f"Dropping outdated snapshot {name}")
+                cur.execute(sql.SQL("DROP DATABASE {}").format(sql.Identifier(name)))
+                return False
+
+            target = make_url(database_url).database
+            staging = f"{target}_restoring"
+            cur.execute(
+                sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(staging))
+            )
+            try:
+                cur.execute(
+                    sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(
+                        sql.Identifier(staging), sql.Identifier(name)
+                    )
+                )
+            except psycopg2.errors.InsufficientPrivilege as e:
+                logger.warning(f"Cannot restore snapshot {name}: {e}")
+                return False
+            try:
+                cur.execute(
+                    sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(
+                        sql.Identifier(target)
+                    )
+                )
+            except psycopg2.errors.InsufficientPrivilege as e:
+                logger.warning(f"Cannot restore snapshot {name}: {e}")
+                cur.execute(sql.SQL("DROP DATABASE {}").format(sql.Identifier(staging)))
+                return False
+            cur.execute(
+                sql.SQL("ALTER DATABASE {} RENAME TO {}").format(
+                    sql.Identifier(staging), sql.Identifier(target)
+                )
+            )
+    finally:
+        conn.close()
+    logger.info(f"Restored snapshot {name} in {time.perf_counter() - start:.1f}s")
+    return True
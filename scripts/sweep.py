@@ -0,0 +1,355 @@
+import itertools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, fields
+from datetime import timedelta
+from typing import Dict, List, Tuple
+
+import eflips.eval.output.prepare
+import pandas as pd
+import sqlalchemy.orm
+from eflips.depot.api import SmartChargingStrategy, simulate_scenario
+from eflips.model import Area, Depot, Event, Scenario
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from scripts import database
+from scripts.clone import clone_scenario, delete_scenario
+from scripts.feasibility import check_energy_feasibility
+from scripts.pipeline import (
+    REPETITION_PERIOD,
+    scheduling_max_duration,
+    streaming_chunk_size,
+)
+from scripts.prepare import (
+    BREAK_DURATION,
+    DEPOT_AREA_CAPACITY,
+    DEPOT_CHARGING_POWER,
+    DEPOT_TRIP_DURATION,
+    add_depot,
+    add_empty_trips,
+    delete_invalid_rotations_and_trips,
+    fix_driving_events,
+)
+from scripts.scheduling import do_scheduling
+
+SUMMARY_NAME = "sweep_summary.csv"
+
+
+@dataclass(frozen=True)
+class SweepPoint:
+    """
+    One set of parameters of a parameter sweep. Omitted parameters keep the values of the regular pipeline, see
+    :func:`sweep_points`.
+    """
+
+    depot_power: float = DEPOT_CHARGING_POWER
+    """The charging power per vehicle in the depot, in kW."""
+
+    depot_capacity: int = DEPOT_AREA_CAPACITY
+    """The number of vehicles each depot area can hold."""
+
+    max_duration_hours: float = -1
+    """The maximum rotation duration for the scheduling. 0 for unlimited, negative for the base scenario's default."""
+
+    break_minutes: float = BREAK_DURATION.total_seconds() / 60
+    """The break between an empty trip and the first or last passenger trip."""
+
+    depot_trip_minutes: float = DEPOT_TRIP_DURATION.total_seconds() / 60
+    """The duration of an empty trip."""
+
+    smart_charging: str = "NONE"
+    """The name of a :class:`SmartChargingStrategy`."""
+
+    def preparation_key(self) -> Tuple[float, float, float]:
+        """
+        :return: The parameters that are applied before the depot is added. Points with the same key share one
+            prepared scenario.
+        """
+        return self.max_duration_hours, self.break_minutes, self.depot_trip_minutes
+
+
+def sweep_points(config: dict) -> List[SweepPoint]:
+    """
+    The points of the parameter sweep described in the `[sweep]` section of config.toml: every combination of the
+    values in `[sweep.grid]`, followed by each explicit `[[sweep.points]]` entry. Omitted depot parameters are taken
+    from the `[depot]` section.
+
+    :param config: The parsed contents of config.toml.
+    :return: The sweep points, without duplicates.
+    """
+    names = [field.name for field in fields(SweepPoint)]
+    for entry in [config["sweep"].get("grid", {})] + config["sweep"].get("points", []):
+        unknown = set(entry) - set(names)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown sweep parameters: {sorted(unknown)}")
+
+    defaults = dict(
+        depot_power=config["depot"]["electric_power"],
+        depot_capacity=config["depot"]["capacity"],
+    )
+    points = []
+    grid = config["sweep"].get("grid", {})
+    if len(grid) > 0:
+        for values in itertools.product(*grid.values()):
+            points.append(SweepPoint(**{**defaults, **dict(zip(grid.keys(), values))}))
+    points.extend(
+        SweepPoint(**{**defaults, **entry})
+        for entry in config["sweep"].get("points", [])
+    )
+    return list(dict.fromkeys(points))
+
+
+def _prepare_worker(
+    base_scenario_id: int,
+    index: int,
+    key: Tuple[float, float, float],
+    database_url: str,
+    config: dict,
+) -> int:
+    """
+    Clone the base scenario and run the stages before the depot is added, with the parameters of a preparation key.
+    The prepared scenario is committed, so the simulation workers can clone it.
+
+    :param base_scenario_id: The id of the unprocessed base scenario.
+    :param index: The number of the preparation group, used in the scenario name.
+    :param key: The preparation parameters, see :meth:`SweepPoint.preparation_key`.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml.
+    :return: The id of the prepared scenario.
+    """
+    logging.basicConfig(level=config["logging"]["level"])
+    max_duration_hours, break_minutes, depot_trip_minutes = key
+
+    database.configure_engines(config)
+    engine = database.get_engine(database_url)
+    try:
+        with Session(engine) as session:
+            base = session.query(Scenario).filter(Scenario.id == base_scenario_id).one()
+            if max_duration_hours < 0:
+                max_duration = scheduling_max_duration(base.name_short)
+            elif max_duration_hours == 0:
+                max_duration = None
+            else:
+                max_duration = timedelta(hours=max_duration_hours)
+
+            (scenario,) = clone_scenario(base, session)
+            scenario.name = f"{base.name} (sweep preparation {index})"
+            scenario.name_short = f"{base.name_short}_SWEEP_PREP{index}"
+            session.flush()
+
+            chunk_size = streaming_chunk_size(config)
+            do_scheduling(
+                scenario,
+                session,
+                max_duration,
+                cache_dir=(
+                    config["scheduling"]["cache_dir"]
+                    if config["scheduling"]["cache"]
+                    else None
+                ),
+                cache_max_size_mb=config["scheduling"]["cache_max_size_mb"],
+                chunk_size=chunk_size,
+            )
+            add_empty_trips(
+                scenario,
+                session,
+                chunk_size=chunk_size,
+                break_duration=timedelta(minutes=break_minutes),
+                depot_trip_duration=timedelta(minutes=depot_trip_minutes),
+            )
+            delete_invalid_rotations_and_trips(scenario, session)
+            fix_driving_events(scenario, session, chunk_size=chunk_size)
+            check_energy_feasibility(
+                scenario,
+                session,
+                min_soc=config["feasibility"]["min_soc"],
+                split=config["feasibility"]["split"],
+            )
+            session.commit()
+            return scenario.id
+    finally:
+        database.dispose_engines()
+
+
+def summarize(scenario: Scenario, session: sqlalchemy.orm.session.Session) -> Dict:
+    """
+    The key figures of a simulated scenario.
+
+    :param scenario: The simulated scenario.
+    :param session: An SQLAlchemy session.
+    :return: The peak depot power in kW, the number of vehicles and the lowest SoC of any vehicle.
+    """
+    vehicle_count, min_soc = session.execute(
+        select(
+            func.count(Event.vehicle_id.distinct()),
+            func.min(func.least(Event.soc_start, Event.soc_end)),
+        ).filter(Event.scenario_id == scenario.id)
+    ).one()
+    area_ids = session.scalars(
+        select(Area.id)
+        .join(Depot, Area.depot_id == Depot.id)
+        .filter(Depot.scenario_id == scenario.id)
+        .filter(
+            Area.id.in_(select(Event.area_id).filter(Event.scenario_id == scenario.id))
+        )
+    ).all()
+    peak_power = (
+        eflips.eval.output.prepare.power_and_occupancy(area_ids, session)["power"].max()
+        if len(area_ids) > 0
+        else 0.0
+    )
+    return dict(
+        peak_power_kw=float(peak_power),
+        vehicle_count=vehicle_count,
+        min_soc=min_soc,
+    )
+
+
+def _simulate_worker(
+    prepared_scenario_id: int,
+    index: int,
+    point: SweepPoint,
+    database_url: str,
+    config: dict,
+) -> Dict:
+    """
+    Clone a prepared scenario, add the depot and simulate it with the parameters of a sweep point.
+
+    :param prepared_scenario_id: The id of the scenario prepared for the point's preparation key.
+    :param index: The number of the sweep point, used in the scenario name.
+    :param point: The sweep point.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml.
+    :return: The summary of the simulated scenario, see :func:`summarize`.
+    """
+    logging.basicConfig(level=config["logging"]["level"])
+
+    database.configure_engines(config)
+    engine = database.get_engine(database_url)
+    try:
+        with Session(engine) as session:
+            prepared = (
+                session.query(Scenario)
+                .filter(Scenario.id == prepared_scenario_id)
+                .one()
+            )
+            (scenario,) = clone_scenario(prepared, session)
+            scenario.name = f"{prepared.name} (sweep point {index})"
+            scenario.name_short = f"{prepared.parent.name_short}_SWEEP{index}"
+            session.flush()
+
+            add_depot(
+                scenario,
+                session,
+                electric_power=point.depot_power,
+                capacity=point.depot_capacity,
+            )
+            simulate_scenario(
+                scenario,
+                repetition_period=REPETITION_PERIOD,
+                smart_charging_strategy=SmartChargingStrategy[point.smart_charging],
+            )
+            summary = summarize(scenario, session)
+            if config["sweep"]["keep_scenarios"]:
+                session.commit()
+            else:
+                session.rollback()
+            return summary
+    finally:
+        database.dispose_engines()
+
+
+def run_sweep(base_scenario_id: int, database_url: str, config: dict) -> pd.DataFrame:
+    """
+    Run the parameter sweep of the `[sweep]` section of config.toml on a committed, unprocessed scenario.
+
+    The base scenario is cloned and prepared (scheduling, empty trips, validation, driving events, feasibility check)
+    once per distinct combination of the preparation parameters. Each sweep point then clones its prepared scenario,
+    adds the depot and runs the simulation. Both steps run in a process pool with `sweep.workers` processes. Unless
+    `sweep.keep_scenarios` is set, the simulated clones are not committed. The prepared scenarios are deleted at the
+    end, also if points failed, and kept clones become children of the base scenario.
+
+    :param base_scenario_id: The id of the scenario to sweep over.
+    :param database_url: The database URL to connect to.
+    :param config: The parsed contents of config.toml.
+    :return: One row per sweep point with its parameters, the key figures from :func:`summarize` and the error of a
+        failed point. The table is also written to `sweep_summary.csv` in the output directory.
+    """
+    logger = logging.getLogger(__name__)
+    points = sweep_points(config)
+    keys = list(dict.fromkeys(point.preparation_key() for point in points))
+    logger.info(f"Sweeping {len(points)} points with {len(keys)} distinct preparations")
+
+    errors: Dict[int, str] = {}
+    summaries: Dict[int, Dict] = {}
+    prepared_ids: Dict[Tuple[float, float, float], int] = {}
+    try:
+        # "spawn" makes sure no database connections from the parent are inherited by the workers
+        with ProcessPoolExecutor(
+            max_workers=config["sweep"]["workers"],
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _prepare_worker, base_scenario_id, i, key, database_url, config
+                ): key
+                for i, key in enumerate(keys)
+            }
+            for future in as_completed(futures):
+                try:
+                    prepared_ids[futures[future]] = future.result()
+                except Exception as e:
+                    logger.error(f"Preparation {futures[future]} failed: {e!r}")
+                    for i, point in enumerate(points):
+                        if point.preparation_key() == futures[future]:
+                            errors[i] = repr(e)
+
+            futures = {
+                executor.submit(
+                    _simulate_worker,
+                    prepared_ids[point.preparation_key()],
+                    i,
+                    point,
+                    database_url,
+                    config,
+                ): i
+                for i, point in enumerate(points)
+                if point.preparation_key() in prepared_ids
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    summaries[i] = future.result()
+                    logger.info(f"Sweep point {i} ({points[i]}): {summaries[i]}")
+                except Exception as e:
+                    logger.error(f"Sweep point {i} ({points[i]}) failed: {e!r}")
+                    errors[i] = repr(e)
+    finally:
+        if len(prepared_ids) > 0:
+            with Session(database.get_engine(database_url)) as session:
+                for prepared_id in prepared_ids.values():
+                    delete_scenario(prepared_id, session, reparent_to=base_scenario_id)
+                session.commit()
+            database.dispose_engines()
+
+    summary = pd.DataFrame(
+        [
+            dict(
+                point=i,
+                **asdict(point),
+                **summaries.get(
+                    i, dict(peak_power_kw=None, vehicle_count=None, min_soc=None)
+                ),
+                error=errors.get(i),
+            )
+            for i, point in enumerate(points)
+        ]
+    )
+    os.makedirs(config["paths"]["output_dir"], exist_ok=True)
+    summary.to_csv(
+        os.path.join(config["paths"]["output_dir"], SUMMARY_NAME), index=False
+    )
+    return summary
@@ -0,0 +1,266 @@
+import logging
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import sqlalchemy.orm
+from eflips.model import (
+    AssocRouteStation,
+    Event,
+    EventType,
+    Line,
+    Rotation,
+    Route,
+    Scenario,
+    Station,
+    StopTime,
+    Trip,
+    TripType,
+    VehicleType,
+)
+from sqlalchemy import insert
+
+from scripts.prepare import TERMINAL_NAME
+
+TERMINAL_LATLON = (35.04383, 135.75872)
+BASE_LINES = 12
+"""The number of lines at scale 1. Larger scales add lines, so the headways and rotation lengths stay realistic."""
+
+SERVICE_DAY = datetime(2024, 4, 1, tzinfo=ZoneInfo("Asia/Tokyo"))
+SERVICE_START = timedelta(hours=5, minutes=30)
+SERVICE_END = timedelta(hours=23)
+AVERAGE_SPEED = 18  # km/h, including stops
+LAYOVER = timedelta(minutes=8)
+
+
+def _outer_station_latlon(
+    line_index: int, line_count: int, radius: float
+) -> tuple[float, float]:
+    """
+    The position of the outer terminus of a line. The lines are spread out in a star around the terminal.
+
+    :param line_index: The index of the line.
+    :param line_count: The total number of lines.
+    :param radius: The distance from the terminal, in meters.
+    :return: A (latitude, longitude) pair.
+    """
+    angle = 2 * math.pi * line_index / line_count
+    latitude = TERMINAL_LATLON[0] + radius * math.cos(angle) / 111_320
+    longitude = TERMINAL_LATLON[1] + radius * math.sin(angle) / (
+        111_320 * math.cos(math.radians(TERMINAL_LATLON[0]))
+    )
+    return latitude, longitude
+
+
+def generate_scenario(
+    session: sqlalchemy.orm.session.Session, scale: float = 1, seed: int = 0
+) -> Scenario:
+    """
+    Create a synthetic scenario shaped like the Kyoto dataset, for benchmarking the pipeline at different sizes.
+
+    Like the imported data, the scenario has a single "ElectricBus" vehicle type, a terminal station named
+    :data:`scripts.prepare.TERMINAL_NAME` and trips with a DRIVING event each, but no vehicles and no depot. All lines
+    run back and forth between the terminal and an outer terminus over one service day. The rows are written with bulk
+    INSERTs, and nothing is committed.
+
+    :param session: An SQLAlchemy session.
+    :param scale: The size relative to the base network of :data:`BASE_LINES` lines. The number of trips grows
+        proportionally.
+    :param seed: The seed for the random route lengths, headways and consumptions. The same seed and scale always
+        produce the same timetable.
+    :return: The new scenario.
+    """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    line_count = max(1, round(BASE_LINES * scale))
+
+    scenario = Scenario(name=f"Synthetic Kyoto x{scale:g}", name_short=f"SYN{scale:g}")
+    session.add(scenario)
+    vehicle_type = VehicleType(
+        scenario=scenario,
+        name="ElectricBus",
+        name_short="EB",
+        battery_capacity=300,
+        battery_capacity_reserve=0,
+        charging_curve=[[0, 150], [1, 150]],
+        opportunity_charging_capable=True,
+        consumption=None,
+    )
+    session.add(vehicle_type)
+    session.flush()
+
+    # One outer terminus per line, with the terminal shared by all of them
+    radii = [rng.uniform(3000, 12000) for _ in range(line_count)]
+    station_rows = [
+        dict(
+            scenario_id=scenario.id,
+            name=TERMINAL_NAME,
+            name_short="TERM",
+            geom=f"SRID=4326;POINT({TERMINAL_LATLON[1]} {TERMINAL_LATLON[0]} 0)",
+            is_electrified=False,
+        )
+    ]
+    for i, radius in enumerate(radii):
+        latitude, longitude = _outer_station_latlon(i, line_count, radius)
+        station_rows.append(
+            dict(
+                scenario_id=scenario.id,
+                name=f"Synthetic terminus {i + 1}",
+                name_short=f"S{i + 1}",
+                geom=f"SRID=4326;POINT({longitude} {latitude} 0)",
+                is_electrified=False,
+            )
+        )
+    station_ids = session.scalars(
+        insert(Station).returning(Station.id, sort_by_parameter_order=True),
+        station_rows,
+    ).all()
+    terminal_id, outer_station_ids = station_ids[0], station_ids[1:]
+
+    line_ids = session.scalars(
+        insert(Line).returning(Line.id, sort_by_parameter_order=True),
+        [
+            dict(scenario_id=scenario.id, name=f"Line {i + 1}", name_short=str(i + 1))
+            for i in range(line_count)
+        ],
+    ).all()
+
+    # An outbound and an inbound route per line. The road distance is a detour factor above the straight line.
+    route_rows = []
+    for i, (line_id, outer_station_id, radius) in enumerate(
+        zip(line_ids, outer_station_ids, radii)
+    ):
+        distance = round(radius * rng.uniform(1.2, 1.5))
+        for direction, (departure_id, arrival_id) in enumerate(
+            [(terminal_id, outer_station_id), (outer_station_id, terminal_id)]
+        ):
+            route_rows.append(
+                dict(
+                    scenario_id=scenario.id,
+                    departure_station_id=departure_id,
+                    arrival_station_id=arrival_id,
+                    line_id=line_id,
+                    name=f"Line {i + 1} {'outbound' if direction == 0 else 'inbound'}",
+                    name_short=f"{i + 1}{'O' if direction == 0 else 'I'}",
+                    distance=distance,
+                )
+            )
+    route_ids = session.scalars(
+        insert(Route).returning(Route.id, sort_by_parameter_order=True), route_rows
+    ).all()
+    session.execute(
+        insert(AssocRouteStation),
+        [
+            dict(
+                scenario_id=scenario.id,
+                route_id=route_id,
+                station_id=station_id,
+                elapsed_distance=elapsed_distance,
+            )
+            for route_id, row in zip(route_ids, route_rows)
+            for station_id, elapsed_distance in [
+                (row["departure_station_id"], 0),
+                (row["arrival_station_id"], row["distance"]),
+            ]
+        ],
+    )
+
+    # The imported data comes with one rotation per line, which fixup_rotations replaces
+    rotation_ids = session.scalars(
+        insert(Rotation).returning(Rotation.id, sort_by_parameter_order=True),
+        [
+            dict(
+                scenario_id=scenario.id,
+                vehicle_type_id=vehicle_type.id,
+                allow_opportunity_charging=True,
+                name=f"Line {i + 1}",
+            )
+            for i in range(line_count)
+        ],
+    ).all()
+
+    trip_rows = []
+    consumptions = []  # kWh/km
+    for i, rotation_id in enumerate(rotation_ids):
+        outbound, inbound = route_rows[2 * i], route_rows[2 * i + 1]
+        outbound_id, inbound_id = route_ids[2 * i], route_ids[2 * i + 1]
+        run_time = timedelta(
+            minutes=math.ceil(outbound["distance"] / 1000 / AVERAGE_SPEED * 60)
+        )
+        headway = timedelta(minutes=rng.choice([10, 12, 15, 20, 30]))
+        departure = SERVICE_DAY + SERVICE_START + timedelta(minutes=rng.randrange(15))
+        while departure + 2 * run_time + LAYOVER <= SERVICE_DAY + SERVICE_END:
+            inbound_departure = departure + run_time + LAYOVER
+            for route_id, route, trip_departure in [
+                (outbound_id, outbound, departure),
+                (inbound_id, inbound, inbound_departure),
+            ]:
+                trip_rows.append(
+                    dict(
+                        scenario_id=scenario.id,
+                        route_id=route_id,
+                        rotation_id=rotation_id,
+                        departure_time=trip_departure,
+                        arrival_time=trip_departure + run_time,
+                        trip_type=TripType.PASSENGER,
+                    )
+                )
+                consumptions.append(rng.uniform(1.0, 1.6))
+            departure += headway
+    route_by_id = dict(zip(route_ids, route_rows))
+
+    trip_ids = session.scalars(
+        insert(Trip).returning(Trip.id, sort_by_parameter_order=True), trip_rows
+    ).all()
+    session.execute(
+        insert(StopTime),
+        [
+            dict(
+                scenario_id=scenario.id,
+                station_id=station_id,
+                trip_id=trip_id,
+                arrival_time=arrival_time,
+                dwell_duration=timedelta(0),
+            )
+            for trip_id, row in zip(trip_ids, trip_rows)
+            for station_id, arrival_time in [
+                (
+                    route_by_id[row["route_id"]]["departure_station_id"],
+                    row["departure_time"],
+                ),
+                (
+                    route_by_id[row["route_id"]]["arrival_station_id"],
+                    row["arrival_time"],
+                ),
+            ]
+        ],
+    )
+    session.execute(
+        insert(Event),
+        [
+            dict(
+                scenario_id=scenario.id,
+                trip_id=trip_id,
+                vehicle_type_id=vehicle_type.id,
+                event_type=EventType.DRIVING,
+                time_start=row["departure_time"],
+                time_end=row["arrival_time"],
+                soc_start=1,
+                soc_end=1
+                - route_by_id[row["route_id"]]["distance"]
+                / 1000
+                * consumption
+                / vehicle_type.battery_capacity,
+            )
+            for trip_id, row, consumption in zip(trip_ids, trip_rows, consumptions)
+        ],
+    )
+
+    logger.info(
+        f"Generated scenario {scenario.name} with {line_count} lines and {len(trip_rows)} trips "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return scenario
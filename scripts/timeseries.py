@@ -0,0 +1,127 @@
+from datetime import timedelta
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+PERCENTILES = [5, 25, 50, 75, 95]
+"""The percentiles of the fleet SoC shown as bands in the fleet overview."""
+
+
+def _time_ns(times: pd.Series) -> np.ndarray:
+    """
+    Convert a series of timezone-aware timestamps to nanoseconds since the epoch.
+
+    :param times: The timestamps.
+    :return: An int64 array.
+    """
+    return times.dt.as_unit("ns").astype("int64").to_numpy()
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Select the points of a series to keep with the Largest-Triangle-Three-Buckets algorithm. The first and last
+    points are always kept. The points in between are split into `threshold - 2` buckets, and from each bucket the
+    point forming the largest triangle with the point kept from the previous bucket and the average of the next
+    bucket is kept. Unlike taking every n-th point, this keeps the peaks and dips of the series.
+
+    The bucket averages are computed for all buckets at once, the triangle areas for all points of a bucket at once.
+
+    :param x: The x values, sorted ascending.
+    :param y: The y values.
+    :param threshold: The number of points to keep.
+    :return: The sorted indices of the points to keep. All indices if the series has at most `threshold` points.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = x.astype(float)
+    y = y.astype(float)
+
+    # Bucket i holds the points edges[i] to edges[i + 1] - 1. The last point is not part of any bucket.
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[: n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[: n - 1], edges[:-1]) / counts
+    # The triangles of the last bucket end at the last point
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y[i] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_soc(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """
+    Reduce the SoC time series of a vehicle to at most `max_points` points with :func:`lttb_indices`.
+
+    :param df: The SoC time series with "time" and "soc" columns, see :func:`scripts.plot.load_vehicle_socs`.
+    :param max_points: The maximum number of points.
+    :return: The downsampled series, or `df` itself if it is short enough.
+    """
+    if len(df) <= max_points:
+        return df
+    indices = lttb_indices(_time_ns(df["time"]), df["soc"].to_numpy(), max_points)
+    return df.iloc[indices].reset_index(drop=True)
+
+
+def fleet_soc_grid(
+    vehicle_socs: Dict[int, Tuple[pd.DataFrame, dict]], step: timedelta
+) -> Tuple[pd.DatetimeIndex, List[int], np.ndarray]:
+    """
+    Resample the SoC time series of all vehicles to a common time grid, by linear interpolation. Before its first and
+    after its last sample, a vehicle's SoC is NaN.
+
+    :param vehicle_socs: The SoC data of all vehicles, as returned by :func:`scripts.plot.load_vehicle_socs`.
+    :param step: The time between two grid points.
+    :return: A tuple of the grid times, the vehicle ids and a (vehicles × times) array of SoCs.
+    """
+    series = {
+        vehicle_id: (_time_ns(df["time"]), df["soc"].to_numpy(dtype=float))
+        for vehicle_id, (df, _) in vehicle_socs.items()
+        if len(df) > 0
+    }
+    if len(series) == 0:
+        return pd.DatetimeIndex([], tz="UTC"), [], np.empty((0, 0))
+    timezone = next(df for df, _ in vehicle_socs.values() if len(df) > 0)["time"].dt.tz
+    start = min(times[0] for times, _ in series.values())
+    end = max(times[-1] for times, _ in series.values())
+    grid = np.arange(start, end + 1, int(step.total_seconds() * 1e9), dtype=np.int64)
+
+    socs = np.full((len(series), len(grid)), np.nan)
+    for row, (times, soc) in enumerate(series.values()):
+        socs[row] = np.interp(grid, times, soc, left=np.nan, right=np.nan)
+    grid_times = pd.to_datetime(grid, utc=True).tz_convert(timezone)
+    return grid_times, list(series.keys()), socs
+
+
+def fleet_soc_bands(socs: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    The minimum and the :data:`PERCENTILES` of the fleet SoC at each grid time, over the vehicles with a SoC at that
+    time.
+
+    :param socs: The array returned by :func:`fleet_soc_grid`.
+    :return: A dictionary mapping "min" and "p5", "p25", ... to arrays with one value per grid time (NaN where no
+        vehicle has a SoC).
+    """
+    bands = {"min": np.full(socs.shape[1], np.nan)}
+    bands.update({f"p{p}": np.full(socs.shape[1], np.nan) for p in PERCENTILES})
+    covered = ~np.all(np.isnan(socs), axis=0)
+    if covered.any():
+        bands["min"][covered] = np.nanmin(socs[:, covered], axis=0)
+        for p, values in zip(
+            PERCENTILES, np.nanpercentile(socs[:, covered], PERCENTILES, axis=0)
+        ):
+            bands[f"p{p}"][covered] = values
+    return bands
@@ -1,13 +1,20 @@
+import hashlib
+import logging
+import os
 import subprocess
+import time
 
-import psycopg2
 import sqlalchemy.engine
 import sqlalchemy.orm
 from eflips.model import Base, Scenario, VehicleType, Trip, Rotation
-from psycopg2._psycopg import parse_dsn
-from sqlalchemy import create_engine
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import Session
 
+from scripts import checkpoint, incremental
+from scripts.clone import clone_scenario
+from scripts.database import get_engine
+
 
 def construct_database_url(
     db_name: str, db_user: str, db_password: str, db_host: str, db_port: int
@@ -25,52 +32,207 @@ def construct_database_url(
     return f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
 
 
+IMPORT_STATE_TABLE = "kyoto_import_state"
+"""A bookkeeping table holding the content hash of the dump the database was imported from."""
+
+
+class DumpImportError(RuntimeError):
+    """
+    Raised if restoring a database dump fails. Contains the stderr output of `psql` or `pg_restore`.
+    """
+
+    def __init__(self, command: str, returncode: int, stderr: str):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(
+            f"{command} failed with exit code {returncode}:\n{stderr.strip()}"
+        )
+
+
 def clear_database(database_url: str):
     """
-    Uses eflips-model to clear the database.
+    Uses eflips-model to clear the database. The bookkeeping tables (import state, checkpoints and saved scenario
+    states) are dropped as well, as they describe the old data.
     **This will delete all data in the database.**
-    :param engine: A SQLAlchemy engine.
+    :param database_url: The database URL.
     :return: None
     """
-    engine = create_engine(database_url)
+    engine = get_engine(database_url)
     Base.metadata.drop_all(engine)
-    engine.dispose()
+    with Session(engine) as session:
+        session.execute(text(f"DROP TABLE IF EXISTS {IMPORT_STATE_TABLE}"))
+        checkpoint.clear_checkpoints(session)
+        incremental.clear_prepared_states(session)
+        session.commit()
+
+
+def dump_format(dump_path: str) -> str:
+    """
+    Detects the format of a database dump.
+
+    :param dump_path: The path to the database dump.
+    :return: "directory" for a `pg_dump -Fd` directory, "custom" for a `pg_dump -Fc` archive, "plain" otherwise.
+    """
+    if os.path.isdir(dump_path):
+        return "directory"
+    with open(dump_path, "rb") as fp:
+        if fp.read(5) == b"PGDMP":
+            return "custom"
+    return "plain"
 
 
-def import_database_dump(database_url: str, dump_path: str):
+def dump_hash(dump_path: str) -> str:
+    """
+    Computes the SHA-256 hash of a database dump. For directory-format dumps, all files are hashed in name order.
+
+    :param dump_path: The path to the database dump.
+    :return: The hex digest of the dump's contents.
+    """
+    if os.path.isdir(dump_path):
+        paths = sorted(os.path.join(dump_path, name) for name in os.listdir(dump_path))
+    else:
+        paths = [dump_path]
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def imported_dump_hash(database_url: str) -> str | None:
+    """
+    Returns the hash of the dump the database was imported from, if the database still is in its freshly imported
+    state.
+
+    :param database_url: The database URL.
+    :return: The hash recorded by :func:`import_database_dump`, or None if there is none.
+    """
+    with get_engine(database_url).connect() as conn:
+        if (
+            conn.execute(
+                text("SELECT to_regclass(:name)"), {"name": IMPORT_STATE_TABLE}
+            ).scalar()
+            is None
+        ):
+            return None
+        return conn.execute(
+            text(f"SELECT dump_hash FROM {IMPORT_STATE_TABLE}")
+        ).scalar()
+
+
+def invalidate_imported_dump_hash(session: sqlalchemy.orm.session.Session) -> None:
+    """
+    Removes the recorded dump hash, marking the database as modified since the import. This is done inside the
+    session's transaction, so it only takes effect if the modifications are committed.
+
+    :param session: An SQLAlchemy session.
+    :return: None
+    """
+    session.execute(sqlalchemy.text(f"DROP TABLE IF EXISTS {IMPORT_STATE_TABLE}"))
+
+
+def import_database_dump(database_url: str, dump_path: str, jobs: int = 1):
     """
     Uses eflips-model to import a database dump. Only runs if there are no scenarios in the database.
 
-    :param engine: A SQLAlchemy engine.
+    Plain SQL dumps are replayed with `psql`. Custom-format (`pg_dump -Fc`) and directory-format (`pg_dump -Fd`)
+    dumps are restored with `pg_restore` using `jobs` parallel jobs. After a successful import, the dump's hash is
+    recorded in the database (see :func:`imported_dump_hash`).
+
+    :param database_url: The database URL.
     :param dump_path: The path to the database dump.
+    :param jobs: The number of parallel restore jobs. Only used for custom and directory-format dumps.
     :return: None
     """
-    engine = create_engine(database_url)
+    logger = logging.getLogger(__name__)
+
+    engine = get_engine(database_url)
     try:
         with Session(engine) as session:
             if session.query(Scenario).count() > 0:
                 raise ValueError("Database is not empty. Refusing to import dump.")
     except sqlalchemy.exc.ProgrammingError:
         pass
-    engine.dispose()
 
     # Manually delete the "alembic_version" table
-    with psycopg2.connect(database_url) as conn:
-        with conn.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS alembic_version")
-        conn.commit()
-
-    database_info = parse_dsn(database_url)
-    subprocess.check_output(
-        f"psql -h {database_info['host']} -U {database_info['user']} -p {database_info['port']} {database_info['dbname']} -f {dump_path}",
-        shell=True,
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
+
+    database_info = make_url(database_url)
+    # Without a host (e.g. for a Unix socket), psql and pg_restore use their defaults
+    host = database_info.host or database_info.query.get("host")
+    connection_args = []
+    if host:
+        connection_args += ["-h", host]
+    if database_info.username:
+        connection_args += ["-U", database_info.username]
+    if database_info.port is not None:
+        connection_args += ["-p", str(database_info.port)]
+    env = dict(os.environ)
+    if database_info.password is not None:
+        env["PGPASSWORD"] = database_info.password
+
+    dump_type = dump_format(dump_path)
+    if dump_type == "plain":
+        command = ["psql", "-q", *connection_args, "-d", database_info.database]
+        command += ["-f", dump_path]
+    else:
+        command = ["pg_restore", "--verbose", "--no-owner", *connection_args]
+        command += ["-d", database_info.database, "-j", str(jobs), dump_path]
+
+    logger.info(f"Importing {dump_type} dump {dump_path} using {command[0]}")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
     )
+    stderr_lines = []
+    for line in process.stderr:
+        stderr_lines.append(line)
+        if "processing data for table" in line or "finished item" in line:
+            logger.info(
+                f"{command[0]} ({time.perf_counter() - start:.1f}s): {line.strip()}"
+            )
+        else:
+            logger.debug(line.strip())
+    returncode = process.wait()
+    if returncode != 0:
+        raise DumpImportError(command[0], returncode, "".join(stderr_lines[-50:]))
+
+    error_lines = [line for line in stderr_lines if "ERROR" in line]
+    if len(error_lines) > 0:
+        logger.warning(
+            f"{command[0]} reported {len(error_lines)} errors, the first one was: {error_lines[0].strip()}"
+        )
+
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {IMPORT_STATE_TABLE} "
+                "(dump_hash TEXT NOT NULL, imported_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        )
+        conn.execute(text(f"DELETE FROM {IMPORT_STATE_TABLE}"))
+        conn.execute(
+            text(f"INSERT INTO {IMPORT_STATE_TABLE} (dump_hash) VALUES (:dump_hash)"),
+            {"dump_hash": dump_hash(dump_path)},
+        )
+
+    logger.info(f"Imported {dump_path} in {time.perf_counter() - start:.1f}s")
 
 
 def create_three_scenarios(session: sqlalchemy.orm.session.Session):
     current_scenario = session.query(Scenario).one()
-    cloned_scenario_1 = current_scenario.clone(session)
-    cloned_scenario_2 = current_scenario.clone(session)
+    cloned_scenario_1, cloned_scenario_2 = clone_scenario(
+        current_scenario, session, count=2
+    )
 
     current_scenario.name = "Depot Charging"
     current_scenario.name_short = "DC"
@@ -80,22 +242,100 @@ def create_three_scenarios(session: sqlalchemy.orm.session.Session):
     cloned_scenario_2.name_short = "TERM"
 
 
-def fixup_rotations(session: sqlalchemy.orm.session.Session) -> None:
+def fixup_rotations(
+    session: sqlalchemy.orm.session.Session,
+    bulk: bool = True,
+    chunk_size: int | None = None,
+) -> None:
     """
     Fix the rotations of the scenarios, by adding a single rotation for each trip
     :param session: An SQLAlchemy session
+    :param bulk: If True, the rotations are created with a single INSERT ... RETURNING and the trips are updated with
+        a bulk UPDATE. If False, one ORM Rotation is created per trip. The elapsed time is logged either way, so
+        the two can be compared.
+    :param chunk_size: If given (and `bulk` is True), the trips are streamed from the database and processed in
+        chunks of this size, so memory use does not grow with the number of trips.
     :return: None
     """
+    logger = logging.getLogger(__name__)
+    start = time.perf_counter()
+
     vehicle_type = (
         session.query(VehicleType).filter(VehicleType.name == "ElectricBus").one()
     )
-    for trip in session.query(Trip):
-        rotation = Rotation(
-            scenario_id=trip.scenario_id,
-            vehicle_type=vehicle_type,
-            allow_opportunity_charging=True,
+    if bulk:
+        trip_count = _fixup_rotations_bulk(session, vehicle_type, chunk_size)
+    else:
+        trip_count = 0
+        for trip in session.query(Trip):
+            rotation = Rotation(
+                scenario_id=trip.scenario_id,
+                vehicle_type=vehicle_type,
+                allow_opportunity_charging=True,
+            )
+            session.add(rotation)
+            trip.rotation = rotation
+            trip_count += 1
+        session.flush()
+        session.expire_all()  # Unclear why this is necessary. But it helps…
+
+    logger.info(
+        f"Created {trip_count} rotations in {time.perf_counter() - start:.2f}s "
+        f"({'bulk' if bulk else 'ORM'})"
+    )
+
+
+def _fixup_rotations_bulk(
+    session: sqlalchemy.orm.session.Session,
+    vehicle_type: VehicleType,
+    chunk_size: int | None = None,
+) -> int:
+    """
+    Set-based implementation of :func:`fixup_rotations`.
+
+    :param session: An SQLAlchemy session
+    :param vehicle_type: The vehicle type to assign to the new rotations.
+    :param chunk_size: If given, the trips are read with a server-side cursor and processed in chunks of this size.
+        Otherwise, all trips are processed at once.
+    :return: The number of rotations created.
+    """
+    statement = select(Trip.id, Trip.scenario_id).order_by(Trip.id)
+    if chunk_size is None:
+        chunks = [session.execute(statement).all()]
+    else:
+        chunks = session.execute(
+            statement.execution_options(yield_per=chunk_size)
+        ).partitions()
+
+    trip_count = 0
+    for trips in chunks:
+        if len(trips) == 0:
+            continue
+        rotation_ids = session.scalars(
+            insert(Rotation).returning(Rotation.id, sort_by_parameter_order=True),
+            [
+                dict(
+                    scenario_id=scenario_id,
+                    vehicle_type_id=vehicle_type.id,
+                    allow_opportunity_charging=True,
+                )
+                for _, scenario_id in trips
+            ],
+        ).all()
+        session.execute(
+            update(Trip),
+            [
+                dict(id=trip_id, rotation_id=rotation_id)
+                for (trip_id, _), rotation_id in zip(trips, rotation_ids)
+            ],
         )
-        session.add(rotation)
-        trip.rotation = rotation
-    session.flush()
-    session.expire_all()  # Unclear why this is necessary. But it helps…
+        trip_count += len(trips)
+
+    # Only the rotation of the trips already loaded in the session has changed
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Trip):
+            session.expire(obj, ["rotation_id", "rotation"])
+        elif isinstance(obj, Rotation):
+            session.expire(obj, ["trips"])
+
+    return trip_count